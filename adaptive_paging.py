@@ -0,0 +1,39 @@
+# Page sizing for throughput harvests.
+#
+# Starts at a modest page size and grows it (up to maxRecordCount) while pages come back
+# faster than the target latency, shrinking it again when a page takes longer, so big
+# fast servers are read in a few large pages and slow ones do not hit timeouts.
+# Callers pair it with a returnCountOnly total so the harvest stops on the last page
+# instead of after a run of empty ones.
+#
+# Tunables (env vars):
+#   ADAPTIVE_PAGE_TARGET_S   page latency to aim for in seconds (default 1.0)
+#   ADAPTIVE_PAGE_INITIAL    first page size (default 100, capped at maxRecordCount)
+
+import os
+
+target_latency_s = float(os.environ.get('ADAPTIVE_PAGE_TARGET_S', '1.0'))
+initial_page_size = int(os.environ.get('ADAPTIVE_PAGE_INITIAL', '100'))
+
+# Limit how fast the size may move per page so one noisy latency sample cannot swing it far
+max_growth = 2.0
+max_shrink = 0.25
+
+class AdaptivePageSize:
+  def __init__(self, max_page_size, initial=None, target_s=None):
+    self.max_page_size = max(1, int(max_page_size))
+    self.target_s = target_s if target_s is not None else target_latency_s
+    self.page_size = min(self.max_page_size, max(1, initial if initial is not None else initial_page_size))
+
+  def next(self, remaining=None):
+    # Page size to ask for next; never more than the features still expected
+    if remaining is not None and remaining > 0:
+      return max(1, min(self.page_size, remaining))
+    return self.page_size
+
+  def observe(self, requested, latency_s):
+    # Scale towards the size that would have taken target_s, assuming latency grows linearly with page size
+    if latency_s <= 0 or requested < self.page_size:
+      return
+    factor = min(max_growth, max(max_shrink, self.target_s / latency_s))
+    self.page_size = min(self.max_page_size, max(1, int(self.page_size * factor)))
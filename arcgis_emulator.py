@@ -0,0 +1,494 @@
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#   "shapely>=2.0.7",
+#   "numpy>=1.21",
+# ]
+# ///
+
+# Offline stand-in for an ArcGIS FeatureServer / MapServer point layer.
+#
+# Serves the layer + service ?f=pjson metadata and the /query endpoint over a synthetic
+# point dataset so test_order_stability.py, initial_research.py and benchmark.py can run
+# without public servers. Supported query parameters: where (1=1, <oid> = N, <oid> IN (...),
+# <oid> < > <= >= <> N joined with AND), objectIds, geometry (polygon rings or envelope),
+# resultOffset, resultRecordCount, orderByFields (the OID field), outFields, returnGeometry,
+# geometryPrecision, quantizationParameters (JSON responses; PBF is always quantized), returnIdsOnly,
+# returnCountOnly and f=json/pjson/pbf (pbf unless --no-pbf or --preset 10.91).
+#
+# Instability modes reproduce what the readme documents for real servers:
+#   none       11.1 / 11.2 behaviour, pages join back into the big query exactly
+#   shuffle    10.91 behaviour, each paginated request sees a slightly different ordering
+#   duplicate  11.3 behaviour, a page may start before resultOffset so rows repeat at page boundaries
+#   drop       a page may start after resultOffset so rows are skipped at page boundaries
+#   mixed      duplicate or drop, picked per request (what gis.blm.gov 11.3 does)
+#
+# --throttle-rps N answers /query requests beyond N per second the way busy servers do, either
+# with HTTP 429 + Retry-After (--throttle-style http) or HTTP 200 + error JSON (--throttle-style json).
+#
+# Responses over 1 KiB are gzip / deflate compressed when the request's Accept-Encoding allows it
+# (--no-compression turns that off). Compressed request bodies (Content-Encoding: gzip) are answered
+# with HTTP 415 unless --accept-compressed-requests is given, like a default IIS front end.
+#
+# Examples:
+#   uv run arcgis_emulator.py --features 1000000 --preset 11.3 --port 8080
+#   uv run test_order_stability.py http://127.0.0.1:8080/arcgis/rest/services/Synthetic/MapServer/0/query
+
+import re
+import sys
+import gzip
+import json
+import zlib
+import random
+import argparse
+import time
+import threading
+import urllib.parse
+import http.server
+
+import numpy
+import shapely
+import shapely.geometry
+
+import esri_pbf
+
+# Version presets mirroring the readme's observed results
+presets = {
+  '10.91': 'shuffle',
+  '11.1': 'none',
+  '11.2': 'none',
+  '11.3': 'mixed',
+}
+instability_modes = ['none', 'shuffle', 'duplicate', 'drop', 'mixed']
+
+class SyntheticLayer:
+  def __init__(self, num_features=100000, seed=0, extent=(-125.0, 24.0, -67.0, 50.0),
+               oid_field='OBJECTID', max_record_count=2000, version=11.2,
+               instability='none', instability_rate=0.3, supports_pbf=True):
+    self.num_features = num_features
+    self.extent = extent
+    self.oid_field = oid_field
+    self.max_record_count = max_record_count
+    self.version = version
+    self.instability = instability
+    self.instability_rate = instability_rate
+    self.supports_pbf = supports_pbf
+    # OIDs are implicit: the feature at index i has OID i+1, so OID order is index order
+    rng = numpy.random.default_rng(seed)
+    self.xs = rng.uniform(extent[0], extent[2], num_features)
+    self.ys = rng.uniform(extent[1], extent[3], num_features)
+    self.pops = rng.integers(0, 1000000, num_features)
+    self.rand = random.Random(seed)
+    self.rand_lock = threading.Lock()
+
+  def fields(self):
+    return [
+      {'name': self.oid_field, 'type': 'esriFieldTypeOID', 'alias': self.oid_field},
+      {'name': 'NAME', 'type': 'esriFieldTypeString', 'alias': 'NAME', 'length': 64},
+      {'name': 'POP', 'type': 'esriFieldTypeInteger', 'alias': 'POP'},
+    ]
+
+  def layer_json(self):
+    xmin, ymin, xmax, ymax = self.extent
+    return {
+      'currentVersion': self.version,
+      'id': 0,
+      'name': 'Synthetic Points',
+      'type': 'Feature Layer',
+      'geometryType': 'esriGeometryPoint',
+      'objectIdField': self.oid_field,
+      'fields': self.fields(),
+      'extent': {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'spatialReference': {'wkid': 4326}},
+      'maxRecordCount': self.max_record_count,
+      'supportedQueryFormats': 'JSON, geoJSON, PBF' if self.supports_pbf else 'JSON, geoJSON',
+      'advancedQueryCapabilities': {
+        'supportsPagination': True,
+        'supportsOrderBy': True,
+        'supportsReturningQueryGeometry': False,
+      },
+    }
+
+  def service_json(self):
+    return {
+      'currentVersion': self.version,
+      'layers': [{'id': 0, 'name': 'Synthetic Points'}],
+    }
+
+  def attributes(self, i, out_fields):
+    attrs = {
+      self.oid_field: int(i) + 1,
+      'NAME': f'Feature {int(i) + 1}',
+      'POP': int(self.pops[i]),
+    }
+    if out_fields is None:
+      return attrs
+    return {k: v for k, v in attrs.items() if k.casefold() in out_fields}
+
+  # Query evaluation, returns ascending feature indexes matching where + objectIds + geometry
+  def select(self, params):
+    idxs = None
+    object_ids = params.get('objectIds', '').strip()
+    if len(object_ids) > 0:
+      oids = numpy.array([int(o) for o in object_ids.split(',') if len(o.strip()) > 0], dtype=numpy.int64)
+      oids = oids[(oids >= 1) & (oids <= self.num_features)]
+      idxs = numpy.unique(oids - 1)
+
+    where = params.get('where', '').strip()
+    if len(where) > 0:
+      idxs = self.apply_where(where, idxs)
+
+    geometry = params.get('geometry', '').strip()
+    if len(geometry) > 0:
+      idxs = self.apply_geometry(geometry, params.get('geometryType', 'esriGeometryEnvelope'), idxs)
+
+    if idxs is None:
+      idxs = numpy.arange(0, self.num_features, dtype=numpy.int64)
+    return idxs
+
+  def apply_where(self, where, idxs):
+    if idxs is None:
+      idxs = numpy.arange(0, self.num_features, dtype=numpy.int64)
+    for clause in re.split(r'\s+and\s+', where, flags=re.IGNORECASE):
+      clause = clause.strip().strip('()').strip()
+      if re.fullmatch(r'1\s*=\s*1', clause):
+        continue
+      m = re.fullmatch(r'(\w+)\s+in\s*\(([\d,\s]*)\)', clause, flags=re.IGNORECASE)
+      if m and m.group(1).casefold() == self.oid_field.casefold():
+        wanted = numpy.array([int(o) for o in m.group(2).split(',') if len(o.strip()) > 0], dtype=numpy.int64)
+        idxs = idxs[numpy.isin(idxs + 1, wanted)]
+        continue
+      m = re.fullmatch(r'(\w+)\s*(<=|>=|<>|=|<|>)\s*(-?\d+)', clause)
+      if m and m.group(1).casefold() == self.oid_field.casefold():
+        op, value = m.group(2), int(m.group(3))
+        oids = idxs + 1
+        if op == '=':
+          idxs = idxs[oids == value]
+        elif op == '<>':
+          idxs = idxs[oids != value]
+        elif op == '<':
+          idxs = idxs[oids < value]
+        elif op == '>':
+          idxs = idxs[oids > value]
+        elif op == '<=':
+          idxs = idxs[oids <= value]
+        elif op == '>=':
+          idxs = idxs[oids >= value]
+        continue
+      raise ValueError(f'Unsupported where clause: {clause}')
+    return idxs
+
+  def apply_geometry(self, geometry, geometry_type, idxs):
+    g_json = json.loads(geometry)
+    if geometry_type == 'esriGeometryEnvelope' or 'xmin' in g_json:
+      g = shapely.geometry.box(g_json['xmin'], g_json['ymin'], g_json['xmax'], g_json['ymax'])
+    elif 'rings' in g_json:
+      g = shapely.geometry.Polygon(g_json['rings'][0], g_json['rings'][1:])
+    else:
+      raise ValueError(f'Unsupported geometry: {geometry}')
+    if not g.is_valid:
+      g = shapely.make_valid(g)
+    if idxs is None:
+      idxs = numpy.arange(0, self.num_features, dtype=numpy.int64)
+    # Cheap bbox pre-filter before the exact point-in-polygon test
+    xmin, ymin, xmax, ymax = g.bounds
+    xs = self.xs[idxs]
+    ys = self.ys[idxs]
+    in_bbox = (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+    idxs = idxs[in_bbox]
+    shapely.prepare(g)
+    return idxs[shapely.intersects_xy(g, self.xs[idxs], self.ys[idxs])]
+
+  def order(self, idxs, params):
+    order_by = params.get('orderByFields', '').strip()
+    if len(order_by) > 0:
+      parts = order_by.split()
+      if parts[0].casefold() == self.oid_field.casefold() and len(parts) > 1 and parts[1].casefold() == 'desc':
+        idxs = idxs[::-1]
+    return idxs
+
+  def perturb_page(self, idxs, offset, count):
+    # Returns the [begin, end) slice of idxs the server "actually" uses for this page request
+    begin = offset
+    if self.instability == 'none' or offset < 1:
+      return idxs, begin
+    with self.rand_lock:
+      if self.rand.random() >= self.instability_rate:
+        return idxs, begin
+      mode = self.instability
+      if mode == 'mixed':
+        mode = self.rand.choice(['duplicate', 'drop'])
+      if mode == 'shuffle':
+        # Swap a few neighbouring rows so this request sees a different ordering than the last one
+        idxs = idxs.copy()
+        for _ in range(0, max(1, len(idxs) // 20)):
+          j = self.rand.randrange(0, max(1, len(idxs) - 1))
+          idxs[j], idxs[j + 1] = idxs[j + 1], idxs[j]
+      elif mode == 'duplicate':
+        begin = max(0, offset - self.rand.randint(1, max(1, count)))
+      elif mode == 'drop':
+        begin = offset + self.rand.randint(1, max(1, count // 2))
+    return idxs, begin
+
+  def query(self, params):
+    idxs = self.select(params)
+
+    if is_true(params.get('returnCountOnly', 'false')):
+      return {'count': int(len(idxs))}
+
+    idxs = self.order(idxs, params)
+
+    if is_true(params.get('returnIdsOnly', 'false')):
+      return {
+        'objectIdFieldName': self.oid_field,
+        'objectIds': (idxs + 1).tolist(),
+      }
+
+    offset = int(params.get('resultOffset', '0') or 0)
+    count = params.get('resultRecordCount', '')
+    count = self.max_record_count if len(str(count)) < 1 else min(int(count), self.max_record_count)
+    idxs, begin = self.perturb_page(idxs, offset, count)
+    page = idxs[begin:begin + count]
+    exceeded_transfer_limit = len(idxs) > begin + count
+
+    out_fields = params.get('outFields', '').strip()
+    if out_fields == '*':
+      out_fields = None
+    else:
+      out_fields = set(f.strip().casefold() for f in out_fields.split(',') if len(f.strip()) > 0)
+    return_geometry = is_true(params.get('returnGeometry', 'true'))
+    # PBF responses are quantized by encode_pbf, so these only change JSON responses
+    is_json = params.get('f', 'json') != 'pbf'
+    precision = params.get('geometryPrecision', '') if is_json else ''
+    precision = int(precision) if len(str(precision).strip()) > 0 else None
+    quantization = params.get('quantizationParameters', '') if is_json else ''
+    quantization = json.loads(quantization) if len(str(quantization).strip()) > 0 else None
+
+    features = []
+    for i in page:
+      f = {'attributes': self.attributes(i, out_fields)}
+      if return_geometry:
+        x, y = float(self.xs[i]), float(self.ys[i])
+        if quantization is not None:
+          # Integer grid steps from the upper left corner of the quantization extent, like real servers
+          x = int(round((x - quantization['extent']['xmin']) / quantization['tolerance']))
+          y = int(round((quantization['extent']['ymax'] - y) / quantization['tolerance']))
+        elif precision is not None:
+          x, y = round(x, precision), round(y, precision)
+        f['geometry'] = {'x': x, 'y': y}
+      features.append(f)
+
+    resp = {
+      'objectIdFieldName': self.oid_field,
+      'geometryType': 'esriGeometryPoint',
+      'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+      'fields': [f for f in self.fields() if out_fields is None or f['name'].casefold() in out_fields],
+      'features': features,
+    }
+    if quantization is not None and return_geometry:
+      tolerance = quantization['tolerance']
+      resp['transform'] = {
+        'originPosition': 'upperLeft',
+        'scale': [tolerance, tolerance, 0, 0],
+        'translate': [quantization['extent']['xmin'], quantization['extent']['ymax'], 0, 0],
+      }
+    if exceeded_transfer_limit:
+      resp['exceededTransferLimit'] = True
+    return resp
+
+  def encode_pbf(self, resp_json):
+    if 'count' in resp_json:
+      return esri_pbf.encode_count(resp_json['count'])
+    if 'objectIds' in resp_json:
+      return esri_pbf.encode_ids(resp_json['objectIdFieldName'], resp_json['objectIds'])
+    return esri_pbf.encode_points(
+      resp_json['objectIdFieldName'], resp_json['fields'], resp_json['features'],
+      translate=(self.extent[0], self.extent[1]), scale=(1e-8, 1e-8),
+      exceeded_transfer_limit=resp_json.get('exceededTransferLimit', False),
+    )
+
+def is_true(value):
+  return str(value).strip().casefold() in ('true', '1', 'yes')
+
+def error_json(code, message, details=None):
+  return {'error': {'code': code, 'message': message, 'details': details or []}}
+
+throttle_styles = ['http', 'json']
+
+class Throttle:
+  # Token bucket shared by every request thread of one server
+  def __init__(self, rps, style='http'):
+    self.rps = float(rps)
+    self.style = style
+    self.tokens = self.rps
+    self.refilled_s = time.monotonic()
+    self.num_throttled = 0
+    self.lock = threading.Lock()
+
+  def allow(self):
+    with self.lock:
+      now_s = time.monotonic()
+      self.tokens = min(self.rps, self.tokens + (now_s - self.refilled_s) * self.rps)
+      self.refilled_s = now_s
+      if self.tokens >= 1.0:
+        self.tokens -= 1.0
+        return True
+      self.num_throttled += 1
+      return False
+
+class EmulatorRequestHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  layer = None # Set on the subclass made by make_server()
+  throttle = None
+  compression = True
+  accept_compressed_requests = False
+  quiet = True
+
+  def do_GET(self):
+    parsed = urllib.parse.urlsplit(self.path)
+    self.handle_params(parsed.path, dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)))
+
+  def do_POST(self):
+    parsed = urllib.parse.urlsplit(self.path)
+    content_len = int(self.headers.get('Content-Length', '0') or 0)
+    body = self.rfile.read(content_len)
+    if self.headers.get('Content-Encoding', 'identity').lower() == 'gzip':
+      if not self.accept_compressed_requests:
+        self.send_body(json.dumps(error_json(415, 'Unsupported Media Type')).encode('utf-8'), 'application/json; charset=utf-8', status=415)
+        return
+      body = gzip.decompress(body)
+    body = body.decode('utf-8')
+    params = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+    params.update(dict(urllib.parse.parse_qsl(body, keep_blank_values=True)))
+    self.handle_params(parsed.path, params)
+
+  def handle_params(self, path, params):
+    path = path.rstrip('/')
+    if path.endswith('/query') and self.throttle is not None and not self.throttle.allow():
+      self.send_throttled(params.get('f', 'html'))
+      return
+    try:
+      if path.endswith('/query'):
+        resp_json = self.layer.query(params)
+      elif re.search(r'/(FeatureServer|MapServer)/\d+$', path):
+        resp_json = self.layer.layer_json()
+      elif re.search(r'/(FeatureServer|MapServer)$', path):
+        resp_json = self.layer.service_json()
+      elif path.endswith('/rest/services') or path.endswith('/rest'):
+        resp_json = {'currentVersion': self.layer.version, 'folders': [], 'services': [{'name': 'Synthetic', 'type': 'FeatureServer'}]}
+      else:
+        resp_json = error_json(404, 'Not Found')
+    except Exception as e:
+      # ArcGIS reports query problems as HTTP 200 + error JSON, not as an HTTP error status
+      resp_json = error_json(400, 'Unable to complete operation.', [str(e)])
+    self.send_json(resp_json, params.get('f', 'html'))
+
+  def send_json(self, resp_json, f):
+    if f == 'pbf' and self.layer.supports_pbf and not 'error' in resp_json:
+      self.send_body(self.layer.encode_pbf(resp_json), 'application/x-protobuf')
+      return
+    if f == 'pjson':
+      body = json.dumps(resp_json, indent=2).encode('utf-8')
+    else:
+      body = json.dumps(resp_json, separators=(',', ':')).encode('utf-8')
+    self.send_body(body, 'application/json; charset=utf-8')
+
+  def send_throttled(self, f):
+    if self.throttle.style == 'json':
+      self.send_json(error_json(429, 'Too many requests. Please try again later.'), f)
+      return
+    body = json.dumps(error_json(429, 'Too Many Requests')).encode('utf-8')
+    self.send_response(429)
+    self.send_header('Retry-After', '1')
+    self.send_header('Content-Type', 'application/json; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_body(self, body, content_type, status=200):
+    accepted = [ e.split(';')[0].strip().lower() for e in self.headers.get('Accept-Encoding', '').split(',') ]
+    content_encoding = None
+    if self.compression and len(body) > 1024:
+      if 'gzip' in accepted:
+        body, content_encoding = gzip.compress(body, compresslevel=6), 'gzip'
+      elif 'deflate' in accepted:
+        body, content_encoding = zlib.compress(body, 6), 'deflate'
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    if content_encoding is not None:
+      self.send_header('Content-Encoding', content_encoding)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if not self.quiet:
+      super().log_message(format, *args)
+
+class EmulatorServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+  request_queue_size = 1024
+
+def make_server(layer, host='127.0.0.1', port=0, quiet=True, throttle=None, compression=True, accept_compressed_requests=False):
+  handler = type('BoundEmulatorRequestHandler', (EmulatorRequestHandler,), {
+    'layer': layer, 'quiet': quiet, 'throttle': throttle,
+    'compression': compression, 'accept_compressed_requests': accept_compressed_requests,
+  })
+  return EmulatorServer((host, port), handler)
+
+def layer_query_url(server, service_kind='MapServer'):
+  host, port = server.server_address[0], server.server_address[1]
+  return f'http://{host}:{port}/arcgis/rest/services/Synthetic/{service_kind}/0/query'
+
+def serve_in_thread(layer, host='127.0.0.1', port=0, throttle=None, compression=True, accept_compressed_requests=False):
+  # Starts an emulator on a background thread, returns (server, query_url); call server.shutdown() when done
+  server = make_server(layer, host=host, port=port, throttle=throttle, compression=compression, accept_compressed_requests=accept_compressed_requests)
+  t = threading.Thread(target=server.serve_forever, daemon=True)
+  t.start()
+  return server, layer_query_url(server)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Offline ArcGIS FeatureServer/MapServer emulator')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--features', type=int, default=100000, help='number of synthetic points')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--preset', choices=sorted(presets.keys()), default=None, help='server version to imitate, sets --version and --instability')
+  parser.add_argument('--version', type=float, default=11.2, help='currentVersion to report')
+  parser.add_argument('--instability', choices=instability_modes, default='none')
+  parser.add_argument('--instability-rate', type=float, default=0.3, help='fraction of paginated requests that misbehave')
+  parser.add_argument('--max-record-count', type=int, default=2000)
+  parser.add_argument('--oid-field', default='OBJECTID')
+  parser.add_argument('--no-pbf', action='store_true', help='do not advertise or serve f=pbf')
+  parser.add_argument('--throttle-rps', type=float, default=0, help='throttle /query requests beyond this rate (0 = never)')
+  parser.add_argument('--throttle-style', choices=throttle_styles, default='http', help='http = 429 + Retry-After, json = 200 + error JSON')
+  parser.add_argument('--no-compression', action='store_true', help='never gzip / deflate responses')
+  parser.add_argument('--accept-compressed-requests', action='store_true', help='accept gzip request bodies instead of answering 415')
+  parser.add_argument('--verbose', action='store_true')
+  args = parser.parse_args(argv)
+
+  version, instability, supports_pbf = args.version, args.instability, not args.no_pbf
+  if args.preset is not None:
+    version, instability = float(args.preset), presets[args.preset]
+    supports_pbf = supports_pbf and version >= 11.0
+
+  print(f'Generating {args.features:,} synthetic points (seed={args.seed})')
+  layer = SyntheticLayer(
+    num_features=args.features, seed=args.seed, oid_field=args.oid_field,
+    max_record_count=args.max_record_count, version=version,
+    instability=instability, instability_rate=args.instability_rate, supports_pbf=supports_pbf,
+  )
+  throttle = Throttle(args.throttle_rps, args.throttle_style) if args.throttle_rps > 0 else None
+  server = make_server(layer, host=args.host, port=args.port, quiet=not args.verbose, throttle=throttle,
+                       compression=not args.no_compression, accept_compressed_requests=args.accept_compressed_requests)
+  print(f'Emulating version {version} with instability={instability} (rate={args.instability_rate}) supports_pbf={supports_pbf}')
+  print(f'  {layer_query_url(server, "FeatureServer")}')
+  print(f'  {layer_query_url(server, "MapServer")}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
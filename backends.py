@@ -0,0 +1,108 @@
+# Lazily loaded optional backends.
+#
+# The arcgis package takes seconds to import and pyproj a noticeable fraction of one, while most
+# runs only use http_pool (stdlib) for queries. Both are imported on first use through the
+# functions here, so a run that never sets USE_ARCGIS_PAGES never pays for arcgis, and every
+# worker process started by parallel_runner.py starts quickly.
+#
+#   arcgis()     the arcgis package with arcgis.features, arcgis.geometry and arcgis.gis loaded
+#   geodesic()   object with area_m2(shapely_polygon) and areas_m2(shapely geometry array), picked by GEODESIC_BACKEND;
+#                one instance per process, so the pyproj.Geod is built once
+#
+# Tunables (env vars):
+#   GEODESIC_BACKEND   pyproj    = WGS84 ellipsoid via pyproj.Geod (default when pyproj is installed)
+#                      spherical = sphere with the authalic radius, no dependencies; edges are straight lines in
+#                                  lon/lat (as in a 4326 query geometry) rather than geodesics, so it is within ~1% of
+#                                  pyproj for 1 degree polygons but drifts apart for large or sliver ones
+#
+# `python -X importtime` profiles are summarized by `uv run benchmark.py startup`.
+
+import os
+import math
+import threading
+
+geodesic_backend_names = ['pyproj', 'spherical']
+
+_lock = threading.Lock()
+_arcgis = None
+_geodesic = None
+
+def arcgis():
+  global _arcgis
+  if _arcgis is None:
+    with _lock:
+      if _arcgis is None:
+        import arcgis as arcgis_module
+        import arcgis.gis
+        import arcgis.features
+        import arcgis.geometry
+        _arcgis = arcgis_module
+  return _arcgis
+
+class PyprojGeodesic:
+  name = 'pyproj'
+
+  def __init__(self):
+    import pyproj
+    self.geod = pyproj.Geod(ellps='WGS84')
+
+  def area_m2(self, g):
+    return abs(self.geod.geometry_area_perimeter(g)[0])
+
+  def areas_m2(self, polygons):
+    import numpy
+    return numpy.fromiter((self.area_m2(g) for g in polygons), dtype=numpy.float64, count=len(polygons))
+
+class SphericalGeodesic:
+  # Ring area on a sphere with the WGS84 authalic radius, each edge taken as straight in lon / sin(lat)
+  name = 'spherical'
+  radius_m = 6371007.181
+
+  def ring_area_m2(self, coords):
+    total = 0.0
+    for (x1, y1), (x2, y2) in zip(coords, coords[1:]):
+      total += math.radians(x2 - x1) * (2.0 + math.sin(math.radians(y1)) + math.sin(math.radians(y2)))
+    return abs(total) * self.radius_m * self.radius_m / 2.0
+
+  def area_m2(self, g):
+    polygons = g.geoms if hasattr(g, 'geoms') else [g]
+    total = 0.0
+    for p in polygons:
+      total += self.ring_area_m2([ c[:2] for c in p.exterior.coords ])
+      for interior in p.interiors:
+        total -= self.ring_area_m2([ c[:2] for c in interior.coords ])
+    return total
+
+  def areas_m2(self, polygons):
+    # Same formula over every ring of every polygon at once: shells add, holes subtract
+    import numpy
+    import shapely
+    polygons = numpy.asarray(polygons)
+    rings, ring_polygon = shapely.get_rings(polygons, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    lon = numpy.radians(coords[:, 0])
+    sin_lat = numpy.sin(numpy.radians(coords[:, 1]))
+    same_ring = coord_ring[:-1] == coord_ring[1:]
+    edge_terms = (lon[1:] - lon[:-1]) * (2.0 + sin_lat[:-1] + sin_lat[1:])
+    ring_areas = numpy.abs(numpy.bincount(coord_ring[:-1][same_ring], weights=edge_terms[same_ring], minlength=len(rings)))
+    ring_areas *= self.radius_m * self.radius_m / 2.0
+    is_shell = numpy.ones(len(rings), dtype=bool)
+    is_shell[1:] = ring_polygon[1:] != ring_polygon[:-1]
+    return numpy.bincount(ring_polygon, weights=numpy.where(is_shell, ring_areas, -ring_areas), minlength=len(polygons))
+
+def geodesic():
+  global _geodesic
+  if _geodesic is None:
+    with _lock:
+      if _geodesic is None:
+        name = os.environ.get('GEODESIC_BACKEND', '')
+        if len(name) > 0 and not name in geodesic_backend_names:
+          raise Exception(f'Unknown GEODESIC_BACKEND {name}, expected one of {geodesic_backend_names}')
+        if len(name) < 1:
+          try:
+            import pyproj
+            name = 'pyproj'
+          except ImportError:
+            name = 'spherical'
+        _geodesic = PyprojGeodesic() if name == 'pyproj' else SphericalGeodesic()
+  return _geodesic
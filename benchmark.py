@@ -0,0 +1,611 @@
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#   "shapely>=2.0.7",
+#   "numpy>=1.21",
+#   "pyproj>=2.3.0",
+#   "arcgis>=2.4.0"
+# ]
+# ///
+
+# Benchmarks for the query harness.
+#
+#   uv run benchmark.py keepalive [QUERY_URL] [--pages N]
+#     Fetches the same sequence of small pages once with a fresh urllib.request.urlopen()
+#     per page (the old behaviour) and once through http_pool.fetch(), and reports
+#     per-page latency for both so the handshake cost is visible.
+#
+#   uv run benchmark.py strategies [--url QUERY_URL] [--dataset-sizes 10000,100000] [--page-sizes 5,50,500]
+#                                  [--strategies pages,double_query,...] [--out bench_results.json]
+#     Runs each paging strategy once per (dataset size, page size) against a local arcgis_emulator.py
+#     (or --url) and reports p50/p95/p99 request latency, features/s, bytes transferred and peak RSS.
+#     Every case runs in its own child process so peak RSS is per case. Results are written as JSON.
+#
+#   uv run benchmark.py formats [--url QUERY_URL] [--page-size 500] [--pages 10]
+#     Fetches the same pages as f=pjson, f=json and f=pbf and reports bytes (decoded and on the wire,
+#     see HTTP_ACCEPT_ENCODING) and decode time per page for each, against a local arcgis_emulator.py
+#     unless --url is given.
+#
+#   uv run benchmark.py payloads [--url QUERY_URL] [--page-size 500] [--pages 10] [--fields NAME] [--quantize-tolerance 0.0001]
+#     Fetches the same pages through query_feature_page with each payload profile (full, fields, oid and,
+#     with --quantize-tolerance, full with quantized geometry) and reports bytes and time per page, and
+#     whether every profile returned the same OIDs as the full payload.
+#
+#   uv run benchmark.py arcgis [--url QUERY_URL] [--page-size 50] [--pages 20]
+#     Per-page latency of the same pages through query_feature_page (http_pool), through
+#     query_feature_page_arcgis building a FeatureLayer + geometry filter per page, and through
+#     query_feature_page_arcgis with the FeatureLayer pool, so the arcgis per-page overhead is visible.
+#
+#   uv run benchmark.py trials [--url QUERY_URL] [--trials 200] [--coverage 0.0005] [--page-size 10]
+#     Runs many offset-paging trials of one polygon at once as asyncio tasks sharing a single
+#     feature_service.FeatureServiceClient, and checks every trial's OIDs against returnIdsOnly,
+#     so trials/s and any cross-trial interference in one process are visible.
+#
+#   uv run benchmark.py startup [--module test_order_stability] [--runs 5] [--top 15]
+#     Wall time to import the module in a fresh interpreter, and a `python -X importtime` profile
+#     summed per top-level package, so heavy imports creeping back into startup are visible.
+#
+#   uv run benchmark.py compare OLD.json NEW.json
+#     Prints the per-case change in latency, throughput, bytes and RSS between two result files.
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import urllib.parse
+import urllib.request
+
+import http_pool
+import content_coding
+
+default_query_url = 'https://sampleserver6.arcgisonline.com/arcgis/rest/services/USA/MapServer/0/query'
+
+def page_request_data(page_num, page_size):
+  return urllib.parse.urlencode({
+    'where': '1=1',
+    'outFields': '*',
+    'returnGeometry': True,
+    'resultOffset': page_num * page_size,
+    'resultRecordCount': page_size,
+    'f': 'pjson',
+  }).encode()
+
+def fetch_with_urlopen(url, data):
+  return urllib.request.urlopen(urllib.request.Request(url, data=data)).read()
+
+def time_pages(fetch_fn, query_url, num_pages, page_size):
+  page_latencies_s = []
+  for page_num in range(0, num_pages):
+    begin_s = time.perf_counter()
+    resp_txt = fetch_fn(query_url, page_request_data(page_num, page_size))
+    json.loads(resp_txt)
+    page_latencies_s.append(time.perf_counter() - begin_s)
+  return page_latencies_s
+
+def print_latencies(label, page_latencies_s):
+  print(f'  {label: <28} mean={statistics.mean(page_latencies_s)*1000.0:8.1f} ms  median={statistics.median(page_latencies_s)*1000.0:8.1f} ms  first={page_latencies_s[0]*1000.0:8.1f} ms  rest-mean={statistics.mean(page_latencies_s[1:] or page_latencies_s)*1000.0:8.1f} ms')
+
+def bench_keepalive(args):
+  print(f'Benchmarking {args.pages} pages of {args.page_size} features from {args.query_url}')
+  # Warm up DNS + server-side caches so neither run gets an unfair first request
+  fetch_with_urlopen(args.query_url, page_request_data(0, args.page_size))
+
+  before_s = time_pages(fetch_with_urlopen, args.query_url, args.pages, args.page_size)
+  http_pool.close_all()
+  after_s = time_pages(http_pool.fetch, args.query_url, args.pages, args.page_size)
+
+  print_latencies('before (urlopen per page)', before_s)
+  print_latencies('after (http_pool.fetch)', after_s)
+  saved_ms = (statistics.median(before_s) - statistics.median(after_s)) * 1000.0
+  print(f'  handshake cost removed from median page latency: {saved_ms:.1f} ms')
+  print(f'  http_pool stats = {http_pool.stats}')
+
+strategy_names = ['pages', 'pages_adaptive', 'pages_arcgis', 'keyset', 'tiled', 'double_query', 'double_query_batched']
+
+def percentile(values, pct):
+  if len(values) < 1:
+    return None
+  ordered = sorted(values)
+  k = (len(ordered) - 1) * (pct / 100.0)
+  lo = int(k)
+  hi = min(lo + 1, len(ordered) - 1)
+  return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def peak_rss_kb():
+  # ru_maxrss is KiB on Linux and bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    peak = peak // 1024
+  return peak
+
+def benchmark_polygon(extent, coverage):
+  # A box centered in the layer extent covering `coverage` of its area
+  import shapely.geometry
+  cx = (extent['xmin'] + extent['xmax']) / 2.0
+  cy = (extent['ymin'] + extent['ymax']) / 2.0
+  half_w = (extent['xmax'] - extent['xmin']) * (coverage ** 0.5) / 2.0
+  half_h = (extent['ymax'] - extent['ymin']) * (coverage ** 0.5) / 2.0
+  return shapely.geometry.box(cx - half_w, cy - half_h, cx + half_w, cy + half_h)
+
+def run_case(args):
+  # Runs in a child process: one strategy at one page size, result JSON written to args.result_file
+  import shapely.wkt
+  import test_order_stability
+
+  request_latencies_s = []
+  request_bytes = []
+  def on_response(url, latency_s, num_bytes):
+    request_latencies_s.append(latency_s)
+    request_bytes.append(num_bytes)
+  http_pool.response_listeners.append(on_response)
+
+  polygon = shapely.wkt.loads(args.polygon_wkt)
+
+  page_latencies_s = []
+  def timed(page_fn):
+    def timed_page_fn(*fn_args, **fn_kwargs):
+      begin_s = time.perf_counter()
+      page = page_fn(*fn_args, **fn_kwargs)
+      page_latencies_s.append(time.perf_counter() - begin_s)
+      return page
+    return timed_page_fn
+
+  begin_s = time.perf_counter()
+  if args.strategy == 'pages':
+    offset_and_len, pages_of_oids = test_order_stability.query_all_feature_pages(
+      args.query_url, polygon, query_feature_page_fn=timed(test_order_stability.query_feature_page), page_sizes=[args.page_size])
+  elif args.strategy == 'pages_adaptive':
+    offset_and_len, pages_of_oids = test_order_stability.query_all_feature_pages(
+      args.query_url, polygon, query_feature_page_fn=timed(test_order_stability.query_feature_page), adaptive=True)
+  elif args.strategy == 'pages_arcgis':
+    offset_and_len, pages_of_oids = test_order_stability.query_all_feature_pages(
+      args.query_url, polygon, query_feature_page_fn=timed(test_order_stability.query_feature_page_arcgis), page_sizes=[args.page_size])
+  elif args.strategy == 'keyset':
+    offset_and_len, pages_of_oids = test_order_stability.keyset_query_all_feature_pages(
+      args.query_url, polygon, query_feature_page_fn=timed(test_order_stability.query_feature_page), page_sizes=[args.page_size])
+  elif args.strategy == 'tiled':
+    offset_and_len, pages_of_oids = test_order_stability.tiled_query_all_feature_pages(
+      args.query_url, polygon, query_feature_page_fn=timed(test_order_stability.query_feature_page), tile_record_count=args.page_size)
+  elif args.strategy == 'double_query':
+    offset_and_len, pages_of_oids = test_order_stability.double_query_all_feature_pages(args.query_url, polygon)
+  elif args.strategy == 'double_query_batched':
+    offset_and_len, pages_of_oids = test_order_stability.double_query_all_feature_pages(
+      args.query_url, polygon, batched=True, batch_size=args.page_size)
+  else:
+    raise Exception(f'Unknown strategy {args.strategy}')
+  duration_s = time.perf_counter() - begin_s
+
+  # The arcgis path does not go through http_pool, so fall back to per-page timings for it
+  latencies_s = request_latencies_s if len(request_latencies_s) > 0 else page_latencies_s
+  num_features = len(set(oid for page in pages_of_oids for oid in page))
+  result = {
+    'strategy': args.strategy,
+    'page_size': args.page_size,
+    'num_requests': len(latencies_s),
+    'num_pages': len(pages_of_oids),
+    'num_features': num_features,
+    'duration_s': duration_s,
+    'latency_p50_s': percentile(latencies_s, 50),
+    'latency_p95_s': percentile(latencies_s, 95),
+    'latency_p99_s': percentile(latencies_s, 99),
+    'features_per_s': num_features / duration_s if duration_s > 0 else None,
+    'bytes_transferred': sum(request_bytes) if len(request_bytes) > 0 else None,
+    'peak_rss_kb': peak_rss_kb(),
+  }
+  with open(args.result_file, 'w') as fd:
+    json.dump(result, fd)
+
+def run_case_in_child(query_url, polygon, strategy, page_size):
+  with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as fd:
+    result_file = fd.name
+  try:
+    child = subprocess.run([
+      sys.executable, os.path.abspath(__file__), 'run-case',
+      '--query-url', query_url, '--polygon-wkt', polygon.wkt,
+      '--strategy', strategy, '--page-size', str(page_size),
+      '--result-file', result_file,
+    ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if child.returncode != 0:
+      print(child.stdout.decode('utf-8', errors='replace'))
+      return {'strategy': strategy, 'page_size': page_size, 'error': f'exit code {child.returncode}'}
+    with open(result_file, 'r') as fd:
+      return json.load(fd)
+  finally:
+    os.remove(result_file)
+
+def format_s(value_s):
+  if value_s is None:
+    return '     n/a'
+  return f'{value_s*1000.0:7.1f}ms'
+
+def print_result(r):
+  if 'error' in r:
+    print(f'  {r["strategy"]: <22} page_size={r["page_size"]: <5} ERROR {r["error"]}')
+    return
+  bytes_txt = 'n/a' if r['bytes_transferred'] is None else f'{r["bytes_transferred"]:,}'
+  print(f'  {r["strategy"]: <22} page_size={r["page_size"]: <5} requests={r["num_requests"]: <6} features={r["num_features"]: <7} '
+        f'p50={format_s(r["latency_p50_s"])} p95={format_s(r["latency_p95_s"])} p99={format_s(r["latency_p99_s"])} '
+        f'{r["features_per_s"] or 0:9.1f} features/s  bytes={bytes_txt}  peak_rss={r["peak_rss_kb"]:,} KiB')
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8').strip()
+  except:
+    return None
+
+def bench_strategies(args):
+  import layer_metadata
+  strategies = args.strategies.split(',')
+  page_sizes = [int(p) for p in args.page_sizes.split(',')]
+  dataset_sizes = [int(d) for d in args.dataset_sizes.split(',')]
+  results = {
+    'git_revision': git_revision(),
+    'python': platform.python_version(),
+    'host': socket.gethostname(),
+    'timestamp_s': time.time(),
+    'coverage': args.coverage,
+    'cases': [],
+  }
+
+  targets = [] # (dataset_size or None, query_url, server or None)
+  if args.url is not None:
+    targets.append((None, args.url, None))
+  else:
+    import arcgis_emulator
+    for dataset_size in dataset_sizes:
+      layer = arcgis_emulator.SyntheticLayer(num_features=dataset_size, seed=args.seed, instability=args.instability)
+      server, query_url = arcgis_emulator.serve_in_thread(layer)
+      targets.append((dataset_size, query_url, server))
+
+  for dataset_size, query_url, server in targets:
+    extent = layer_metadata.get(query_url)['extent']
+    polygon = benchmark_polygon(extent, args.coverage)
+    print(f'=== {query_url} dataset_size={dataset_size} ===')
+    for strategy in strategies:
+      for page_size in page_sizes:
+        if strategy in ('double_query', 'pages_adaptive') and page_size != page_sizes[0]:
+          continue # One request per OID / page size picked at run time, page size does not apply
+        r = run_case_in_child(query_url, polygon, strategy, page_size)
+        r['dataset_size'] = dataset_size
+        r['query_url'] = query_url
+        print_result(r)
+        results['cases'].append(r)
+    if server is not None:
+      server.shutdown()
+
+  with open(args.out, 'w') as fd:
+    json.dump(results, fd, indent=2)
+  print(f'Wrote {len(results["cases"])} results to {args.out}')
+
+def decode_format(f, resp_txt):
+  import esri_pbf
+  if f == 'pbf' and resp_txt.lstrip()[:1] != b'{':
+    return esri_pbf.decode(resp_txt)
+  return json.loads(resp_txt)
+
+def bench_formats(args):
+  server = None
+  query_url = args.url
+  if query_url is None:
+    import arcgis_emulator
+    layer = arcgis_emulator.SyntheticLayer(num_features=args.dataset_size, seed=args.seed)
+    server, query_url = arcgis_emulator.serve_in_thread(layer)
+
+  print(f'Benchmarking {args.pages} pages of {args.page_size} features from {query_url}')
+  baseline = None
+  for f in ['pjson', 'json', 'pbf']:
+    page_bytes = []
+    decode_s = []
+    num_features = 0
+    wire_bytes_before = http_pool.stats['bytes_received']
+    for page_num in range(0, args.pages):
+      data = urllib.parse.urlencode({
+        'where': '1=1',
+        'outFields': '*',
+        'returnGeometry': True,
+        'resultOffset': page_num * args.page_size,
+        'resultRecordCount': args.page_size,
+        'f': f,
+      }).encode()
+      resp_txt = http_pool.fetch(query_url, data=data)
+      begin_s = time.perf_counter()
+      resp_json = decode_format(f, resp_txt)
+      decode_s.append(time.perf_counter() - begin_s)
+      page_bytes.append(len(resp_txt))
+      num_features += len(resp_json.get('features', []))
+    if num_features < 1:
+      print(f'  f={f: <6} returned no features (format unsupported by the server?)')
+      continue
+    mean_bytes = statistics.mean(page_bytes)
+    mean_wire_bytes = (http_pool.stats['bytes_received'] - wire_bytes_before) / args.pages
+    mean_decode_s = statistics.mean(decode_s)
+    if baseline is None:
+      baseline = (mean_bytes, mean_decode_s)
+    print(f'  f={f: <6} {mean_bytes:12,.0f} bytes/page ({100.0*(1.0-mean_bytes/baseline[0]):5.1f}% saved)  '
+          f'{mean_wire_bytes:12,.0f} on the wire (Accept-Encoding: {content_coding.accept_encoding})  '
+          f'decode {mean_decode_s*1000.0:7.2f} ms/page ({(baseline[1]-mean_decode_s)*1000.0:+.2f} ms saved)  {num_features} features')
+
+  if server is not None:
+    server.shutdown()
+
+def bench_payloads(args):
+  import shapely.geometry
+  import feature_service
+  import payload_profiles
+
+  server = None
+  query_url = args.url
+  if query_url is None:
+    import arcgis_emulator
+    layer = arcgis_emulator.SyntheticLayer(num_features=args.dataset_size, seed=args.seed)
+    server, query_url = arcgis_emulator.serve_in_thread(layer)
+
+  client = feature_service.client_for(query_url)
+  extent = client.extent
+  polygon = shapely.geometry.box(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+  profiles = [
+    payload_profiles.PayloadProfile('full'),
+    payload_profiles.PayloadProfile('fields', fields=args.fields.split(',')),
+    payload_profiles.PayloadProfile('oid'),
+  ]
+  if args.quantize_tolerance is not None:
+    profiles.append(payload_profiles.PayloadProfile('full', quantize_tolerance=args.quantize_tolerance))
+
+  def fetch_pages(profile):
+    pages = []
+    for page_num in range(0, args.pages):
+      pages.append(client.query_feature_page(polygon, resultOffset=page_num * args.page_size, resultRecordCount=args.page_size, payload=profile))
+    return pages
+
+  print(f'Benchmarking {args.pages} pages of {args.page_size} features from {query_url} (f={client.query_format})')
+  fetch_pages(profiles[0]) # Warm up the connection pool and metadata cache
+  baseline = None
+  for profile in profiles:
+    wire_bytes_before = http_pool.stats['bytes_received']
+    decoded_bytes_before = http_pool.stats['bytes_decoded']
+    begin_s = time.perf_counter()
+    pages = fetch_pages(profile)
+    duration_s = time.perf_counter() - begin_s
+    mean_wire_bytes = (http_pool.stats['bytes_received'] - wire_bytes_before) / args.pages
+    mean_decoded_bytes = (http_pool.stats['bytes_decoded'] - decoded_bytes_before) / args.pages
+    mean_s = duration_s / args.pages
+    if baseline is None:
+      baseline = (mean_decoded_bytes, mean_s, pages)
+    same_oids = 'same OIDs as full' if pages == baseline[2] else 'OIDs DIFFER from full'
+    print(f'  {profile.describe(client.oid_field)}')
+    print(f'      {mean_decoded_bytes:12,.0f} bytes/page ({100.0*(1.0-mean_decoded_bytes/baseline[0]):5.1f}% saved)  {mean_wire_bytes:12,.0f} on the wire  '
+          f'{mean_s*1000.0:7.2f} ms/page ({(baseline[1]-mean_s)*1000.0:+.2f} ms saved)  {same_oids}')
+
+  if server is not None:
+    server.shutdown()
+
+def bench_arcgis(args):
+  import shapely.geometry
+  import layer_metadata
+  import feature_service
+  import test_order_stability
+
+  server = None
+  query_url = args.url
+  if query_url is None:
+    import arcgis_emulator
+    layer = arcgis_emulator.SyntheticLayer(num_features=args.dataset_size, seed=args.seed)
+    server, query_url = arcgis_emulator.serve_in_thread(layer)
+
+  extent = layer_metadata.get(query_url)['extent']
+  polygon = shapely.geometry.box(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+
+  def time_page_fn(page_fn):
+    page_latencies_s = []
+    for page_num in range(0, args.pages):
+      begin_s = time.perf_counter()
+      page_fn(query_url, polygon, resultOffset=page_num * args.page_size, resultRecordCount=args.page_size)
+      page_latencies_s.append(time.perf_counter() - begin_s)
+    return page_latencies_s
+
+  print(f'Benchmarking {args.pages} pages of {args.page_size} features from {query_url}')
+  time_page_fn(test_order_stability.query_feature_page) # Warm up the connection pool and metadata cache
+  raw_s = time_page_fn(test_order_stability.query_feature_page)
+  feature_service.use_arcgis_layer_pool = False
+  unpooled_s = time_page_fn(test_order_stability.query_feature_page_arcgis)
+  feature_service.use_arcgis_layer_pool = True
+  pooled_s = time_page_fn(test_order_stability.query_feature_page_arcgis)
+
+  print_latencies('query_feature_page', raw_s)
+  print_latencies('arcgis, layer per page', unpooled_s)
+  print_latencies('arcgis, pooled layer', pooled_s)
+  for label, latencies_s in [('layer per page', unpooled_s), ('pooled layer', pooled_s)]:
+    print(f'  arcgis overhead over query_feature_page ({label}): {(statistics.median(latencies_s) - statistics.median(raw_s))*1000.0:+.1f} ms/page (median)')
+
+  if server is not None:
+    server.shutdown()
+
+def bench_trials(args):
+  import asyncio
+  import random
+  import layer_metadata
+  import feature_service
+
+  server = None
+  query_url = args.url
+  if query_url is None:
+    import arcgis_emulator
+    layer = arcgis_emulator.SyntheticLayer(num_features=args.dataset_size, seed=args.seed)
+    server, query_url = arcgis_emulator.serve_in_thread(layer)
+
+  client = feature_service.client_for(query_url)
+  polygon = benchmark_polygon(client.extent, args.coverage)
+  expected_oids = set(client.query_all_feature_oids(polygon))
+  num_requests_before = http_pool.stats['requests']
+
+  async def trial(trial_num):
+    # Every trial uses its own page size, so trials interleave pages of different offsets on the shared client
+    page_size = random.randint(max(1, args.page_size // 2), args.page_size * 2)
+    trial_oids = set()
+    result_offset = 0
+    while True:
+      page = await client.aquery_feature_page(polygon, resultOffset=result_offset, resultRecordCount=page_size)
+      if len(page) < 1:
+        break
+      trial_oids.update(page)
+      result_offset += len(page)
+    return trial_oids
+
+  async def run_all():
+    return await asyncio.gather(*[ trial(i) for i in range(0, args.trials) ])
+
+  print(f'Running {args.trials} concurrent trials of {len(expected_oids)} features from {query_url}')
+  begin_s = time.perf_counter()
+  trial_oid_sets = asyncio.run(run_all())
+  duration_s = time.perf_counter() - begin_s
+  num_requests = http_pool.stats['requests'] - num_requests_before
+  num_mismatched = sum(1 for oids in trial_oid_sets if oids != expected_oids)
+  print(f'  {args.trials} trials in {duration_s:.2f} s ({args.trials / duration_s:.1f} trials/s, {num_requests / duration_s:.0f} requests/s over {num_requests} requests)')
+  print(f'  {num_mismatched} trials returned a different OID set than returnIdsOnly')
+
+  if server is not None:
+    server.shutdown()
+
+def importtime_by_package(stderr_txt):
+  # `-X importtime` lines look like "import time:  self [us] | cumulative | imported package", nested
+  # imports are indented; self times summed per top-level package add up to the total without double counting
+  self_us_by_package = dict()
+  for line in stderr_txt.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) < 3:
+      continue
+    package = fields[2].strip().split('.')[0]
+    self_us_by_package[package] = self_us_by_package.get(package, 0) + int(fields[0].strip())
+  return self_us_by_package
+
+def bench_startup(args):
+  import_cmd = [sys.executable, '-c', f'import {args.module}']
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] + [p for p in [env.get('PYTHONPATH', '')] if len(p) > 0])
+
+  wall_s = []
+  for _ in range(0, args.runs):
+    begin_s = time.perf_counter()
+    subprocess.run(import_cmd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wall_s.append(time.perf_counter() - begin_s)
+
+  profile = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {args.module}'], env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  self_us_by_package = importtime_by_package(profile.stderr.decode('utf-8', errors='replace'))
+  total_us = sum(self_us_by_package.values())
+
+  print(f'import {args.module}: median {statistics.median(wall_s)*1000.0:.0f} ms wall over {args.runs} runs (including interpreter startup), {total_us/1000.0:.0f} ms in imports')
+  for package, self_us in sorted(self_us_by_package.items(), key=lambda kv: -kv[1])[:args.top]:
+    print(f'  {package: <28} {self_us/1000.0:8.1f} ms  {100.0*self_us/max(total_us, 1):5.1f}%')
+  for heavy in ['arcgis', 'pyproj']:
+    print(f'  {heavy} imported at startup: {"Yes" if heavy in self_us_by_package else "No"}')
+
+def case_key(r):
+  return (r.get('strategy'), r.get('page_size'), r.get('dataset_size'))
+
+def bench_compare(args):
+  with open(args.old, 'r') as fd:
+    old = {case_key(r): r for r in json.load(fd)['cases']}
+  with open(args.new, 'r') as fd:
+    new = {case_key(r): r for r in json.load(fd)['cases']}
+  metrics = ['latency_p50_s', 'latency_p95_s', 'latency_p99_s', 'features_per_s', 'bytes_transferred', 'peak_rss_kb']
+  for key in sorted(new.keys(), key=str):
+    if not key in old:
+      continue
+    changes = []
+    for m in metrics:
+      o, n = old[key].get(m, None), new[key].get(m, None)
+      if o is None or n is None or o == 0:
+        continue
+      changes.append(f'{m}={100.0*(n-o)/o:+.1f}%')
+    print(f'  strategy={key[0]: <22} page_size={key[1]: <5} dataset_size={key[2]}: {" ".join(changes)}')
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmarks for the esri query harness')
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  keepalive_parser = subparsers.add_parser('keepalive', help='per-page latency with and without http_pool connection re-use')
+  keepalive_parser.add_argument('query_url', nargs='?', default=default_query_url)
+  keepalive_parser.add_argument('--pages', type=int, default=20)
+  keepalive_parser.add_argument('--page-size', type=int, default=10)
+  keepalive_parser.set_defaults(fn=bench_keepalive)
+
+  strategies_parser = subparsers.add_parser('strategies', help='latency / throughput / bytes / RSS of each paging strategy')
+  strategies_parser.add_argument('--url', default=None, help='remote query URL; when unset a local arcgis_emulator is started per dataset size')
+  strategies_parser.add_argument('--dataset-sizes', default='10000,100000')
+  strategies_parser.add_argument('--page-sizes', default='5,50,500')
+  strategies_parser.add_argument('--strategies', default='pages,keyset,double_query,double_query_batched', help=f'comma separated from {",".join(strategy_names)}')
+  strategies_parser.add_argument('--coverage', type=float, default=0.001, help='fraction of the layer extent the query polygon covers')
+  strategies_parser.add_argument('--instability', default='none', help='emulator instability mode')
+  strategies_parser.add_argument('--seed', type=int, default=0)
+  strategies_parser.add_argument('--out', default='bench_results.json')
+  strategies_parser.set_defaults(fn=bench_strategies)
+
+  formats_parser = subparsers.add_parser('formats', help='bytes and decode time per page for f=pjson / json / pbf')
+  formats_parser.add_argument('--url', default=None, help='remote query URL; when unset a local arcgis_emulator is started')
+  formats_parser.add_argument('--dataset-size', type=int, default=100000)
+  formats_parser.add_argument('--page-size', type=int, default=500)
+  formats_parser.add_argument('--pages', type=int, default=10)
+  formats_parser.add_argument('--seed', type=int, default=0)
+  formats_parser.set_defaults(fn=bench_formats)
+
+  payloads_parser = subparsers.add_parser('payloads', help='bytes and time per page for the full / fields / oid payload profiles')
+  payloads_parser.add_argument('--url', default=None, help='remote query URL; when unset a local arcgis_emulator is started')
+  payloads_parser.add_argument('--dataset-size', type=int, default=100000)
+  payloads_parser.add_argument('--page-size', type=int, default=500)
+  payloads_parser.add_argument('--pages', type=int, default=10)
+  payloads_parser.add_argument('--fields', default='NAME', help='comma-separated fields for the fields profile')
+  payloads_parser.add_argument('--quantize-tolerance', type=float, default=None, help='also run the full profile with geometry quantized to this many degrees')
+  payloads_parser.add_argument('--seed', type=int, default=0)
+  payloads_parser.set_defaults(fn=bench_payloads)
+
+  arcgis_parser = subparsers.add_parser('arcgis', help='per-page overhead of the arcgis FeatureLayer path, with and without the layer pool')
+  arcgis_parser.add_argument('--url', default=None, help='remote query URL; when unset a local arcgis_emulator is started')
+  arcgis_parser.add_argument('--dataset-size', type=int, default=100000)
+  arcgis_parser.add_argument('--page-size', type=int, default=50)
+  arcgis_parser.add_argument('--pages', type=int, default=20)
+  arcgis_parser.add_argument('--seed', type=int, default=0)
+  arcgis_parser.set_defaults(fn=bench_arcgis)
+
+  trials_parser = subparsers.add_parser('trials', help='many concurrent paging trials as asyncio tasks on one FeatureServiceClient')
+  trials_parser.add_argument('--url', default=None, help='remote query URL; when unset a local arcgis_emulator is started')
+  trials_parser.add_argument('--dataset-size', type=int, default=100000)
+  trials_parser.add_argument('--coverage', type=float, default=0.0005, help='fraction of the layer extent covered by the trial polygon')
+  trials_parser.add_argument('--trials', type=int, default=200)
+  trials_parser.add_argument('--page-size', type=int, default=10)
+  trials_parser.add_argument('--seed', type=int, default=0)
+  trials_parser.set_defaults(fn=bench_trials)
+
+  startup_parser = subparsers.add_parser('startup', help='import time of the harness and where it goes')
+  startup_parser.add_argument('--module', default='test_order_stability')
+  startup_parser.add_argument('--runs', type=int, default=5)
+  startup_parser.add_argument('--top', type=int, default=15)
+  startup_parser.set_defaults(fn=bench_startup)
+
+  compare_parser = subparsers.add_parser('compare', help='compare two strategies result files')
+  compare_parser.add_argument('old')
+  compare_parser.add_argument('new')
+  compare_parser.set_defaults(fn=bench_compare)
+
+  run_case_parser = subparsers.add_parser('run-case') # internal, one strategies case in a child process
+  run_case_parser.add_argument('--query-url', required=True)
+  run_case_parser.add_argument('--polygon-wkt', required=True)
+  run_case_parser.add_argument('--strategy', required=True, choices=strategy_names)
+  run_case_parser.add_argument('--page-size', type=int, required=True)
+  run_case_parser.add_argument('--result-file', required=True)
+  run_case_parser.set_defaults(fn=run_case)
+
+  args = parser.parse_args(argv)
+  args.fn(args)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
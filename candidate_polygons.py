@@ -0,0 +1,113 @@
+# Batch generation and screening of candidate test polygons.
+#
+# Candidates are built thousands at a time as shapely 2 geometry arrays from NumPy coordinate
+# arrays, then screened with vectorized checks: valid, non-empty, mostly inside the layer extent
+# and with a geodesic area in range (one shared backends.geodesic() instance for the whole batch).
+# Test geometry is only ever taken from screened candidates, so no count or page request is spent
+# on a self-intersecting, degenerate or off-layer polygon.
+#
+#   random_polygons(extent, n)         like test_order_stability.gen_rand_points: n polygons with vertices
+#                                      scattered around random centers (may self-intersect, screened out)
+#   star_polygons(centers, radii)      like the old geometry_selection.polygon_around: vertices at random
+#                                      angles around each center (always valid)
+#   screen(polygons, extent)           (mask of candidates passing every check, geodesic areas in km^2)
+#   CandidatePool(extent)              pool.next() -> (polygon, area_km2), refilled a batch at a time
+#
+# NumPy random generators are seeded from the `random` module, so RANDOM_SEED still makes runs repeat.
+#
+# Tunables (env vars):
+#   CANDIDATE_BATCH_SIZE            candidates generated per batch (default 4096)
+#   CANDIDATE_MIN_EXTENT_FRACTION   fraction of a candidate's area that must lie inside the layer extent (default 0.5)
+#   CANDIDATE_MIN_AREA_KM2          smallest geodesic area accepted (default 0, only degenerate polygons are dropped)
+#   CANDIDATE_MAX_AREA_KM2          largest geodesic area accepted (default unlimited)
+
+import os
+import random
+
+import numpy
+import shapely
+
+import backends
+
+batch_size = int(os.environ.get('CANDIDATE_BATCH_SIZE', '4096'))
+min_extent_fraction = float(os.environ.get('CANDIDATE_MIN_EXTENT_FRACTION', '0.5'))
+min_area_km2 = float(os.environ.get('CANDIDATE_MIN_AREA_KM2', '0'))
+max_area_km2 = float(os.environ['CANDIDATE_MAX_AREA_KM2']) if len(os.environ.get('CANDIDATE_MAX_AREA_KM2', '')) > 0 else None
+
+def rng_from_random():
+  return numpy.random.default_rng(random.getrandbits(64))
+
+def closed_polygons(coords):
+  # coords: (n, num_points, 2) array of open rings -> shapely array of n polygons
+  return shapely.polygons(numpy.concatenate([coords, coords[:, :1, :]], axis=1))
+
+def random_polygons(extent, n, num_points=3, radius=None, rng=None):
+  rng = rng if rng is not None else rng_from_random()
+  if radius is None:
+    radius = abs(extent['xmax'] - extent['xmin']) / 4.0
+  centers = numpy.stack([
+    rng.uniform(extent['xmin'], extent['xmax'], n),
+    rng.uniform(extent['ymin'], extent['ymax'], n),
+  ], axis=-1)
+  offsets = rng.uniform(-radius, radius, (n, num_points, 2))
+  return closed_polygons(centers[:, None, :] + offsets)
+
+def star_polygons(centers, radii, num_points=3, rng=None):
+  # Vertices at sorted random angles, each at 0.8-1.2x the radius, so every polygon is star-shaped around its center
+  rng = rng if rng is not None else rng_from_random()
+  centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 2)
+  radii = numpy.broadcast_to(numpy.asarray(radii, dtype=numpy.float64), (len(centers),))
+  n = len(centers)
+  angles = numpy.sort(rng.uniform(0, 2.0 * numpy.pi, (n, num_points)), axis=1)
+  r = radii[:, None] * rng.uniform(0.8, 1.2, (n, num_points))
+  coords = numpy.stack([
+    centers[:, 0:1] + r * numpy.cos(angles),
+    centers[:, 1:2] + r * numpy.sin(angles),
+  ], axis=-1)
+  return closed_polygons(coords)
+
+def extent_box(extent):
+  return shapely.box(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+
+def screen(polygons, extent, extent_fraction=None, area_min_km2=None, area_max_km2=None):
+  # Returns (mask, areas_km2); areas are only computed for candidates passing the cheap checks (NaN elsewhere)
+  extent_fraction = extent_fraction if extent_fraction is not None else min_extent_fraction
+  area_min_km2 = area_min_km2 if area_min_km2 is not None else min_area_km2
+  area_max_km2 = area_max_km2 if area_max_km2 is not None else max_area_km2
+  polygons = numpy.asarray(polygons)
+  planar_areas = shapely.area(polygons)
+  mask = shapely.is_valid(polygons) & ~shapely.is_empty(polygons) & (planar_areas > 0)
+  inside_areas = shapely.area(shapely.intersection(polygons[mask], extent_box(extent)))
+  mask[mask] = inside_areas >= extent_fraction * planar_areas[mask]
+  areas_km2 = numpy.full(len(polygons), numpy.nan)
+  areas_km2[mask] = backends.geodesic().areas_m2(polygons[mask]) / 1e6
+  mask[mask] = (areas_km2[mask] > area_min_km2) & (areas_km2[mask] <= (area_max_km2 if area_max_km2 is not None else numpy.inf))
+  return mask, areas_km2
+
+class CandidatePool:
+  # Screened random_polygons() for one extent, handed out one at a time
+  def __init__(self, extent, num_points=3, radius=None, size=None, rng=None):
+    self.extent = extent
+    self.num_points = num_points
+    self.radius = radius
+    self.size = size if size is not None else batch_size
+    self.rng = rng if rng is not None else rng_from_random()
+    self.stats = {'generated': 0, 'accepted': 0}
+    self._polygons = []
+    self._areas_km2 = []
+
+  def refill(self):
+    polygons = random_polygons(self.extent, self.size, num_points=self.num_points, radius=self.radius, rng=self.rng)
+    mask, areas_km2 = screen(polygons, self.extent)
+    self.stats['generated'] += len(polygons)
+    self.stats['accepted'] += int(mask.sum())
+    # Reversed so next() can pop from the end and still hand them out in generation order
+    self._polygons = list(polygons[mask][::-1])
+    self._areas_km2 = list(areas_km2[mask][::-1])
+
+  def next(self):
+    for _ in range(0, 8):
+      if len(self._polygons) > 0:
+        return self._polygons.pop(), float(self._areas_km2.pop())
+      self.refill()
+    raise Exception(f'No candidate polygon passed screening in 8 batches of {self.size} for extent {self.extent}')
@@ -0,0 +1,107 @@
+# HTTP content codings for http_pool: which encodings to ask for, incremental decoders for
+# gzip / deflate / br response bodies, and optional gzip of large POST bodies.
+#
+# Responses are decoded as they are read, so streaming readers (stream_json.py) still see
+# the JSON arrive incrementally. Brotli is only offered when the brotli (or brotlicffi)
+# package is installed.
+#
+# Request bodies are only compressed when HTTP_COMPRESS_REQUESTS_OVER is set. ArcGIS Server
+# behind IIS usually needs dynamic request decompression enabled for this, so a host that
+# answers a compressed request with HTTP 400 / 415 or an ArcGIS error payload is remembered
+# and sent plain bodies from then on.
+#
+# Tunables (env vars):
+#   HTTP_ACCEPT_ENCODING          Accept-Encoding sent with every request (default "gzip, deflate" plus
+#                                 ", br" when brotli is installed; "identity" turns compression off)
+#   HTTP_COMPRESS_REQUESTS_OVER   gzip POST bodies larger than this many bytes (default 0 = never)
+
+import os
+import gzip
+import zlib
+import threading
+
+try:
+  import brotli
+except ImportError:
+  try:
+    import brotlicffi as brotli
+  except ImportError:
+    brotli = None
+
+accept_encoding = os.environ.get('HTTP_ACCEPT_ENCODING', '') or ('gzip, deflate, br' if brotli is not None else 'gzip, deflate')
+compress_requests_over = int(os.environ.get('HTTP_COMPRESS_REQUESTS_OVER', '0') or 0)
+
+_plain_request_hosts = set() # netlocs that rejected a compressed request body
+_plain_request_hosts_lock = threading.Lock()
+
+class ZlibDecoder:
+  def __init__(self, wbits):
+    self._d = zlib.decompressobj(wbits)
+
+  def decompress(self, chunk):
+    return self._d.decompress(chunk)
+
+  def flush(self):
+    return self._d.flush()
+
+class DeflateDecoder:
+  # "deflate" is meant to be zlib-wrapped, but some servers send a raw deflate stream; tell them apart on the first chunk
+  def __init__(self):
+    self._d = None
+    self._head = b''
+
+  def decompress(self, chunk):
+    if self._d is None:
+      self._head += chunk
+      if len(self._head) < 2:
+        return b''
+      self._d = zlib.decompressobj(zlib.MAX_WBITS)
+      try:
+        return self._d.decompress(self._head)
+      except zlib.error:
+        self._d = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._d.decompress(self._head)
+    return self._d.decompress(chunk)
+
+  def flush(self):
+    if self._d is None:
+      return b''
+    return self._d.flush()
+
+class BrotliDecoder:
+  def __init__(self):
+    self._d = brotli.Decompressor()
+
+  def decompress(self, chunk):
+    if hasattr(self._d, 'process'):
+      return self._d.process(chunk)
+    return self._d.decompress(chunk)
+
+  def flush(self):
+    return b''
+
+def decoder_for(content_encoding):
+  # Incremental decoder for a Content-Encoding header value, or None when the body is not encoded
+  content_encoding = (content_encoding or '').strip().lower()
+  if content_encoding in ('', 'identity'):
+    return None
+  if content_encoding in ('gzip', 'x-gzip'):
+    return ZlibDecoder(16 + zlib.MAX_WBITS)
+  if content_encoding == 'deflate':
+    return DeflateDecoder()
+  if content_encoding == 'br' and brotli is not None:
+    return BrotliDecoder()
+  raise Exception(f'Unsupported Content-Encoding {content_encoding}')
+
+def should_compress_request(netloc, data):
+  if compress_requests_over < 1 or data is None or len(data) <= compress_requests_over:
+    return False
+  with _plain_request_hosts_lock:
+    return not netloc in _plain_request_hosts
+
+def compress_request(data):
+  return gzip.compress(data, compresslevel=6)
+
+def reject_compressed_requests(netloc):
+  with _plain_request_hosts_lock:
+    _plain_request_hosts.add(netloc)
@@ -0,0 +1,330 @@
+# Decoder (and a small encoder, used by arcgis_emulator.py) for ArcGIS f=pbf query responses.
+#
+# The format is esriPBuffer.FeatureCollectionPBuffer from Esri's FeatureCollection.proto.
+# Only the parts the harness reads are handled: feature results (OID field name, fields,
+# attributes, quantized geometry, exceededTransferLimit), count results and objectIds results.
+# decode() returns the same dict shape as the f=json response so read_oid() and friends do
+# not care which format was used. Pure stdlib, no protobuf package needed.
+
+import struct
+
+# FeatureCollectionPBuffer.GeometryType
+geometry_types = {
+  0: 'esriGeometryPoint',
+  1: 'esriGeometryMultipoint',
+  2: 'esriGeometryPolyline',
+  3: 'esriGeometryPolygon',
+  4: 'esriGeometryMultipatch',
+  127: 'esriGeometryNone',
+}
+
+# FeatureCollectionPBuffer.FieldType
+field_types = {
+  0: 'esriFieldTypeSmallInteger',
+  1: 'esriFieldTypeInteger',
+  2: 'esriFieldTypeSingle',
+  3: 'esriFieldTypeDouble',
+  4: 'esriFieldTypeString',
+  5: 'esriFieldTypeDate',
+  6: 'esriFieldTypeOID',
+  7: 'esriFieldTypeGeometry',
+  8: 'esriFieldTypeBlob',
+  9: 'esriFieldTypeRaster',
+  10: 'esriFieldTypeGUID',
+  11: 'esriFieldTypeGlobalID',
+  12: 'esriFieldTypeXML',
+}
+
+quantize_origin_upper_left = 0
+quantize_origin_lower_left = 1
+
+# Wire format
+
+def _read_varint(buf, pos):
+  b = buf[pos]
+  if b < 0x80:
+    return b, pos + 1
+  result = 0
+  shift = 0
+  while True:
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+def _zigzag_decode(n):
+  return (n >> 1) ^ -(n & 1)
+
+def _iter_fields(buf):
+  # Yields (field_number, wire_type, value) where value is an int for varints and
+  # bytes for fixed-width and length-delimited fields
+  pos = 0
+  end = len(buf)
+  while pos < end:
+    tag = buf[pos]
+    if tag < 0x80:
+      pos += 1
+    else:
+      tag, pos = _read_varint(buf, pos)
+    field_num, wire_type = tag >> 3, tag & 0x07
+    if wire_type == 0:
+      value, pos = _read_varint(buf, pos)
+    elif wire_type == 1:
+      value = buf[pos:pos+8]
+      pos += 8
+    elif wire_type == 2:
+      length, pos = _read_varint(buf, pos)
+      value = buf[pos:pos+length]
+      pos += length
+    elif wire_type == 5:
+      value = buf[pos:pos+4]
+      pos += 4
+    else:
+      raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+    yield field_num, wire_type, value
+
+def _packed_varints(value, wire_type):
+  # Repeated scalars may arrive packed (one length-delimited blob) or one per tag
+  if wire_type == 0:
+    return [value]
+  out = []
+  pos = 0
+  while pos < len(value):
+    v, pos = _read_varint(value, pos)
+    out.append(v)
+  return out
+
+def _string(value):
+  return value.decode('utf-8')
+
+# Messages
+
+def _decode_value(buf):
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      return _string(value)
+    if field_num == 2:
+      return struct.unpack('<f', value)[0]
+    if field_num == 3:
+      return struct.unpack('<d', value)[0]
+    if field_num in (4, 8):
+      return _zigzag_decode(value)
+    if field_num in (5, 7):
+      return value
+    if field_num == 6:
+      return value - (1 << 64) if value >= (1 << 63) else value
+    if field_num == 9:
+      return bool(value)
+  return None
+
+def _decode_field(buf):
+  field = dict()
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      field['name'] = _string(value)
+    elif field_num == 2:
+      field['type'] = field_types.get(value, f'esriFieldType{value}')
+    elif field_num == 3:
+      field['alias'] = _string(value)
+  return field
+
+def _decode_doubles(buf):
+  out = dict()
+  for field_num, wire_type, value in _iter_fields(buf):
+    out[field_num] = struct.unpack('<d', value)[0]
+  return out
+
+def _decode_transform(buf):
+  transform = {'origin': quantize_origin_upper_left, 'scale': (1.0, 1.0), 'translate': (0.0, 0.0)}
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      transform['origin'] = value
+    elif field_num == 2:
+      scale = _decode_doubles(value)
+      transform['scale'] = (scale.get(1, 1.0), scale.get(2, 1.0))
+    elif field_num == 3:
+      translate = _decode_doubles(value)
+      transform['translate'] = (translate.get(1, 0.0), translate.get(2, 0.0))
+  return transform
+
+def _decode_geometry(buf, geometry_type, transform, num_dims):
+  lengths = []
+  coords = []
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 2:
+      lengths.extend(_packed_varints(value, wire_type))
+    elif field_num == 3:
+      coords.extend(_zigzag_decode(v) for v in _packed_varints(value, wire_type))
+
+  # Coordinates are delta encoded across the whole geometry, then quantized by the transform
+  scale_x, scale_y = transform['scale'] if transform is not None else (1.0, 1.0)
+  translate_x, translate_y = transform['translate'] if transform is not None else (0.0, 0.0)
+  y_sign = -1.0 if transform is not None and transform['origin'] == quantize_origin_upper_left else 1.0
+  points = []
+  qx, qy = 0, 0
+  for i in range(0, len(coords) - num_dims + 1, num_dims):
+    qx += coords[i]
+    qy += coords[i + 1]
+    points.append([translate_x + qx * scale_x, translate_y + y_sign * qy * scale_y])
+
+  if geometry_type == 'esriGeometryPoint':
+    if len(points) < 1:
+      return None
+    return {'x': points[0][0], 'y': points[0][1]}
+  if geometry_type == 'esriGeometryMultipoint':
+    return {'points': points}
+  parts = []
+  begin = 0
+  for length in (lengths or [len(points)]):
+    parts.append(points[begin:begin + length])
+    begin += length
+  if geometry_type == 'esriGeometryPolyline':
+    return {'paths': parts}
+  return {'rings': parts}
+
+def _decode_feature(buf, field_names, geometry_type, transform, num_dims):
+  attributes = dict()
+  feature = {'attributes': attributes}
+  attr_i = 0
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      if attr_i < len(field_names):
+        attributes[field_names[attr_i]] = _decode_value(value)
+      attr_i += 1
+    elif field_num == 2:
+      feature['geometry'] = _decode_geometry(value, geometry_type, transform, num_dims)
+  return feature
+
+def _decode_feature_result(buf):
+  result = {'fields': [], 'features': []}
+  geometry_type = 'esriGeometryPoint'
+  transform = None
+  has_z = False
+  has_m = False
+  feature_bufs = []
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      result['objectIdFieldName'] = _string(value)
+    elif field_num == 7:
+      geometry_type = geometry_types.get(value, geometry_type)
+    elif field_num == 9:
+      result['exceededTransferLimit'] = bool(value)
+    elif field_num == 10:
+      has_z = bool(value)
+    elif field_num == 11:
+      has_m = bool(value)
+    elif field_num == 12:
+      transform = _decode_transform(value)
+    elif field_num == 13:
+      result['fields'].append(_decode_field(value))
+    elif field_num == 15:
+      feature_bufs.append(value) # Decoded once fields + transform are known
+  result['geometryType'] = geometry_type
+  field_names = [ f.get('name', '') for f in result['fields'] ]
+  num_dims = 2 + int(has_z) + int(has_m)
+  result['features'] = [ _decode_feature(f, field_names, geometry_type, transform, num_dims) for f in feature_bufs ]
+  return result
+
+def _decode_ids_result(buf):
+  result = {'objectIds': []}
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      result['objectIdFieldName'] = _string(value)
+    elif field_num == 3:
+      result['objectIds'].extend(_packed_varints(value, wire_type))
+  return result
+
+def _decode_count_result(buf):
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 1:
+      return {'count': value}
+  return {'count': 0}
+
+def decode(pbf_bytes):
+  # FeatureCollectionPBuffer bytes -> the dict the equivalent f=json query would have returned
+  buf = bytes(pbf_bytes)
+  for field_num, wire_type, value in _iter_fields(buf):
+    if field_num == 2: # queryResult
+      for result_num, result_wire_type, result_value in _iter_fields(value):
+        if result_num == 1:
+          return _decode_feature_result(result_value)
+        if result_num == 2:
+          return _decode_count_result(result_value)
+        if result_num == 3:
+          return _decode_ids_result(result_value)
+  return dict()
+
+# Encoding, only what the emulator needs: point features, counts and objectIds
+
+def _varint(n):
+  out = bytearray()
+  while True:
+    b = n & 0x7f
+    n >>= 7
+    if n:
+      out.append(b | 0x80)
+    else:
+      out.append(b)
+      return bytes(out)
+
+def _zigzag_encode(n):
+  return (n << 1) ^ (n >> 63)
+
+def _tag(field_num, wire_type):
+  return _varint((field_num << 3) | wire_type)
+
+def _len_field(field_num, payload):
+  return _tag(field_num, 2) + _varint(len(payload)) + payload
+
+def _varint_field(field_num, n):
+  return _tag(field_num, 0) + _varint(n)
+
+def _double_field(field_num, d):
+  return _tag(field_num, 1) + struct.pack('<d', d)
+
+def _encode_value(v):
+  if isinstance(v, bool):
+    return _varint_field(9, int(v))
+  if isinstance(v, int):
+    return _varint_field(8, _zigzag_encode(v))
+  if isinstance(v, float):
+    return _double_field(3, v)
+  return _len_field(1, str(v).encode('utf-8'))
+
+def _wrap(query_result):
+  return _len_field(1, b'3.0.0') + _len_field(2, query_result)
+
+def encode_count(count):
+  return _wrap(_len_field(2, _varint_field(1, count)))
+
+def encode_ids(oid_field_name, oids):
+  packed = b''.join(_varint(o) for o in oids)
+  return _wrap(_len_field(3, _len_field(1, oid_field_name.encode('utf-8')) + _len_field(3, packed)))
+
+def encode_points(oid_field_name, fields, features, translate, scale, exceeded_transfer_limit=False):
+  # fields: [{'name', 'type'}], features: [{'attributes': {...}, 'geometry': {'x', 'y'} or absent}]
+  field_type_nums = {v: k for k, v in field_types.items()}
+  body = bytearray()
+  body += _len_field(1, oid_field_name.encode('utf-8'))
+  body += _varint_field(7, 0) # esriGeometryTypePoint
+  if exceeded_transfer_limit:
+    body += _varint_field(9, 1)
+  body += _len_field(12,
+    _varint_field(1, quantize_origin_lower_left) +
+    _len_field(2, _double_field(1, scale[0]) + _double_field(2, scale[1])) +
+    _len_field(3, _double_field(1, translate[0]) + _double_field(2, translate[1]))
+  )
+  for f in fields:
+    body += _len_field(13, _len_field(1, f['name'].encode('utf-8')) + _varint_field(2, field_type_nums.get(f['type'], 4)))
+  for feature in features:
+    feature_buf = bytearray()
+    for f in fields:
+      feature_buf += _len_field(1, _encode_value(feature['attributes'].get(f['name'], '')))
+    if feature.get('geometry', None) is not None:
+      qx = int(round((feature['geometry']['x'] - translate[0]) / scale[0]))
+      qy = int(round((feature['geometry']['y'] - translate[1]) / scale[1]))
+      feature_buf += _len_field(2, _len_field(3, _varint(_zigzag_encode(qx)) + _varint(_zigzag_encode(qy))))
+    body += _len_field(15, bytes(feature_buf))
+  return _wrap(_len_field(1, bytes(body)))
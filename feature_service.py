@@ -0,0 +1,406 @@
+# Per-layer query client.
+#
+# A FeatureServiceClient holds everything the query functions used to keep in module globals
+# (OID field name, extent, maxRecordCount, query format, pooled arcgis FeatureLayers, the last
+# page's JSON) for one layer, so any number of layers and trials can be queried from threads or
+# asyncio tasks in one process. Methods only touch the client's own state under its lock or in
+# thread-local storage; HTTP goes through http_pool, which is thread-safe and caps in-flight
+# requests per host (HTTP_MAX_INFLIGHT, see request_scheduler.py).
+#
+#   client = feature_service.client_for(query_url)   # one shared client per layer URL
+#   oids = client.query_feature_page(polygon, resultOffset=0, resultRecordCount=10)
+#   oids = await client.aquery_feature_page(polygon, resultOffset=0, resultRecordCount=10)
+#
+# The a* methods run the blocking method in asyncio's default thread pool.
+#
+# Tunables (env vars):
+#   QUERY_FORMAT                 auto (default) = f=pbf when the layer advertises PBF, else compact f=json; or pbf / json / pjson
+#   STREAM_JSON                  decode JSON query responses incrementally (stream_json.py), keeping only OIDs
+#   DISABLE_ARCGIS_LAYER_POOL    build an arcgis FeatureLayer and geometry filter per page instead of re-using them
+#   PAGE_PAYLOAD (and friends)   what page requests ask for: full, oid or fields, see payload_profiles.py
+
+import os
+import json
+import asyncio
+import threading
+import traceback
+import collections
+import urllib.parse
+
+import http_pool
+import backends
+import layer_metadata
+import stream_json
+import esri_pbf
+import geometry_selection
+import request_timing
+import request_scheduler
+import payload_profiles
+
+possible_oid_names = [
+  'objectid', 'OBJECTID', 'ObjectID', 'oid', 'OID', 'rowid'
+]
+default_oid_field = 'objectid'
+default_extent = {'xmin': -120.0, 'xmax': -82.0, 'ymin': 32.0, 'ymax': 46.0}
+default_max_record_count = 1000
+
+query_format_setting = os.environ.get('QUERY_FORMAT', 'auto')
+use_streaming_json = len(os.environ.get('STREAM_JSON', '')) > 0
+
+# FeatureLayer instances and prebuilt geometry filters are reused across pages and trials instead of being
+# built (and the layer's metadata looked up again by the SDK) for every page. Layers are checked out so
+# concurrent harvests never share one instance. Filters do not depend on the layer and are shared by all clients.
+use_arcgis_layer_pool = len(os.environ.get('DISABLE_ARCGIS_LAYER_POOL', '')) < 1
+arcgis_filter_cache_size = 256
+_arcgis_filter_cache = collections.OrderedDict() # polygon key -> geometry filter dict, least recently used first
+_arcgis_filter_lock = threading.Lock()
+
+def read_oid(f, oid_names=None):
+  if oid_names is None:
+    oid_names = possible_oid_names
+  if not isinstance(f, dict) and hasattr(f, 'as_dict'): # arcgis.features.Feature, without importing arcgis to check
+    f = f.as_dict
+
+  if 'attributes' in f:
+    for possible_oid_name in oid_names:
+      if possible_oid_name in f['attributes']:
+        return f['attributes'][possible_oid_name]
+    raise Exception(f'No ObjectID found in f={f}')
+  else:
+    for possible_oid_name in oid_names:
+      if possible_oid_name in f:
+        return f[possible_oid_name]
+    raise Exception(f'No ObjectID found in f={f}')
+
+def read_oid_field(f, oid_names=None):
+  if oid_names is None:
+    oid_names = possible_oid_names
+  if 'attributes' in f:
+    for possible_oid_name in oid_names:
+      if possible_oid_name in f['attributes']:
+        return possible_oid_name
+    raise Exception(f'No ObjectID found in f={f}')
+  else:
+    for possible_oid_name in oid_names:
+      if possible_oid_name in f:
+        return possible_oid_name
+    raise Exception(f'No ObjectID found in f={f}')
+
+def polygon_coords(a_polygon):
+  if hasattr(a_polygon, 'exterior'):
+    return [pt for pt in a_polygon.exterior.coords]
+  return a_polygon
+
+def decode_query_response(resp_txt):
+  # Servers answer f=pbf requests with JSON when the query fails, so sniff the body
+  if resp_txt.lstrip()[:1] == b'{':
+    return json.loads(resp_txt)
+  return esri_pbf.decode(resp_txt)
+
+def print_error_json(resp_txt, data):
+  if not isinstance(resp_txt, str):
+    resp_txt = resp_txt.decode('utf-8', errors='replace')
+  if not isinstance(data, str):
+    data = data.decode('utf-8')
+  print(f'WARNING ERROR JSON:\n{resp_txt}\n^^ query data={data}\n')
+
+def arcgis_feature_layer_url(server_url):
+  fl_url = server_url
+  if fl_url.endswith('/query'):
+    fl_url = '/'.join(fl_url.split('/')[:-1])
+  return fl_url
+
+def arcgis_geometry_filter(a_polygon):
+  coords = polygon_coords(a_polygon)
+  key = a_polygon.wkb if hasattr(a_polygon, 'wkb') else json.dumps(coords)
+  if use_arcgis_layer_pool:
+    with _arcgis_filter_lock:
+      if key in _arcgis_filter_cache:
+        _arcgis_filter_cache.move_to_end(key)
+        return _arcgis_filter_cache[key]
+  arcgis = backends.arcgis()
+  json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [ coords ]}
+  arcgis_g = arcgis.geometry.Polygon(json_query_g)
+  geometry_filter = arcgis.geometry.filters.intersects(arcgis_g, sr=4326)
+  if use_arcgis_layer_pool:
+    with _arcgis_filter_lock:
+      _arcgis_filter_cache[key] = geometry_filter
+      while len(_arcgis_filter_cache) > arcgis_filter_cache_size:
+        _arcgis_filter_cache.popitem(last=False)
+  return geometry_filter
+
+class FeatureServiceClient:
+  def __init__(self, query_url, oid_field=None):
+    self.query_url = query_url
+    self.layer_url = layer_metadata.layer_url(query_url)
+    metadata = layer_metadata.get(query_url)
+    self.version = metadata['version'] if metadata['version'] is not None else -0.0
+    self.extent = metadata['extent'] if metadata['extent'] is not None else dict(default_extent)
+    self.max_record_count = metadata['max_record_count'] or default_max_record_count
+    self.supported_query_formats = metadata['supported_query_formats']
+    self.oid_field = oid_field or metadata['oid_field'] or default_oid_field
+    self.oid_names = ([self.oid_field] if not self.oid_field in possible_oid_names else []) + possible_oid_names
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._idle_arcgis_layers = [] # arcgis.features.FeatureLayer instances not in use by a query
+    self.payload_profile = payload_profiles.default_profile # What page requests ask for, methods take a payload= override
+
+  @property
+  def query_format(self):
+    if query_format_setting != 'auto':
+      return query_format_setting
+    if 'pbf' in self.supported_query_formats:
+      return 'pbf'
+    return 'json'
+
+  @property
+  def last_page_json(self):
+    # Response of the last page this thread fetched (top-level keys only when streamed), for reporting
+    return getattr(self._local, 'last_page_json', None)
+
+  def _set_oid_field(self, oid_field):
+    with self._lock:
+      if oid_field != self.oid_field:
+        self.oid_field = oid_field
+        if not oid_field in self.oid_names:
+          self.oid_names = [oid_field] + self.oid_names
+
+  def read_oid(self, f):
+    return read_oid(f, self.oid_names)
+
+  def payload_params(self, payload=None):
+    return (payload or self.payload_profile).query_params(self.oid_field)
+
+  def fetch_query(self, span_name, data, result_key='features'):
+    # POSTs a query and decodes the answer, returning (body, decoded JSON). The request_timing span is
+    # opened per attempt inside the retry, so backoff sleeps are not counted as request latency.
+    def fetch_once():
+      with request_timing.span(span_name, self.query_url) as timing:
+        resp_txt = http_pool.fetch_once(self.query_url, data=data)
+        resp_json = decode_query_response(resp_txt)
+        timing.parsed(len(resp_json.get(result_key, None) or []))
+      return resp_txt, resp_json
+    return request_scheduler.retry(self.query_url, fetch_once)
+
+  def query_feature_page(self, a_polygon, resultOffset=0, resultRecordCount=4, where=None, payload=None):
+    if a_polygon is None:
+      return []
+    json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [polygon_coords(a_polygon)]}
+    params = {
+        'geometry': json.dumps(json_query_g),
+        'geometryType': 'esriGeometryPolygon',
+        **self.payload_params(payload),
+        'orderByFields': f'{self.oid_field} DESC',
+        # 'returnDistinctValues': 'true', # Cannot use in a Geometry query -_-
+        'resultOffset': resultOffset,
+        'resultRecordCount': resultRecordCount,
+        'f': self.query_format,
+    }
+    if where is not None:
+      params['where'] = where
+    data = urllib.parse.urlencode(params).encode()
+    if use_streaming_json and self.query_format != 'pbf':
+      return self.query_feature_page_streaming(data)
+    resp_txt, resp_json = self.fetch_query('query_feature_page', data)
+    self._local.last_page_json = resp_json # Save off for any reporting we want to do
+    # We return a list of objectids
+    if not 'features' in resp_json:
+      print_error_json(resp_txt, data)
+      return []
+    return [ self.read_oid(f) for f in resp_json['features'] ]
+
+  def query_feature_page_streaming(self, data):
+    # OIDs are read out of each feature as the response arrives; only the OID list is kept, and
+    # last_page_json holds the top-level keys of the response without the features.
+    # Parsing overlaps the download here, so the download phase includes it
+    def stream_once():
+      resp_header = dict()
+      with request_timing.span('query_feature_page_streaming', self.query_url) as timing:
+        with http_pool.open_once(self.query_url, data=data) as resp:
+          page_oids = [ self.read_oid(f) for f in stream_json.iter_top_level_array(resp, 'features', resp_header) ]
+        timing.parsed(len(page_oids))
+      request_scheduler.raise_for_error(self.query_url, resp_header.get('error', None))
+      return resp_header, page_oids
+    resp_header, page_oids = request_scheduler.retry(self.query_url, stream_once)
+    self._local.last_page_json = resp_header
+    if not 'features' in resp_header:
+      print_error_json(json.dumps(resp_header, indent=2), data)
+      return []
+    return page_oids
+
+  def checkout_arcgis_layer(self):
+    if use_arcgis_layer_pool:
+      with self._lock:
+        if len(self._idle_arcgis_layers) > 0:
+          return self._idle_arcgis_layers.pop()
+    return backends.arcgis().features.FeatureLayer(arcgis_feature_layer_url(self.query_url))
+
+  def checkin_arcgis_layer(self, arcgis_fl):
+    if use_arcgis_layer_pool:
+      with self._lock:
+        self._idle_arcgis_layers.append(arcgis_fl)
+
+  def query_feature_page_arcgis(self, a_polygon, resultOffset=0, resultRecordCount=4, where=None, payload=None):
+    if a_polygon is None:
+      return []
+
+    geometry_filter = arcgis_geometry_filter(a_polygon)
+    arcgis_fl = self.checkout_arcgis_layer()
+
+    # arcgis does its own HTTP + parsing, so this span only has a total
+    with request_timing.span('query_feature_page_arcgis', self.query_url) as timing:
+      arcgis_result = arcgis_fl.query(
+        where=where if where is not None else '1=1',
+        geometry_filter=dict(geometry_filter), # query() may add to the dict it is given
+        **(payload or self.payload_profile).arcgis_query_kwargs(self.oid_field),
+        order_by_fields=f'{self.oid_field} DESC',
+        result_offset=resultOffset,
+        result_record_count=resultRecordCount,
+        return_all_records=False # Must be set so result_record_count is respected
+      )
+      timing.parsed(len(arcgis_result.features))
+    # Only layers that completed a query go back to the pool; one that raised may hold a broken session
+    self.checkin_arcgis_layer(arcgis_fl)
+    try:
+      page_oids = [ self.read_oid(f) for f in arcgis_result.features ]
+      #print(f'result_offset={resultOffset} result_record_count={resultRecordCount} - {page_oids}')
+      return page_oids
+    except:
+      traceback.print_exc()
+      return []
+
+  def query_all_feature_oids(self, a_polygon, where=None):
+    # a_polygon may be None when a where clause is given, e.g. '1=1' for every OID in the layer
+    if a_polygon is None and where is None:
+      return []
+    params = {
+        #'outFields': '*',
+        'returnGeometry': False,
+        'returnIdsOnly': True,
+        'orderByFields': f'{self.oid_field} DESC',
+        'f': self.query_format,
+    }
+    if a_polygon is not None:
+      params['geometry'] = json.dumps({'spatialReference': {'wkid': 4326}, 'rings': [polygon_coords(a_polygon)]})
+      params['geometryType'] = 'esriGeometryPolygon'
+    if where is not None:
+      params['where'] = where
+    data = urllib.parse.urlencode(params).encode()
+    if use_streaming_json and self.query_format != 'pbf':
+      def stream_once():
+        resp_json = dict()
+        with request_timing.span('query_all_feature_oids', self.query_url) as timing:
+          with http_pool.open_once(self.query_url, data=data) as resp:
+            oids = list(stream_json.iter_top_level_array(resp, 'objectIds', resp_json))
+          timing.parsed(len(oids))
+        request_scheduler.raise_for_error(self.query_url, resp_json.get('error', None))
+        return resp_json, oids
+      resp_json, oids = request_scheduler.retry(self.query_url, stream_once)
+      resp_txt = json.dumps(resp_json)
+      if 'objectIds' in resp_json:
+        resp_json['objectIds'] = oids
+    else:
+      resp_txt, resp_json = self.fetch_query('query_all_feature_oids', data, result_key='objectIds')
+    if not 'objectIds' in resp_json:
+      print_error_json(resp_txt, data)
+      return []
+
+    # Update if info available
+    self._set_oid_field(resp_json.get('objectIdFieldName', self.oid_field))
+
+    return resp_json['objectIds']
+
+  def query_features(self, a_polygon=None, where='1=1', resultOffset=None, resultRecordCount=None, orderByFields=None, outSR=4326):
+    # Whole features (attributes + geometry, ArcGIS JSON shape whatever the format) for an optional polygon and where
+    # clause; None (rather than []) when the server answered with an error, so callers can tell it from the last page
+    params = {
+        'where': where,
+        'outFields': '*',
+        'returnGeometry': True,
+        'outSR': outSR,
+        'f': self.query_format,
+    }
+    if a_polygon is not None:
+      params['geometry'] = json.dumps({'spatialReference': {'wkid': 4326}, 'rings': [polygon_coords(a_polygon)]})
+      params['geometryType'] = 'esriGeometryPolygon'
+    if orderByFields is not None:
+      params['orderByFields'] = orderByFields
+    if resultOffset is not None:
+      params['resultOffset'] = resultOffset
+    if resultRecordCount is not None:
+      params['resultRecordCount'] = resultRecordCount
+    data = urllib.parse.urlencode(params).encode()
+    resp_txt, resp_json = self.fetch_query('query_features', data)
+    self._local.last_page_json = resp_json # Save off for any reporting we want to do
+    if not 'features' in resp_json:
+      print_error_json(resp_txt, data)
+      return None
+    return resp_json['features']
+
+  def query_feature(self, feature_oid, payload=None):
+    data = urllib.parse.urlencode({
+        **self.payload_params(payload),
+        'where': f'{self.oid_field} = {feature_oid}',
+        'f': self.query_format,
+    }).encode()
+    resp_txt, resp_json = self.fetch_query('query_feature', data)
+    self._local.last_page_json = resp_json # Save off for any reporting we want to do
+    if not 'features' in resp_json:
+      print_error_json(resp_txt, data)
+      return []
+    if len(resp_json['features']) < 1:
+      return None
+    else:
+      return next(x for x in resp_json['features'])
+
+  def query_features_by_oids(self, feature_oids, payload=None):
+    if len(feature_oids) < 1:
+      return []
+    data = urllib.parse.urlencode({
+        'objectIds': ','.join(str(oid) for oid in feature_oids),
+        **self.payload_params(payload),
+        'f': self.query_format,
+    }).encode()
+    resp_txt, resp_json = self.fetch_query('query_features_by_oids', data)
+    self._local.last_page_json = resp_json # Save off for any reporting we want to do
+    if not 'features' in resp_json:
+      print_error_json(resp_txt, data)
+      return []
+    # Servers return objectIds= results in their own order, callers re-order by OID
+    return resp_json['features']
+
+  def query_feature_count(self, a_polygon=None, envelope=None, where='1=1'):
+    return geometry_selection.query_feature_count(self.query_url, a_polygon=a_polygon, envelope=envelope, where=where)
+
+  async def aquery_feature_page(self, a_polygon, resultOffset=0, resultRecordCount=4, where=None, payload=None):
+    return await asyncio.to_thread(self.query_feature_page, a_polygon, resultOffset=resultOffset, resultRecordCount=resultRecordCount, where=where, payload=payload)
+
+  async def aquery_feature_page_arcgis(self, a_polygon, resultOffset=0, resultRecordCount=4, where=None, payload=None):
+    return await asyncio.to_thread(self.query_feature_page_arcgis, a_polygon, resultOffset=resultOffset, resultRecordCount=resultRecordCount, where=where, payload=payload)
+
+  async def aquery_all_feature_oids(self, a_polygon, where=None):
+    return await asyncio.to_thread(self.query_all_feature_oids, a_polygon, where=where)
+
+  async def aquery_features(self, a_polygon=None, where='1=1', resultOffset=None, resultRecordCount=None, orderByFields=None, outSR=4326):
+    return await asyncio.to_thread(self.query_features, a_polygon, where=where, resultOffset=resultOffset, resultRecordCount=resultRecordCount, orderByFields=orderByFields, outSR=outSR)
+
+  async def aquery_feature(self, feature_oid, payload=None):
+    return await asyncio.to_thread(self.query_feature, feature_oid, payload=payload)
+
+  async def aquery_features_by_oids(self, feature_oids, payload=None):
+    return await asyncio.to_thread(self.query_features_by_oids, feature_oids, payload=payload)
+
+  async def aquery_feature_count(self, a_polygon=None, envelope=None, where='1=1'):
+    return await asyncio.to_thread(self.query_feature_count, a_polygon=a_polygon, envelope=envelope, where=where)
+
+_clients = dict() # query url -> FeatureServiceClient
+_clients_lock = threading.Lock()
+
+def client_for(query_url):
+  # The shared client for a layer; built outside the lock since it may fetch layer metadata
+  with _clients_lock:
+    if query_url in _clients:
+      return _clients[query_url]
+  client = FeatureServiceClient(query_url)
+  with _clients_lock:
+    return _clients.setdefault(query_url, client)
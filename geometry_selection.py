@@ -0,0 +1,138 @@
+# Picks test polygons that contain a target number of features using cheap requests.
+#
+# Instead of downloading up to 500 features per random triangle just to count them, candidate
+# polygons are checked with returnCountOnly=true queries, and candidates are sized from a
+# coarse per-layer density grid (grid_size x grid_size returnCountOnly counts over the layer
+# extent, cached with the layer metadata) so the first or second probe usually lands in range.
+# Candidates are generated and screened in one batch by candidate_polygons.py.
+#
+# Tunables (env vars):
+#   DENSITY_GRID_SIZE   cells per side of the density grid (default 8)
+
+import os
+import json
+import math
+import urllib.parse
+import concurrent.futures
+
+import numpy
+
+import http_pool
+import layer_metadata
+import candidate_polygons
+
+density_grid_size = int(os.environ.get('DENSITY_GRID_SIZE', '8'))
+
+def query_feature_count(server_url, a_polygon=None, envelope=None, where='1=1'):
+  # returnCountOnly for a polygon (shapely or list of coords) or an envelope dict; None when the server errors
+  params = {
+    'where': where,
+    'returnCountOnly': True,
+    'returnGeometry': False,
+    'spatialRel': 'esriSpatialRelIntersects',
+    'f': 'json',
+  }
+  if envelope is not None:
+    params['geometry'] = json.dumps(dict(envelope, spatialReference={'wkid': 4326}))
+    params['geometryType'] = 'esriGeometryEnvelope'
+  elif a_polygon is not None:
+    if hasattr(a_polygon, 'exterior'):
+      coords = [pt for pt in a_polygon.exterior.coords]
+    else:
+      coords = a_polygon
+    params['geometry'] = json.dumps({'spatialReference': {'wkid': 4326}, 'rings': [coords]})
+    params['geometryType'] = 'esriGeometryPolygon'
+  data = urllib.parse.urlencode(params).encode()
+  resp_txt = http_pool.fetch(server_url, data=data)
+  resp_json = json.loads(resp_txt)
+  if not 'count' in resp_json:
+    print(f'WARNING ERROR JSON:\n{resp_txt.decode("utf-8", errors="replace")}\n^^ query data={data.decode("utf-8")}\n')
+    return None
+  return int(resp_json['count'])
+
+def grid_cells(extent, grid_size):
+  cell_w = (extent['xmax'] - extent['xmin']) / grid_size
+  cell_h = (extent['ymax'] - extent['ymin']) / grid_size
+  cells = []
+  for row in range(0, grid_size):
+    for col in range(0, grid_size):
+      cells.append({
+        'xmin': extent['xmin'] + col * cell_w,
+        'xmax': extent['xmin'] + (col + 1) * cell_w,
+        'ymin': extent['ymin'] + row * cell_h,
+        'ymax': extent['ymin'] + (row + 1) * cell_h,
+      })
+  return cells
+
+def density_grid(server_url, extent, grid_size=None, max_workers=4):
+  # [{xmin, xmax, ymin, ymax, count}] for every cell; count is None where the server errored
+  if grid_size is None:
+    grid_size = density_grid_size
+  extent_key = ','.join(f'{extent[k]:.6f}' for k in ('xmin', 'ymin', 'xmax', 'ymax'))
+  def compute():
+    cells = grid_cells(extent, grid_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      counts = list(executor.map(lambda cell: query_feature_count(server_url, envelope=cell), cells))
+    for cell, count in zip(cells, counts):
+      cell['count'] = count
+    return cells
+  return layer_metadata.get_derived(server_url, f'density_grid:{grid_size}:{extent_key}', compute)
+
+def polygon_area_fraction(num_points):
+  # Area of a regular num_points-gon with circumradius 1; good enough to size the random ones
+  return 0.5 * num_points * math.sin(2.0 * math.pi / num_points)
+
+def select_test_polygon(server_url, extent, min_features=10, max_features=89, num_points=3, max_probes=40):
+  # Returns (polygon, feature_count, probes_used) with min_features <= feature_count <= max_features,
+  # or (None, None, probes_used) if no polygon was found within max_probes count queries.
+  # Only candidates that passed candidate_polygons.screen() are ever probed.
+  probes = 0
+  target = (min_features + max_features) / 2.0
+  cells = [ c for c in density_grid(server_url, extent) if c['count'] is not None and c['count'] >= min_features ]
+  if len(cells) < 1:
+    # No density information (or the layer is sparse everywhere), fall back to blind count probes in the extent
+    cells = [ dict(extent, count=None) ]
+
+  # One batch of candidates: cells with more features are proportionally more likely to be picked, like random
+  # points on features would be, and each candidate is sized so that at its cell's average density it holds about
+  # `target` features. A few per probe so screening losses do not run us out.
+  rng = candidate_polygons.rng_from_random()
+  num_candidates = max_probes * 4
+  cell_xmin, cell_xmax, cell_ymin, cell_ymax, cell_count = [ numpy.array([ c[k] or 0 for c in cells ], dtype=numpy.float64) for k in ('xmin', 'xmax', 'ymin', 'ymax', 'count') ]
+  weights = numpy.maximum(cell_count, 1.0)
+  picked = rng.choice(len(cells), size=num_candidates, p=weights / weights.sum())
+  cell_w = cell_xmax[picked] - cell_xmin[picked]
+  cell_h = cell_ymax[picked] - cell_ymin[picked]
+  centers = numpy.stack([ cell_xmin[picked] + rng.uniform(0, 1, num_candidates) * cell_w,
+                          cell_ymin[picked] + rng.uniform(0, 1, num_candidates) * cell_h ], axis=-1)
+  radii = numpy.maximum(cell_w, cell_h) / 4.0
+  known = cell_count[picked] > 0
+  density = cell_count[picked][known] / (cell_w[known] * cell_h[known])
+  radii[known] = numpy.sqrt(target / density / polygon_area_fraction(num_points))
+  candidates = candidate_polygons.star_polygons(centers, radii, num_points=num_points, rng=rng)
+  passed, _ = candidate_polygons.screen(candidates, extent)
+
+  for i in numpy.flatnonzero(passed):
+    if probes >= max_probes:
+      break
+    polygon = candidates[i]
+    radius = radii[i]
+    # Rescale around the same center a few times before giving up on it
+    for attempt in range(0, 4):
+      if probes >= max_probes:
+        break
+      count = query_feature_count(server_url, polygon)
+      probes += 1
+      if count is None:
+        break
+      if min_features <= count <= max_features:
+        return polygon, count, probes
+      # Feature count scales with area, i.e. with radius squared
+      radius *= math.sqrt(target / max(count, 0.5))
+      rescaled = candidate_polygons.star_polygons(centers[i:i+1], [radius], num_points=num_points, rng=rng)
+      rescaled_passed, _ = candidate_polygons.screen(rescaled, extent)
+      if not rescaled_passed[0]:
+        break
+      polygon = rescaled[0]
+
+  return None, None, probes
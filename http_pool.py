@@ -0,0 +1,387 @@
+# Per-host keep-alive HTTP connection pool.
+#
+# Every query function routes through fetch() instead of urllib.request.urlopen() so
+# consecutive pages against one server re-use an already-open TCP + TLS session instead
+# of paying a fresh handshake per page.
+#
+# Proxies are taken from the environment like urlopen() does (HTTP_PROXY / HTTPS_PROXY / NO_PROXY,
+# see urllib.request.getproxies): https is tunnelled with CONNECT, http requests are sent to the
+# proxy with an absolute URL. Redirects follow urllib too: 301 / 302 / 303 are re-sent as a GET
+# without the body, a POST answered with 307 / 308 raises HTTPError.
+#
+# Tunables (env vars):
+#   HTTP_POOL_SIZE            max idle connections kept open per host (default 4, 0 disables pooling)
+#   HTTP_POOL_IDLE_TIMEOUT_S  idle connections older than this are closed instead of re-used (default 30)
+#   HTTP_TIMEOUT_S            socket timeout for connect + reads (default 120)
+#   HTTP_REPLAY_DB / HTTP_REPLAY_MODE   record and replay responses, see replay_cache.py
+#   HTTP_ACCEPT_ENCODING, HTTP_COMPRESS_REQUESTS_OVER   gzip / deflate / br transfer compression, see content_coding.py
+#   HTTP_RATE_LIMIT_RPS, HTTP_MAX_INFLIGHT, HTTP_MAX_RETRIES, ...   see request_scheduler.py
+
+import os
+import sys
+import time
+import socket
+import base64
+import threading
+import http.client
+import urllib.parse
+import urllib.error
+import urllib.request
+
+import replay_cache
+import content_coding
+import request_timing
+import request_scheduler
+
+pool_size = int(os.environ.get('HTTP_POOL_SIZE', '4'))
+idle_timeout_s = float(os.environ.get('HTTP_POOL_IDLE_TIMEOUT_S', '30'))
+timeout_s = float(os.environ.get('HTTP_TIMEOUT_S', '120'))
+
+max_redirects = 5
+user_agent = f'Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}'
+
+# (scheme, netloc) -> list of (connection, last_used_s); most recently used at the end
+_idle_connections = dict()
+_idle_lock = threading.Lock()
+
+# Counters so benchmarks can show how often a handshake was avoided and what compression saved.
+# bytes_received is what came over the wire, bytes_decoded the response bodies after content decoding.
+stats = {
+  'connections_opened': 0,
+  'connections_reused': 0,
+  'requests': 0,
+  'bytes_received': 0,
+  'bytes_decoded': 0,
+  'request_bytes_sent': 0,
+  'requests_compressed': 0,
+  'replayed': 0,
+}
+_stats_lock = threading.Lock() # stats are updated from every thread using the pool
+
+def count_stat(key, amount=1):
+  with _stats_lock:
+    stats[key] += amount
+
+# Callables invoked as fn(url, latency_s, num_bytes) after every successful fetch(), used by benchmark.py
+response_listeners = []
+
+# replay_cache.ReplayStore consulted by open() before the network, set from HTTP_REPLAY_DB or by assigning it
+replay_store = None
+if len(os.environ.get('HTTP_REPLAY_DB', '')) > 0:
+  replay_store = replay_cache.ReplayStore(os.environ['HTTP_REPLAY_DB'], os.environ.get('HTTP_REPLAY_MODE', 'auto') or 'auto')
+
+def configure(size=None, idle_timeout=None):
+  global pool_size, idle_timeout_s
+  if size is not None:
+    pool_size = int(size)
+  if idle_timeout is not None:
+    idle_timeout_s = float(idle_timeout)
+  close_all()
+
+def close_all():
+  with _idle_lock:
+    all_conns = [c for conns in _idle_connections.values() for c, _ in conns]
+    _idle_connections.clear()
+  for conn in all_conns:
+    conn.close()
+
+def _timed_connect(conn):
+  # Same as HTTPConnection.connect(), with DNS and TCP connect timed separately (to the proxy when there
+  # is one). The timings are left on the connection for the request that triggered the connect.
+  begin_s = time.perf_counter()
+  addr_infos = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+  dns_done_s = time.perf_counter()
+  last_err = None
+  for family, sock_type, proto, _, sock_addr in addr_infos:
+    sock = socket.socket(family, sock_type, proto)
+    try:
+      if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        sock.settimeout(conn.timeout)
+      sock.connect(sock_addr)
+      break
+    except OSError as e:
+      sock.close()
+      sock = None
+      last_err = e
+  if sock is None:
+    raise last_err
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  conn.sock = sock
+  if conn._tunnel_host:
+    conn._tunnel() # CONNECT through the proxy, counted as connect time
+  conn.connect_timings = {'dns_s': dns_done_s - begin_s, 'connect_s': time.perf_counter() - dns_done_s}
+
+class TimedHTTPConnection(http.client.HTTPConnection):
+  def connect(self):
+    _timed_connect(self)
+
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+  def connect(self):
+    _timed_connect(self)
+    tls_begin_s = time.perf_counter()
+    self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+    self.connect_timings['tls_s'] = time.perf_counter() - tls_begin_s
+
+def proxy_for(scheme, netloc):
+  # (proxy netloc, Proxy-Authorization header value or None) from the environment, or None to connect directly
+  proxy_url = urllib.request.getproxies().get(scheme, None)
+  if not proxy_url or urllib.request.proxy_bypass(urllib.parse.urlsplit(f'//{netloc}').hostname or netloc):
+    return None
+  if not '://' in proxy_url:
+    proxy_url = f'http://{proxy_url}'
+  parsed = urllib.parse.urlsplit(proxy_url)
+  proxy_netloc = parsed.hostname + (f':{parsed.port}' if parsed.port else '')
+  auth = None
+  if parsed.username is not None:
+    user_pass = f'{urllib.parse.unquote(parsed.username)}:{urllib.parse.unquote(parsed.password or "")}'
+    auth = 'Basic ' + base64.b64encode(user_pass.encode('utf-8')).decode('ascii')
+  return proxy_netloc, auth
+
+def _new_connection(scheme, netloc):
+  count_stat('connections_opened')
+  proxy = proxy_for(scheme, netloc)
+  if scheme == 'https':
+    if proxy is None:
+      return TimedHTTPSConnection(netloc, timeout=timeout_s)
+    conn = TimedHTTPSConnection(proxy[0], timeout=timeout_s)
+    conn.set_tunnel(netloc, headers={'Proxy-Authorization': proxy[1]} if proxy[1] is not None else None)
+    return conn
+  return TimedHTTPConnection(proxy[0] if proxy is not None else netloc, timeout=timeout_s)
+
+def _checkout(scheme, netloc):
+  # Returns (connection, was_reused)
+  now_s = time.monotonic()
+  stale = []
+  conn = None
+  with _idle_lock:
+    conns = _idle_connections.get((scheme, netloc), [])
+    while len(conns) > 0:
+      candidate, last_used_s = conns.pop()
+      if now_s - last_used_s > idle_timeout_s:
+        stale.append(candidate)
+      else:
+        conn = candidate
+        break
+  for s in stale:
+    s.close()
+  if conn is not None:
+    count_stat('connections_reused')
+    return conn, True
+  return _new_connection(scheme, netloc), False
+
+def _checkin(scheme, netloc, conn):
+  if pool_size < 1:
+    conn.close()
+    return
+  with _idle_lock:
+    conns = _idle_connections.setdefault((scheme, netloc), [])
+    conns.append((conn, time.monotonic()))
+    evicted = conns[:-pool_size]
+    del conns[:-pool_size]
+  for e, _ in evicted:
+    e.close()
+
+def _request_once(scheme, netloc, path, data, headers):
+  # Sends the request and returns (connection, response, timings) with the body still unread
+  method = 'GET' if data is None else 'POST'
+  conn, was_reused = _checkout(scheme, netloc)
+  begin_s = time.perf_counter()
+  try:
+    conn.request(method, path, body=data, headers=headers)
+    resp = conn.getresponse()
+  except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+    conn.close()
+    if not was_reused:
+      raise
+    # The server closed an idle keep-alive connection under us, retry once on a fresh one
+    conn = _new_connection(scheme, netloc)
+    try:
+      conn.request(method, path, body=data, headers=headers)
+      resp = conn.getresponse()
+    except:
+      conn.close()
+      raise
+  except:
+    conn.close()
+    raise
+  # Whatever was not spent opening the connection is time to first byte
+  timings = getattr(conn, 'connect_timings', None) or dict()
+  conn.connect_timings = None
+  timings['ttfb_s'] = time.perf_counter() - begin_s - sum(timings.values())
+  return conn, resp, timings
+
+class PooledResponse:
+  # File-like response body, decoded as it is read when the server used a Content-Encoding.
+  # The connection goes back to the pool on close() only if the body was read to the end,
+  # otherwise it is closed. num_bytes counts bytes on the wire, num_decoded_bytes what read() returned.
+  def __init__(self, url, scheme, netloc, conn, resp, begin_s, timings=None, request_body_compressed=False):
+    self.url = url
+    self.status = resp.status
+    self.headers = resp.headers
+    self.request_body_compressed = request_body_compressed
+    self.num_bytes = 0
+    self.num_decoded_bytes = 0
+    self._decoder = content_coding.decoder_for(resp.headers.get('Content-Encoding', None))
+    self._decoded = b''
+    self._raw_at_end = False
+    self._scheme = scheme
+    self._netloc = netloc
+    self._conn = conn
+    self._resp = resp
+    self._begin_s = begin_s
+    self._timings = timings or dict()
+    self._response_begin_s = time.perf_counter()
+    self.on_close = None # Called once by close(), releases the request_scheduler in-flight slot
+
+  def read(self, amt=None):
+    if self._decoder is None:
+      chunk = self._resp.read(amt)
+      self.num_bytes += len(chunk)
+      self.num_decoded_bytes += len(chunk)
+      return chunk
+    if amt is None:
+      raw = self._resp.read()
+      self.num_bytes += len(raw)
+      chunk = self._decoded + self._decoder.decompress(raw) + self._decoder.flush()
+      self._decoded = b''
+      self._raw_at_end = True
+    else:
+      while len(self._decoded) < amt and not self._raw_at_end:
+        raw = self._resp.read(max(amt, 16 * 1024))
+        self.num_bytes += len(raw)
+        if len(raw) < 1:
+          self._decoded += self._decoder.flush()
+          self._raw_at_end = True
+        else:
+          self._decoded += self._decoder.decompress(raw)
+      chunk = self._decoded[:amt]
+      self._decoded = self._decoded[amt:]
+    self.num_decoded_bytes += len(chunk)
+    return chunk
+
+  def close(self):
+    if self._conn is None:
+      return
+    if self._resp.isclosed() and not self._resp.will_close:
+      _checkin(self._scheme, self._netloc, self._conn)
+    else:
+      self._conn.close()
+    self._conn = None
+    if self.on_close is not None:
+      self.on_close()
+    count_stat('bytes_received', self.num_bytes)
+    count_stat('bytes_decoded', self.num_decoded_bytes)
+    if request_timing.enabled:
+      self._timings['download_s'] = time.perf_counter() - self._response_begin_s
+      request_timing.add_http(self._timings, self.num_bytes, self.num_decoded_bytes)
+    for listener in response_listeners:
+      listener(self.url, time.perf_counter() - self._begin_s, self.num_bytes)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.close()
+
+def open(url, data=None, headers=None):
+  # Like urllib.request.urlopen(urllib.request.Request(url, data=data)): POSTs when data is given,
+  # follows redirects and raises urllib.error.HTTPError on >= 400. Returns a PooledResponse to
+  # read() incrementally, use it as a context manager so the connection is released.
+  # Rate limited and retried per request_scheduler; the body is not checked for error payloads here.
+  return request_scheduler.retry(url, lambda: open_once(url, data, headers))
+
+def open_once(url, data=None, headers=None):
+  # One attempt: replayed if recorded, otherwise sent once a rate limit token + in-flight slot are free.
+  # The in-flight slot is held until the response is closed. Callers that check the body themselves
+  # wrap this (not open()) in request_scheduler.retry, like fetch(), so a request is retried in one place.
+  live_open_fn = lambda: request_scheduler.limited(url, lambda release: _open_live(url, data, headers, release))
+  if replay_store is not None:
+    resp = replay_store.open(url, data, live_open_fn)
+    if isinstance(resp, replay_cache.ReplayedResponse):
+      count_stat('replayed')
+    return resp
+  return live_open_fn()
+
+def _open_live(url, data, headers, release=None):
+  count_stat('requests')
+  begin_s = time.perf_counter()
+  req_headers = {
+    'User-Agent': user_agent,
+    'Accept-Encoding': content_coding.accept_encoding,
+  }
+  if data is not None:
+    req_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+  if headers is not None:
+    req_headers.update(headers)
+
+  num_sent = 0
+  while num_sent <= max_redirects:
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+      path += '?' + parsed.query
+    send_data = data
+    send_headers = req_headers
+    if parsed.scheme == 'http':
+      proxy = proxy_for(parsed.scheme, parsed.netloc)
+      if proxy is not None:
+        # Plain http goes to the proxy as an absolute-form request
+        path = urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, path.split('?')[0], parsed.query, ''))
+        if proxy[1] is not None:
+          send_headers = dict(send_headers, **{'Proxy-Authorization': proxy[1]})
+    request_body_compressed = content_coding.should_compress_request(parsed.netloc, data)
+    if request_body_compressed:
+      send_data = content_coding.compress_request(data)
+      send_headers = dict(send_headers, **{'Content-Encoding': 'gzip'})
+      count_stat('requests_compressed')
+    count_stat('request_bytes_sent', len(send_data) if send_data is not None else 0)
+    num_sent += 1
+    conn, resp, timings = _request_once(parsed.scheme, parsed.netloc, path, send_data, send_headers)
+    pooled_resp = PooledResponse(url, parsed.scheme, parsed.netloc, conn, resp, begin_s, timings, request_body_compressed)
+
+    if request_body_compressed and resp.status in (400, 415):
+      # The server cannot read compressed bodies, send this one (and later ones to the host) plain
+      pooled_resp.read()
+      pooled_resp.close()
+      content_coding.reject_compressed_requests(parsed.netloc)
+      num_sent -= 1
+      continue
+
+    if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+      pooled_resp.read()
+      pooled_resp.close()
+      if data is not None and resp.status in (307, 308):
+        # urllib does not re-send a POST body to another URL either
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+      url = urllib.parse.urljoin(url, resp.getheader('Location'))
+      if data is not None:
+        # Like urllib: the redirect is followed with a GET, without the body or its headers
+        data = None
+        req_headers = { k: v for k, v in req_headers.items() if k.lower() != 'content-type' }
+      continue
+    if resp.status >= 400:
+      pooled_resp.read()
+      pooled_resp.close()
+      raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    pooled_resp.on_close = release
+    return pooled_resp
+
+  raise urllib.error.HTTPError(url, resp.status, 'Too many redirects', resp.headers, None)
+
+def fetch(url, data=None, headers=None):
+  # Drop-in for urllib.request.urlopen(urllib.request.Request(url, data=data)).read(), also retrying
+  # ArcGIS error payloads that signal throttling or a transient server failure
+  return request_scheduler.retry(url, lambda: fetch_once(url, data, headers))
+
+def fetch_once(url, data=None, headers=None):
+  # One attempt of fetch(): raises request_scheduler.RetryableError for retryable error payloads,
+  # for callers that wrap each attempt in request_scheduler.retry themselves
+  with open_once(url, data, headers) as resp:
+    body = resp.read()
+  error = request_scheduler.arcgis_error(body)
+  if error is not None and getattr(resp, 'request_body_compressed', False):
+    # ArcGIS answers a body it could not read with an error payload, retry uncompressed
+    content_coding.reject_compressed_requests(urllib.parse.urlsplit(resp.url).netloc)
+    return fetch_once(url, data, headers)
+  request_scheduler.raise_for_error(url, error)
+  return body
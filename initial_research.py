@@ -2,17 +2,27 @@
 # requires-python = ">=3.9"
 # dependencies = [
 #   "shapely>=2.0.7",
+#   "numpy>=1.21",
 # ]
 # ///
 
 import os
-import sys
-import urllib.request
 import urllib.parse
 import random
 import json
+import time
+import threading
 
-import shapely.geometry
+import http_pool
+import geometry_selection
+import layer_metadata
+import adaptive_paging
+import stability_trials
+import candidate_polygons
+import payload_profiles
+import feature_service
+
+server_url = 'https://sampleserver6.arcgisonline.com/arcgis/rest/services/USA/MapServer/0/query'
 
 min_x = -120.0
 max_y = 46.0
@@ -20,136 +30,242 @@ max_x = -82.0
 min_y = 32.0
 
 triangle_radius_deg = 6.0
-rp = (random.uniform(min_x, max_x), random.uniform(min_y, max_y))
-
-
-def gen_rand_points(num_points=3):
-  pts = []
-  for i in range(0, num_points):
-    pts.append(
-        (rp[0] + random.uniform(-triangle_radius_deg, triangle_radius_deg),
-         rp[1] + random.uniform(-triangle_radius_deg, triangle_radius_deg)))
-  return pts
-
-
-a_random_triangle = shapely.geometry.Polygon(gen_rand_points())
-
-oids_observed = set()
-
-
-def query_features_under(a_polygon, resultOffset=0, resultRecordCount=4):
-  global oids_observed
-  #json_query_g = json.dumps(shapely.geometry.mapping(a_polygon)) # This isn't effective
-  coords = [pt for pt in a_polygon.exterior.coords]
-  #print(f'coords = {coords}')
-  json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [coords]}
-  #print(f'json_query_g={json_query_g}')
-  data = urllib.parse.urlencode({
-      'geometry': json.dumps(json_query_g),
-      'geometryType': 'esriGeometryPolygon',
-      'outFields': '*',
-      'returnGeometry': True,
-      'resultOffset': resultOffset,
-      'resultRecordCount': resultRecordCount,
-      'f': 'pjson',
-  }).encode()
-  req = urllib.request.Request(
-      'https://sampleserver6.arcgisonline.com/arcgis/rest/services/USA/MapServer/0/query',
-      data=data)
-  resp = urllib.request.urlopen(req)
-  resp_txt = resp.read()
-  #print(f'resp_txt={resp_txt.decode("utf-8")}')
-  resp_json = json.loads(resp_txt)
-  #print(f'resp_json={resp_json}')
-  new_features = [
-      f for f in resp_json['features']
-      if not (f['attributes']['objectid'] in oids_observed)
-  ]
-  # Record seen OIDS to disallow them in the future
-  for f in resp_json['features']:
-    oids_observed.add(f['attributes']['objectid'])
-
-  return len(new_features)
-
-
-def sum_all_feature_pages_under(a_polygon, page_size=None):
-  global oids_observed
-  if page_size is None:
-    page_size = random.randint(2, 8)
-  oids_observed = set()  # Clear this
-  total_fc = 0
-  result_offset = 0
-  allowed_zero_results = 26
-  while allowed_zero_results > 0:
-    num_features = query_features_under(a_polygon,
-                                        resultOffset=result_offset,
-                                        resultRecordCount=page_size)
-    result_offset += num_features
-    total_fc += num_features
-    if num_features < 1:
-      allowed_zero_results -= 1
-  if not (total_fc == len(oids_observed)):
-    print(
-        f'WARNING: total_fc={total_fc} and len(oids_observed)={len(oids_observed)} ({oids_observed})'
-    )
-  paginated_oids_observed = list(oids_observed)
-  oids_observed = set()  # Clear this
-  single_query_total = query_features_under(a_polygon,
-                                            resultOffset=0,
-                                            resultRecordCount=99999)
-  if not (single_query_total == total_fc):
-    print(
-        f'WARNING: total_fc={total_fc} but single_query_total={single_query_total};'
-    )
-    print(f'len(oids_observed)={len(oids_observed)} ({oids_observed})')
+
+# PAGE_PAYLOAD=oid (or fields) fetches pages with only the OID field and no geometry, see payload_profiles.py
+payload_profile = payload_profiles.default_profile
+
+# USE_ADAPTIVE_PAGES=true reads pages sized from measured latency (up to maxRecordCount) and stops once the
+# returnCountOnly total is reached, instead of random 2-8 feature pages until 26 empty pages in a row.
+use_adaptive_pages = len(os.environ.get('USE_ADAPTIVE_PAGES', '')) > 0
+
+# Sequential stability test: 7 full paginations, each ending after 26 empty pages.
+# STABILITY_SEQUENTIAL_TRIALS=true uses it instead of the concurrent early-stopping trials below.
+use_sequential_trials = len(os.environ.get('STABILITY_SEQUENTIAL_TRIALS', '')) > 0
+
+
+class StabilityResearch:
+  # Stability tests against one layer. Per-run state (the number of page requests sent) lives here and
+  # every pagination keeps its own OID set, so concurrent trials never share mutable state.
+  def __init__(self, query_url, oid_field=None, payload=payload_profile):
+    self.query_url = query_url
+    # Same format negotiation as feature_service: f=pbf where the layer supports it, compact f=json otherwise
+    self.client = feature_service.client_for(query_url)
+    self.oid_field = oid_field or self.client.oid_field # The layer's OID field from its metadata unless given
+    self.payload_profile = payload
+    self.num_requests = 0
+    self._lock = threading.Lock()
+
+  def query_features_under(self,
+                           a_polygon,
+                           resultOffset=0,
+                           resultRecordCount=4,
+                           seen_oids=None):
+    # Returns the number of features not in seen_oids (default: none seen), seen_oids is updated
+    if seen_oids is None:
+      seen_oids = set()
+    coords = [pt for pt in a_polygon.exterior.coords]
+    #print(f'coords = {coords}')
+    json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [coords]}
+    #print(f'json_query_g={json_query_g}')
+    data = urllib.parse.urlencode({
+        'geometry': json.dumps(json_query_g),
+        'geometryType': 'esriGeometryPolygon',
+        **self.payload_profile.query_params(self.oid_field),
+        'resultOffset': resultOffset,
+        'resultRecordCount': resultRecordCount,
+        'f': self.client.query_format,
+    }).encode()
+    with self._lock:
+      self.num_requests += 1
+    # http_pool: keep-alive, gzip / deflate / br responses, rate limiting and retries
+    resp_txt = http_pool.fetch(self.query_url, data=data)
+    #print(f'resp_txt={resp_txt.decode("utf-8")}')
+    resp_json = feature_service.decode_query_response(resp_txt)
+    #print(f'resp_json={resp_json}')
+    new_features = [
+        f for f in resp_json['features']
+        if not (self.client.read_oid(f) in seen_oids)
+    ]
+    # Record seen OIDS to disallow them in the future
+    for f in resp_json['features']:
+      seen_oids.add(self.client.read_oid(f))
+
+    return len(new_features)
+
+  def sum_all_feature_pages_under(self, a_polygon, page_size=None):
+    if page_size is None:
+      page_size = random.randint(2, 8)
+    expected_count = None
+    page_sizer = None
+    if use_adaptive_pages:
+      expected_count = geometry_selection.query_feature_count(self.query_url, a_polygon)
+      page_sizer = adaptive_paging.AdaptivePageSize(
+          layer_metadata.get(self.query_url)['max_record_count'] or 1000)
+    oids_observed = set()
+    total_fc = 0
+    result_offset = 0
+    allowed_zero_results = 26
+    while allowed_zero_results > 0:
+      if expected_count is not None and result_offset >= expected_count:
+        break
+      if page_sizer is not None:
+        page_size = page_sizer.next(remaining=expected_count - result_offset
+                                    if expected_count is not None else None)
+      page_begin_s = time.perf_counter()
+      num_features = self.query_features_under(a_polygon,
+                                               resultOffset=result_offset,
+                                               resultRecordCount=page_size,
+                                               seen_oids=oids_observed)
+      if page_sizer is not None:
+        page_sizer.observe(page_size, time.perf_counter() - page_begin_s)
+      result_offset += num_features
+      total_fc += num_features
+      if num_features < 1:
+        allowed_zero_results -= 1
+    if not (total_fc == len(oids_observed)):
+      print(
+          f'WARNING: total_fc={total_fc} and len(oids_observed)={len(oids_observed)} ({oids_observed})'
+      )
+    paginated_oids_observed = list(oids_observed)
+    oids_observed = set()
+    single_query_total = self.query_features_under(a_polygon,
+                                                   resultOffset=0,
+                                                   resultRecordCount=99999,
+                                                   seen_oids=oids_observed)
+    if not (single_query_total == total_fc):
+      print(
+          f'WARNING: total_fc={total_fc} but single_query_total={single_query_total};'
+      )
+      print(f'len(oids_observed)={len(oids_observed)} ({oids_observed})')
+      print(
+          f'len(paginated_oids_observed)={len(paginated_oids_observed)} ({paginated_oids_observed})'
+      )
+
+    return total_fc
+
+  def test_if_polygon_stable_sequential(self, p):
+    #previous_fc = self.query_features_under(p,
+    #                                        resultOffset=0,
+    #                                        resultRecordCount=99999)
+    previous_fc = self.sum_all_feature_pages_under(p)
+    for i in range(0, 6):
+      print('.', end='', flush=True)
+      dis_fc = self.sum_all_feature_pages_under(p)
+      if dis_fc != previous_fc:
+        print()
+        print(
+            f'On query number {i} to server we first saw {previous_fc} features and THEN saw {dis_fc} features.'
+        )
+        print(f'This polygon broke the stability: {p}')
+        return False
+
+      previous_fc = dis_fc
+      # print(f'self.query_features_under(p)={self.query_features_under(p)}')
+    print()
     print(
-        f'len(paginated_oids_observed)={len(paginated_oids_observed)} ({paginated_oids_observed})'
+        f'The following polygon is stable, returns {previous_fc} features 6x times: {p}'
     )
+    return True
 
-  return total_fc
+  def paginate_oids_under(self, a_polygon, expected_count, stop_event=None):
+    # One trial: paginate with its own page size and OID set, stopping at the returnCountOnly total
+    # (plus one page to confirm nothing follows) instead of always after 26 empty pages.
+    # Returns the set of OIDs seen, or None when stop_event was set part way through.
+    seen_oids = set()
+    page_size = random.randint(2, 8)
+    page_sizer = None
+    if use_adaptive_pages:
+      page_sizer = adaptive_paging.AdaptivePageSize(
+          layer_metadata.get(self.query_url)['max_record_count'] or 1000)
+    result_offset = 0
+    # Below the returnCountOnly total the trial gives up after 26 empty pages in a row (the budget
+    # sum_all_feature_pages_under uses); once the total is reached the first empty page ends it
+    allowed_zero_results = 26
+    while allowed_zero_results > 0:
+      if stop_event is not None and stop_event.is_set():
+        return None
+      if page_sizer is not None:
+        page_size = page_sizer.next(
+            remaining=max(1, expected_count - result_offset))
+      page_begin_s = time.perf_counter()
+      num_features = self.query_features_under(a_polygon,
+                                               resultOffset=result_offset,
+                                               resultRecordCount=page_size,
+                                               seen_oids=seen_oids)
+      if page_sizer is not None:
+        page_sizer.observe(page_size, time.perf_counter() - page_begin_s)
+      result_offset += num_features
+      if num_features > 0:
+        allowed_zero_results = 26
+      else:
+        allowed_zero_results -= 1
+        if result_offset >= expected_count:
+          break
+    return seen_oids
 
+  def test_if_polygon_stable(self, p):
+    if use_sequential_trials:
+      return self.test_if_polygon_stable_sequential(p)
+    requests_before = self.num_requests
+    expected_count = geometry_selection.query_feature_count(self.query_url, p)
+    if expected_count is None:
+      expected_count = self.query_features_under(p,
+                                                 resultOffset=0,
+                                                 resultRecordCount=99999)
 
-def test_if_polygon_stable(p):
-  global oids_observed
-  oids_observed = set()
-  #previous_fc = query_features_under(p,
-  #                                   resultOffset=0,
-  #                                   resultRecordCount=99999)
-  previous_fc = sum_all_feature_pages_under(p)
-  for i in range(0, 6):
-    print('.', end='', flush=True)
-    oids_observed = set()
-    dis_fc = sum_all_feature_pages_under(p)
-    if dis_fc != previous_fc:
-      print()
+    def trial(stop_event):
+      oids = self.paginate_oids_under(p, expected_count, stop_event=stop_event)
+      return stability_trials.fingerprint(oids) if oids is not None else None
+
+    result = stability_trials.run_trials(
+        trial, on_trial=lambda fp: print('.', end='', flush=True))
+    print()
+    num_polygon_requests = self.num_requests - requests_before
+    if not result.stable:
+      first_fc = result.fingerprints[0][0]
+      dis_fc = result.fingerprints[result.mismatch_trial][0]
+      differs = 'the same number of different' if first_fc == dis_fc else f'{dis_fc}'
       print(
-          f'On query number {i} to server we first saw {previous_fc} features and THEN saw {dis_fc} features.'
+          f'On trial number {result.mismatch_trial} to server we first saw {first_fc} features and THEN saw {differs} features (returnCountOnly said {expected_count}).'
       )
       print(f'This polygon broke the stability: {p}')
+      print(f'({num_polygon_requests} requests)')
       return False
 
-    previous_fc = dis_fc
-    # print(f'query_features_under(p)={query_features_under(p)}')
-  print()
-  print(
-      f'The following polygon is stable, returns {previous_fc} features 6x times: {p}'
-  )
-  return True
+    print(
+        f'The following polygon is stable, returns {result.fingerprints[0][0]} features {result.num_trials}x times (confidence {stability_trials.confidence}, {num_polygon_requests} requests): {p}'
+    )
+    return True
 
+  def select_polygon_with_features(self, num_points=3):
+    # returnCountOnly probes (sized from the layer density grid) instead of downloading a page per candidate
+    search_extent = {'xmin': min_x, 'xmax': max_x, 'ymin': min_y, 'ymax': max_y}
+    p, num_features, num_probes = geometry_selection.select_test_polygon(
+        self.query_url, search_extent, min_features=1, max_features=100, num_points=num_points)
+    if p is None:
+      candidates = candidate_polygons.CandidatePool(
+          search_extent,
+          num_points=num_points,
+          radius=triangle_radius_deg)
+      p, _ = candidates.next()
+      while self.query_features_under(p) < 1:
+        p, _ = candidates.next()
+    return p
 
-while query_features_under(a_random_triangle) < 1:
-  a_random_triangle = shapely.geometry.Polygon(gen_rand_points(3))
+  def run(self, num_rounds=20):
+    print(f'Page payload: {self.payload_profile.describe(self.oid_field)}')
+    a_random_triangle = self.select_polygon_with_features(3)
 
-for x in range(0, 20):
-  num_pts_to_gen = 3
-  while test_if_polygon_stable(a_random_triangle):
-    print()
-    print()
-    a_random_triangle = shapely.geometry.Polygon(
-        gen_rand_points(num_pts_to_gen))
-    while query_features_under(a_random_triangle) < 1:
-      a_random_triangle = shapely.geometry.Polygon(
-          gen_rand_points(num_pts_to_gen))
-    num_pts_to_gen += 1
-
-print(f'Done!')
+    for x in range(0, num_rounds):
+      num_pts_to_gen = 3
+      while self.test_if_polygon_stable(a_random_triangle):
+        print()
+        print()
+        a_random_triangle = self.select_polygon_with_features(num_pts_to_gen)
+        num_pts_to_gen += 1
+
+    print(f'Done!')
+
+
+if __name__ == '__main__':
+  StabilityResearch(server_url).run()
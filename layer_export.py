@@ -0,0 +1,252 @@
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#   "shapely>=2.0.7",
+#   "numpy>=1.21",
+# ]
+# ///
+
+# Streaming export of a layer (or the features matching a where clause) to line-delimited GeoJSON
+# or SQLite, one page at a time, so memory stays bounded by a page however big the layer is.
+#
+# Every page is written together with a checkpoint (the last OID for keyset paging, the next
+# resultOffset for offset paging): SQLite commits both in one transaction, GeoJSONL fsyncs the
+# lines and then atomically replaces <out>.checkpoint.json, and on resume truncates anything
+# written after the last checkpoint. Re-running the same command after an interruption picks
+# up where it stopped without re-downloading finished pages. At the end the exported OIDs are
+# compared with query_all_feature_oids (returnIdsOnly) for the same where clause. An existing
+# output file without a checkpoint is started over.
+#
+# Keyset paging (where=<OID> > last OID, ordered by OID) is the default: pages do not shift when
+# rows are added or removed mid-export and resuming needs only the last OID. Offset paging is
+# kept for servers that reject OID comparisons in where clauses.
+#
+# Examples:
+#   uv run layer_export.py QUERY_URL layer.geojsonl
+#   uv run layer_export.py QUERY_URL layer.sqlite --where "STATE = 'CA'" --page-size 1000
+#
+# Geometry is requested in WGS84 (outSR=4326). Polygon rings are grouped into GeoJSON polygons
+# by orientation (clockwise rings start a polygon, counter-clockwise ones are its holes).
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+import numpy
+
+import feature_service
+import adaptive_paging
+
+paging_modes = ['keyset', 'offset']
+
+def ring_is_clockwise(ring):
+  return sum((x2 - x1) * (y2 + y1) for (x1, y1, *_), (x2, y2, *_) in zip(ring, ring[1:])) > 0
+
+def geojson_geometry(g):
+  # ArcGIS JSON geometry -> GeoJSON geometry (None for features without geometry)
+  if g is None:
+    return None
+  if 'x' in g:
+    if g['x'] is None:
+      return None
+    return {'type': 'Point', 'coordinates': [g['x'], g['y']]}
+  if 'points' in g:
+    return {'type': 'MultiPoint', 'coordinates': g['points']}
+  if 'paths' in g:
+    if len(g['paths']) == 1:
+      return {'type': 'LineString', 'coordinates': g['paths'][0]}
+    return {'type': 'MultiLineString', 'coordinates': g['paths']}
+  if 'rings' in g:
+    polygons = []
+    for ring in g['rings']:
+      if ring_is_clockwise(ring) or len(polygons) < 1:
+        polygons.append([ring])
+      else:
+        polygons[-1].append(ring)
+    # GeoJSON (RFC 7946) wants counter-clockwise shells and clockwise holes, the opposite of ArcGIS
+    polygons = [ [ ring[::-1] for ring in polygon ] for polygon in polygons ]
+    if len(polygons) == 1:
+      return {'type': 'Polygon', 'coordinates': polygons[0]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+  return None
+
+def geojson_feature(f, oid):
+  return {'type': 'Feature', 'id': oid, 'geometry': geojson_geometry(f.get('geometry', None)), 'properties': f.get('attributes', {})}
+
+class GeoJSONLinesSink:
+  def __init__(self, path):
+    self.path = path
+    self.checkpoint_path = f'{path}.checkpoint.json'
+    self._fd = open(path, 'ab')
+
+  def load_checkpoint(self):
+    # Drops lines written after the last checkpoint (an interrupted page) and returns the checkpoint, or None
+    if not os.path.exists(self.checkpoint_path):
+      self._fd.truncate(0)
+      return None
+    with open(self.checkpoint_path, 'r') as fd:
+      checkpoint = json.load(fd)
+    self._fd.seek(0, os.SEEK_END)
+    if self._fd.tell() < checkpoint['bytes']:
+      # Truncating would pad the file with NUL bytes, so the output was deleted or cut short: start over
+      print(f'WARNING: {self.path} is {self._fd.tell()} bytes but its checkpoint expects {checkpoint["bytes"]}, restarting the export')
+      os.remove(self.checkpoint_path)
+      self._fd.truncate(0)
+      return None
+    self._fd.truncate(checkpoint['bytes'])
+    self._fd.seek(0, os.SEEK_END)
+    return checkpoint
+
+  def write_page(self, features, checkpoint):
+    self._fd.write(b''.join(json.dumps(f, separators=(',', ':')).encode('utf-8') + b'\n' for f in features))
+    self._fd.flush()
+    os.fsync(self._fd.fileno())
+    checkpoint = dict(checkpoint, bytes=self._fd.tell())
+    tmp_path = f'{self.checkpoint_path}.tmp'
+    with open(tmp_path, 'w') as fd:
+      json.dump(checkpoint, fd)
+      fd.flush()
+      os.fsync(fd.fileno())
+    os.replace(tmp_path, self.checkpoint_path)
+
+  def iter_oids(self):
+    with open(self.path, 'rb') as fd:
+      for line in fd:
+        yield json.loads(line)['id']
+
+  def close(self):
+    self._fd.close()
+
+class SQLiteSink:
+  # features(oid, geometry GeoJSON text, properties JSON text) plus a one-row export_checkpoint table
+  def __init__(self, path):
+    self.path = path
+    self._db = sqlite3.connect(path)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS features (oid INTEGER PRIMARY KEY, geometry TEXT, properties TEXT NOT NULL)')
+    self._db.execute('CREATE TABLE IF NOT EXISTS export_checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0), checkpoint TEXT NOT NULL)')
+    self._db.commit()
+
+  def load_checkpoint(self):
+    row = self._db.execute('SELECT checkpoint FROM export_checkpoint WHERE id = 0').fetchone()
+    if row is None:
+      self._db.execute('DELETE FROM features')
+      self._db.commit()
+      return None
+    return json.loads(row[0])
+
+  def write_page(self, features, checkpoint):
+    with self._db:
+      self._db.executemany(
+        'INSERT OR REPLACE INTO features (oid, geometry, properties) VALUES (?, ?, ?)',
+        [ (f['id'], json.dumps(f['geometry']) if f['geometry'] is not None else None, json.dumps(f['properties'])) for f in features ]
+      )
+      self._db.execute('INSERT OR REPLACE INTO export_checkpoint (id, checkpoint) VALUES (0, ?)', (json.dumps(checkpoint),))
+
+  def iter_oids(self):
+    for row in self._db.execute('SELECT oid FROM features ORDER BY oid'):
+      yield row[0]
+
+  def close(self):
+    self._db.close()
+
+def open_sink(path):
+  if path.endswith('.sqlite') or path.endswith('.db'):
+    return SQLiteSink(path)
+  return GeoJSONLinesSink(path)
+
+def check_export_complete(client, sink, where='1=1'):
+  # (missing_oids, unexpected_oids) of the sink against returnIdsOnly for the same where clause
+  exported = numpy.fromiter(sink.iter_oids(), dtype=numpy.int64)
+  expected = numpy.asarray(client.query_all_feature_oids(None, where=where), dtype=numpy.int64)
+  return numpy.setdiff1d(expected, exported).tolist(), numpy.setdiff1d(exported, expected).tolist()
+
+def export_layer(query_url, sink, where='1=1', paging='keyset', page_size=None, progress_every_s=10.0):
+  # Returns the number of features in the sink once the export (or its resumed remainder) has finished
+  if not paging in paging_modes:
+    raise Exception(f'Unknown paging {paging}, expected one of {paging_modes}')
+  client = feature_service.client_for(query_url)
+  oid_field = client.oid_field
+  checkpoint = sink.load_checkpoint()
+  if checkpoint is not None:
+    if checkpoint['query_url'] != query_url or checkpoint['where'] != where or checkpoint['paging'] != paging:
+      raise Exception(f'{sink.path} holds an export of {checkpoint["query_url"]} where={checkpoint["where"]} paging={checkpoint["paging"]}, refusing to resume it with different settings')
+    print(f'Resuming export of {query_url} after {checkpoint["num_features"]:,} features')
+  else:
+    checkpoint = {'query_url': query_url, 'where': where, 'paging': paging, 'last_oid': None, 'offset': 0, 'num_features': 0}
+
+  expected_count = client.query_feature_count(where=where)
+  page_sizer = None
+  if page_size is None:
+    page_sizer = adaptive_paging.AdaptivePageSize(client.max_record_count)
+  begin_s = time.perf_counter()
+  progress_s = begin_s
+  num_at_begin = checkpoint['num_features']
+  while True:
+    remaining = expected_count - checkpoint['num_features'] if expected_count is not None else None
+    requested = page_sizer.next(remaining=remaining) if page_sizer is not None else page_size
+    page_begin_s = time.perf_counter()
+    if paging == 'keyset':
+      page_where = where
+      if checkpoint['last_oid'] is not None:
+        after_last = f'{oid_field} > {checkpoint["last_oid"]}'
+        page_where = after_last if where == '1=1' else f'({where}) AND {after_last}'
+      features = client.query_features(where=page_where, resultRecordCount=requested, orderByFields=f'{oid_field} ASC')
+    else:
+      features = client.query_features(where=where, resultOffset=checkpoint['offset'], resultRecordCount=requested, orderByFields=f'{oid_field} ASC')
+    if features is None:
+      raise Exception(f'Export of {query_url} stopped on an error page after {checkpoint["num_features"]:,} features, re-run to resume')
+    if page_sizer is not None:
+      page_sizer.observe(requested, time.perf_counter() - page_begin_s)
+    if len(features) < 1:
+      break
+
+    page = [ geojson_feature(f, client.read_oid(f)) for f in features ]
+    checkpoint = dict(checkpoint,
+      last_oid=max(f['id'] for f in page),
+      offset=checkpoint['offset'] + len(page),
+      num_features=checkpoint['num_features'] + len(page),
+    )
+    sink.write_page(page, checkpoint)
+
+    now_s = time.perf_counter()
+    if now_s - progress_s >= progress_every_s:
+      progress_s = now_s
+      rate = (checkpoint['num_features'] - num_at_begin) / (now_s - begin_s)
+      expected_txt = f'{expected_count:,}' if expected_count is not None else '?'
+      print(f'  {checkpoint["num_features"]:,} / {expected_txt} features ({rate:,.0f} features/s)')
+
+  duration_s = time.perf_counter() - begin_s
+  print(f'Exported {checkpoint["num_features"] - num_at_begin:,} features in {duration_s:.1f} s, {checkpoint["num_features"]:,} in {sink.path}')
+  return checkpoint['num_features']
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Export an ArcGIS layer to GeoJSONL or SQLite with checkpoint / resume')
+  parser.add_argument('query_url')
+  parser.add_argument('out', help='output file, .sqlite / .db for SQLite, anything else for line-delimited GeoJSON')
+  parser.add_argument('--where', default='1=1')
+  parser.add_argument('--paging', choices=paging_modes, default='keyset')
+  parser.add_argument('--page-size', type=int, default=None, help='features per request (default: adaptive, up to maxRecordCount)')
+  parser.add_argument('--no-check', action='store_true', help='skip the returnIdsOnly completeness check')
+  args = parser.parse_args(argv)
+
+  sink = open_sink(args.out)
+  try:
+    export_layer(args.query_url, sink, where=args.where, paging=args.paging, page_size=args.page_size)
+    if not args.no_check:
+      missing_oids, unexpected_oids = check_export_complete(feature_service.client_for(args.query_url), sink, where=args.where)
+      print(f'Completeness vs returnIdsOnly: {len(missing_oids)} missing, {len(unexpected_oids)} unexpected')
+      if len(missing_oids) > 0:
+        print(f'  missing OIDs (first 20): {missing_oids[:20]}')
+      if len(unexpected_oids) > 0:
+        print(f'  unexpected OIDs (first 20): {unexpected_oids[:20]}')
+      return 0 if len(missing_oids) < 1 else 1
+  finally:
+    sink.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,226 @@
+# Layer metadata cache.
+#
+# The layer ?f=pjson document is fetched once per layer URL and the pieces the harness
+# needs (server version, extent, OID field, maxRecordCount, supported query formats) are
+# kept in memory and in a JSON cache file, so later runs against the same layers make no
+# metadata requests at all.
+#
+# Tunables (env vars):
+#   LAYER_METADATA_CACHE   cache file path (default ~/.cache/esriisms/layer_metadata.json, empty string disables the file)
+#   LAYER_METADATA_TTL_S   entries older than this are re-fetched (default 86400, one day)
+#   LAYER_METADATA_RETRY_S a layer whose metadata could not be read is not asked again for this long (default 60)
+#
+# Metadata is fetched outside the cache lock, one fetch per layer at a time, so a slow host only delays
+# callers asking for that layer. Saving merges with what other processes (parallel_runner.py children)
+# wrote to the cache file since it was loaded, under a file lock where fcntl is available.
+#
+# get_derived() keeps values computed from a layer (like geometry_selection's density grid)
+# in the same cache, under the layer's entry.
+
+import os
+import json
+import time
+import threading
+import traceback
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None # Windows: saves still merge, just without the lock
+
+import http_pool
+
+cache_file = os.environ.get('LAYER_METADATA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'esriisms', 'layer_metadata.json'))
+ttl_s = float(os.environ.get('LAYER_METADATA_TTL_S', str(24 * 60 * 60)))
+retry_s = float(os.environ.get('LAYER_METADATA_RETRY_S', '60'))
+
+# Bump when the shape of an entry changes so stale cache files are ignored
+cache_format = 2
+
+_entries = None # layer_url -> entry dict, loaded lazily from cache_file
+_lock = threading.RLock()
+_fetch_locks = dict() # layer_url -> Lock held while that layer's metadata is fetched
+_failed_at_s = dict() # layer_url -> time of the last failed fetch, kept in memory only
+
+def layer_url(query_url):
+  query_url = query_url.split('?')[0].rstrip('/')
+  if query_url.endswith('/query'):
+    query_url = '/'.join(query_url.split('/')[:-1])
+  return query_url
+
+def _read_file():
+  if len(cache_file) < 1 or not os.path.exists(cache_file):
+    return dict()
+  try:
+    with open(cache_file, 'r') as fd:
+      cache_json = json.load(fd)
+    if cache_json.get('cache_format', None) == cache_format:
+      return cache_json.get('layers', dict())
+  except:
+    traceback.print_exc()
+  return dict()
+
+def _load():
+  global _entries
+  if _entries is None:
+    _entries = _read_file()
+
+def _merge_entry(mine, theirs):
+  # The newer fetch wins; derived values are merged key by key, newest first
+  if mine is None:
+    return theirs
+  if (theirs.get('fetched_at_s', None) or 0) > (mine.get('fetched_at_s', None) or 0):
+    mine, theirs = theirs, mine
+  merged = dict(mine)
+  derived = dict(theirs.get('derived', dict()))
+  for key, value in mine.get('derived', dict()).items():
+    if not key in derived or value.get('computed_at_s', 0) >= derived[key].get('computed_at_s', 0):
+      derived[key] = value
+  if len(derived) > 0:
+    merged['derived'] = derived
+  return merged
+
+def _save(merge=True, forget=()):
+  # Called with _lock held. Entries other processes saved since we loaded are merged in (except `forget`)
+  # so concurrent runs sharing the cache file do not drop each other's layers.
+  if len(cache_file) < 1:
+    return
+  try:
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with open(f'{cache_file}.lock', 'a') as lock_fd:
+      if fcntl is not None:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+      if merge:
+        for url, entry in _read_file().items():
+          if not url in forget:
+            _entries[url] = _merge_entry(_entries.get(url, None), entry)
+      tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+      with open(tmp_file, 'w') as fd:
+        json.dump({'cache_format': cache_format, 'layers': _entries}, fd, indent=2)
+      os.replace(tmp_file, cache_file)
+  except:
+    traceback.print_exc()
+
+def _fetch_json(url):
+  return json.loads(http_pool.fetch(url+'?f=pjson'))
+
+def _read_version(url, layer_json):
+  if 'currentVersion' in layer_json:
+    return layer_json['currentVersion']
+  # Older layers only report currentVersion on the service / catalog, so walk up until one does
+  up_one_url = url
+  for i in range(0, 6):
+    up_one_url = '/'.join(up_one_url.split('/')[:-1])
+    try:
+      resp_json = _fetch_json(up_one_url)
+      if 'currentVersion' in resp_json:
+        return resp_json['currentVersion']
+    except:
+      traceback.print_exc()
+  return None
+
+def _read_entry(url):
+  layer_json = _fetch_json(url)
+  if 'error' in layer_json:
+    raise Exception(f'Error reading layer metadata from {url}: {layer_json["error"]}')
+
+  oid_field = layer_json.get('objectIdField', None)
+  for field in layer_json.get('fields', None) or []:
+    if oid_field is None and field.get('type', 'UNK').casefold() == 'esriFieldTypeOID'.casefold():
+      oid_field = field.get('name', field.get('alias', None))
+
+  extent = None
+  if 'extent' in layer_json:
+    extent = {
+      'xmin': layer_json['extent']['xmin'],
+      'xmax': layer_json['extent']['xmax'],
+      'ymin': layer_json['extent']['ymin'],
+      'ymax': layer_json['extent']['ymax'],
+    }
+
+  max_record_count = layer_json.get('maxRecordCount', None)
+  supported_query_formats = [ f.strip().casefold() for f in layer_json.get('supportedQueryFormats', '').split(',') if len(f.strip()) > 0 ]
+
+  return {
+    'fetched_at_s': time.time(),
+    'version': _read_version(url, layer_json),
+    'extent': extent,
+    'oid_field': oid_field,
+    'max_record_count': int(max_record_count) if max_record_count is not None else None,
+    'supported_query_formats': supported_query_formats,
+  }
+
+def _cached_entry(url):
+  with _lock:
+    _load()
+    entry = _entries.get(url, None)
+    if entry is not None and time.time() - entry.get('fetched_at_s', 0) < ttl_s:
+      return entry
+    return None
+
+def get(query_url):
+  # Returns the cached metadata entry for the layer behind query_url, fetching it if missing or expired.
+  # If the server cannot be read an entry of all-None values is returned (and not cached), and the
+  # layer is not asked again for retry_s seconds.
+  url = layer_url(query_url)
+  entry = _cached_entry(url)
+  if entry is not None:
+    return entry
+  with _lock:
+    fetch_lock = _fetch_locks.setdefault(url, threading.Lock())
+  with fetch_lock:
+    entry = _cached_entry(url) # Another thread may have fetched it while we waited
+    if entry is not None:
+      return entry
+    if time.time() - _failed_at_s.get(url, float('-inf')) < retry_s:
+      return _empty_entry()
+    try:
+      entry = _read_entry(url)
+    except:
+      traceback.print_exc()
+      _failed_at_s[url] = time.time()
+      return _empty_entry()
+    with _lock:
+      _failed_at_s.pop(url, None)
+      _entries[url] = entry
+      _save()
+    return entry
+
+def _empty_entry():
+  return {
+    'fetched_at_s': None,
+    'version': None,
+    'extent': None,
+    'oid_field': None,
+    'max_record_count': None,
+    'supported_query_formats': [],
+  }
+
+def get_derived(query_url, key, compute_fn):
+  # Caches compute_fn() (anything JSON serializable worked out from the layer, e.g. a density grid)
+  # next to the layer's metadata under `key`, with the same TTL and cache file.
+  url = layer_url(query_url)
+  with _lock:
+    _load()
+    derived = _entries.get(url, dict()).get('derived', dict()).get(key, None)
+    if derived is not None and time.time() - derived.get('computed_at_s', 0) < ttl_s:
+      return derived['value']
+  # Computed outside the lock, this may take many requests
+  value = compute_fn()
+  get(query_url) # derived values live inside the layer's entry, so make sure it exists
+  with _lock:
+    if url in _entries:
+      _entries[url].setdefault('derived', dict())[key] = {'computed_at_s': time.time(), 'value': value}
+      _save()
+  return value
+
+def invalidate(query_url=None):
+  global _entries
+  with _lock:
+    _load()
+    if query_url is None:
+      _entries = dict()
+      _save(merge=False)
+    else:
+      _entries.pop(layer_url(query_url), None)
+      _save(forget=[layer_url(query_url)])
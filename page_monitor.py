@@ -0,0 +1,255 @@
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#   "shapely>=2.0.7",
+#   "numpy>=1.21",
+# ]
+# ///
+
+# Low-traffic stability monitoring of many layers.
+#
+# Each watched (layer, polygon) pair is paged with a fixed resultRecordCount, and a fingerprint of
+# every page (OID count plus a rolling hash of the OIDs in page order) is kept in a local SQLite
+# index keyed by (layer, polygon, resultOffset, resultRecordCount). Repeat runs fetch the pages
+# OID-only (PAGE_PAYLOAD=oid, see payload_profiles.py) and compare fingerprints; only when a page's
+# fingerprint changed is returnIdsOnly fetched, the Q1-Q4 analysis (stability_analysis.py) run over
+# the run's pages, and each changed page downloaded again with the full payload and compared with its
+# slice of returnIdsOnly. A quiet layer costs one returnCountOnly request plus one small page request per page.
+#
+# The rolling hash is a polynomial hash over the OIDs, so the hash of a whole harvest is combined
+# from the page hashes (combine_hashes) and stored per watch without keeping any OID lists.
+#
+# The first run of a watch only records its fingerprints. A layer URL given without --polygon-wkt is
+# watched with a polygon of 10-89 features picked by geometry_selection.select_test_polygon, the same
+# size test_order_stability.py uses. Watches run concurrently (--workers); http_pool caps in-flight
+# requests per host (HTTP_MAX_INFLIGHT, see request_scheduler.py).
+#
+# Examples:
+#   uv run page_monitor.py QUERY_URL1 QUERY_URL2 --index page_index.db     # add watches, first run records fingerprints
+#   uv run page_monitor.py --index page_index.db --interval-s 600          # re-check every watch every 10 minutes
+#
+# Exits with 1 when a single round (no --interval-s) found a changed page.
+
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+import shapely.wkt
+
+import http_pool
+import feature_service
+import geometry_selection
+import payload_profiles
+import stability_analysis
+
+hash_base = 1000003
+hash_modulus = (1 << 61) - 1 # Mersenne prime, hashes fit a signed 64-bit SQLite INTEGER
+
+oid_payload = payload_profiles.PayloadProfile('oid')
+full_payload = payload_profiles.PayloadProfile('full')
+
+def rolling_hash(oids, h=0):
+  for oid in oids:
+    h = (h * hash_base + int(oid) % hash_modulus + 1) % hash_modulus
+  return h
+
+def combine_hashes(h_a, h_b, len_b):
+  # rolling_hash(a + b) from rolling_hash(a), rolling_hash(b) and len(b)
+  return (h_a * pow(hash_base, len_b, hash_modulus) + h_b) % hash_modulus
+
+def page_fingerprint(oids):
+  return (len(oids), rolling_hash(oids))
+
+def polygon_key(a_polygon):
+  return hashlib.sha256(a_polygon.wkb).hexdigest()[:16]
+
+class FingerprintIndex:
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute('''CREATE TABLE IF NOT EXISTS watches (
+      query_url TEXT NOT NULL, polygon_key TEXT NOT NULL, polygon_wkt TEXT NOT NULL, page_size INTEGER NOT NULL,
+      num_features INTEGER, harvest_hash INTEGER, checked_s REAL,
+      PRIMARY KEY (query_url, polygon_key))''')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS page_fingerprints (
+      query_url TEXT NOT NULL, polygon_key TEXT NOT NULL, result_offset INTEGER NOT NULL, result_record_count INTEGER NOT NULL,
+      num_oids INTEGER NOT NULL, oid_hash INTEGER NOT NULL, checked_s REAL NOT NULL, changed_s REAL,
+      PRIMARY KEY (query_url, polygon_key, result_offset, result_record_count))''')
+    self._db.commit()
+
+  def watches(self, query_urls=None):
+    with self._lock:
+      rows = self._db.execute('SELECT query_url, polygon_key, polygon_wkt, page_size FROM watches ORDER BY query_url, polygon_key').fetchall()
+    watches = [ {'query_url': r[0], 'polygon_key': r[1], 'polygon_wkt': r[2], 'page_size': r[3]} for r in rows ]
+    if query_urls is not None:
+      watches = [ w for w in watches if w['query_url'] in query_urls ]
+    return watches
+
+  def add_watch(self, query_url, a_polygon, page_size):
+    watch = {'query_url': query_url, 'polygon_key': polygon_key(a_polygon), 'polygon_wkt': a_polygon.wkt, 'page_size': page_size}
+    with self._lock, self._db:
+      self._db.execute('INSERT OR IGNORE INTO watches (query_url, polygon_key, polygon_wkt, page_size) VALUES (?, ?, ?, ?)',
+                       (query_url, watch['polygon_key'], watch['polygon_wkt'], page_size))
+    return watch
+
+  def page_fingerprints(self, watch):
+    # {(result_offset, result_record_count): (num_oids, oid_hash)} from the last run of a watch
+    with self._lock:
+      rows = self._db.execute('SELECT result_offset, result_record_count, num_oids, oid_hash FROM page_fingerprints WHERE query_url = ? AND polygon_key = ?',
+                              (watch['query_url'], watch['polygon_key'])).fetchall()
+    return { (r[0], r[1]): (r[2], r[3]) for r in rows }
+
+  def store_run(self, watch, fingerprints, changed_pages, num_features, harvest_hash, now_s):
+    key = (watch['query_url'], watch['polygon_key'])
+    with self._lock, self._db:
+      self._db.execute('DELETE FROM page_fingerprints WHERE query_url = ? AND polygon_key = ?', key)
+      self._db.executemany(
+        'INSERT INTO page_fingerprints (query_url, polygon_key, result_offset, result_record_count, num_oids, oid_hash, checked_s, changed_s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [ key + page + fp + (now_s, now_s if page in changed_pages else None) for page, fp in fingerprints.items() ]
+      )
+      self._db.execute('UPDATE watches SET num_features = ?, harvest_hash = ?, checked_s = ? WHERE query_url = ? AND polygon_key = ?',
+                       (num_features, harvest_hash, now_s) + key)
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+def select_watch_polygon(query_url):
+  client = feature_service.client_for(query_url)
+  a_polygon, num_features, num_probes = geometry_selection.select_test_polygon(query_url, client.extent, min_features=10, max_features=89, num_points=3)
+  return a_polygon
+
+def diff_changed_pages(client, a_polygon, pages, changed_pages):
+  # Q1-Q4 of this run's pages against returnIdsOnly, plus {page: (full download, expected OIDs)} for the changed pages
+  expected_oids = sorted(client.query_all_feature_oids(a_polygon), reverse=True) # Pages are ordered by OID DESC
+  analysis = stability_analysis.analyze(expected_oids, [ pages[page] for page in sorted(pages) ])
+  full_pages = dict()
+  for offset, count in sorted(changed_pages):
+    if (offset, count) in pages:
+      full_oids = client.query_feature_page(a_polygon, resultOffset=offset, resultRecordCount=count, payload=full_payload)
+      full_pages[(offset, count)] = (full_oids, expected_oids[offset:offset + count])
+  return analysis, full_pages
+
+def check_watch(index, watch):
+  # Returns (report lines, number of changed pages)
+  client = feature_service.client_for(watch['query_url'])
+  a_polygon = shapely.wkt.loads(watch['polygon_wkt'])
+  page_size = watch['page_size']
+  label = f'{watch["query_url"]} polygon {watch["polygon_key"]}'
+  num_features = client.query_feature_count(a_polygon)
+  if num_features is None:
+    return [f'{label}: returnCountOnly failed, skipped'], 0
+
+  previous = index.page_fingerprints(watch)
+  pages = dict()
+  fingerprints = dict()
+  harvest_hash = 0
+  for offset in range(0, num_features, page_size):
+    page_oids = client.query_feature_page(a_polygon, resultOffset=offset, resultRecordCount=page_size, payload=oid_payload)
+    pages[(offset, page_size)] = page_oids
+    fingerprints[(offset, page_size)] = page_fingerprint(page_oids)
+    harvest_hash = combine_hashes(harvest_hash, fingerprints[(offset, page_size)][1], len(page_oids))
+
+  if len(previous) < 1:
+    index.store_run(watch, fingerprints, set(), num_features, harvest_hash, time.time())
+    return [f'{label}: recorded {len(fingerprints)} page fingerprints ({num_features} features, page size {page_size})'], 0
+
+  changed_pages = set( page for page in fingerprints if previous.get(page, None) != fingerprints[page] )
+  removed_pages = set( page for page in previous if not page in fingerprints )
+  index.store_run(watch, fingerprints, changed_pages, num_features, harvest_hash, time.time())
+  if len(changed_pages) + len(removed_pages) < 1:
+    return [f'{label}: {len(fingerprints)} pages ({num_features} features) unchanged'], 0
+
+  lines = [f'{label}: {len(changed_pages)} of {len(fingerprints)} pages changed, {len(removed_pages)} gone ({num_features} features)']
+  analysis, full_pages = diff_changed_pages(client, a_polygon, pages, changed_pages)
+  for page in sorted(changed_pages | removed_pages):
+    before = previous.get(page, None)
+    after = fingerprints.get(page, None)
+    before_txt = f'{before[0]} OIDs #{before[1]:016x}' if before is not None else 'no page'
+    after_txt = f'{after[0]} OIDs #{after[1]:016x}' if after is not None else 'no page'
+    lines.append(f'  Page resultOffset={page[0]: <4} resultRecordCount={page[1]: <3}: {before_txt} -> {after_txt}')
+    if page in pages:
+      lines.append(f'      OID-only page: {pages[page]}')
+    if page in full_pages:
+      full_oids, expected_page = full_pages[page]
+      lines.append(f'      full download: {full_oids} ({"matches" if full_oids == expected_page else "differs from"} returnIdsOnly {expected_page})')
+  lines.append(f'  Q1 duplicate OIDs: {len(analysis["duplicates"])}  Q2 missing OIDs: {len(analysis["missing"])}  '
+               f'Q3 unexpected OIDs: {len(analysis["unexpected"])}  Q4 order mismatches: {len(analysis["order_mismatches"])}')
+  for oid, count in analysis['duplicates']:
+    lines.append(f'  Observation: {oid} was returned {count} times!')
+  for e_oid in analysis['missing']:
+    lines.append(f'  Observation: {e_oid} was NOT returned in the pages!')
+  for p_oid in analysis['unexpected']:
+    lines.append(f'  Observation: {p_oid} was returned but is NOT in returnIdsOnly!')
+  return lines, len(changed_pages) + len(removed_pages)
+
+def run_round(index, watches, max_workers):
+  # Checks every watch once, printing each watch's report as one block; returns the number of changed pages
+  print_lock = threading.Lock()
+  num_changed = 0
+  requests_before = http_pool.stats['requests']
+  bytes_before = http_pool.stats['bytes_received']
+  begin_s = time.time()
+
+  def check_one(watch):
+    try:
+      lines, changed = check_watch(index, watch)
+    except Exception as e:
+      lines, changed = [f'{watch["query_url"]} polygon {watch["polygon_key"]}: check failed: {e}'], 0
+    with print_lock:
+      print('\n'.join(lines), flush=True)
+    return changed
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+    for changed in executor.map(check_one, watches):
+      num_changed += changed
+
+  num_requests = http_pool.stats['requests'] - requests_before
+  num_bytes = http_pool.stats['bytes_received'] - bytes_before
+  print(f'Checked {len(watches)} watches in {time.time() - begin_s:.1f} s: {num_changed} changed pages, {num_requests} requests, {num_bytes:,} bytes on the wire')
+  return num_changed
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Watch layers for page instability by comparing per-page OID fingerprints between runs')
+  parser.add_argument('query_urls', nargs='*', help='layers to watch (added to the index when new); every watch in the index when none are given')
+  parser.add_argument('--index', default='page_index.db', help='SQLite fingerprint index')
+  parser.add_argument('--page-size', type=int, default=10, help='resultRecordCount of new watches')
+  parser.add_argument('--polygon-wkt', default=None, help='polygon (WGS84 WKT) for new watches, selected per layer when unset')
+  parser.add_argument('--interval-s', type=float, default=0.0, help='re-check every watch this often, forever; 0 checks once')
+  parser.add_argument('--workers', type=int, default=8, help='watches checked at once')
+  args = parser.parse_args(argv)
+
+  index = FingerprintIndex(args.index)
+  try:
+    query_urls = None
+    if len(args.query_urls) > 0:
+      query_urls = set(args.query_urls)
+      watched_urls = set( w['query_url'] for w in index.watches(query_urls) )
+      for query_url in args.query_urls:
+        if query_url in watched_urls and args.polygon_wkt is None:
+          continue
+        a_polygon = shapely.wkt.loads(args.polygon_wkt) if args.polygon_wkt is not None else select_watch_polygon(query_url)
+        if a_polygon is None:
+          print(f'WARNING: no polygon of 10-89 features found for {query_url}, not watching it')
+          continue
+        index.add_watch(query_url, a_polygon, args.page_size)
+
+    watches = index.watches(query_urls)
+    if len(watches) < 1:
+      print(f'Nothing to watch in {args.index}, pass layer query URLs to add watches')
+      return 1
+    while True:
+      num_changed = run_round(index, watches, args.workers)
+      if args.interval_s <= 0:
+        return 0 if num_changed < 1 else 1
+      time.sleep(args.interval_s)
+  finally:
+    index.close()
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
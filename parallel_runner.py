@@ -0,0 +1,71 @@
+# Runs test_order_stability.py against many servers at once.
+#
+# Each server is tested in its own child process (the test keeps per-server state in module
+# globals, so processes are the safe unit of parallelism). A child's output is buffered and
+# printed as one block when it finishes, so each server's Q1-Q4 report reads exactly like a
+# sequential run. A child issues one request at a time, so limiting the number of children
+# per host caps the in-flight requests against that host.
+#
+# Tunables (env vars):
+#   PARALLEL_SERVERS        number of servers tested at once (test_order_stability.py runs sequentially when unset or < 2)
+#   MAX_INFLIGHT_PER_HOST   max concurrent tests (and so in-flight requests) per host (default 2)
+
+import os
+import sys
+import time
+import threading
+import subprocess
+import urllib.parse
+import concurrent.futures
+
+max_inflight_per_host = int(os.environ.get('MAX_INFLIGHT_PER_HOST', '2') or 2)
+
+def interleave_by_host(server_urls):
+  # Round-robin the URLs across hosts so workers are not all parked on one host's limit
+  by_host = dict()
+  for url in server_urls:
+    by_host.setdefault(urllib.parse.urlparse(url).netloc, []).append(url)
+  interleaved = []
+  while any(len(urls) > 0 for urls in by_host.values()):
+    for urls in by_host.values():
+      if len(urls) > 0:
+        interleaved.append(urls.pop(0))
+  return interleaved
+
+def run_servers(script_path, server_urls, max_workers, per_host_limit=None):
+  if per_host_limit is None:
+    per_host_limit = max_inflight_per_host
+  host_semaphores = dict()
+  for url in server_urls:
+    host_semaphores.setdefault(urllib.parse.urlparse(url).netloc, threading.BoundedSemaphore(max(1, per_host_limit)))
+  print_lock = threading.Lock()
+
+  def run_one(child_num, server_url):
+    child_env = dict(os.environ)
+    child_env.pop('PARALLEL_SERVERS', None)
+    if len(child_env.get('LOG_URLS_TO', '')) > 0:
+      # Every child truncates its log file on start, so give each its own
+      child_env['LOG_URLS_TO'] = f'{child_env["LOG_URLS_TO"]}.{child_num}'
+    with host_semaphores[urllib.parse.urlparse(server_url).netloc]:
+      begin_s = time.time()
+      child = subprocess.run([sys.executable, script_path, server_url],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=child_env)
+      duration_s = time.time() - begin_s
+    with print_lock:
+      sys.stdout.write(child.stdout.decode('utf-8', errors='replace'))
+      sys.stdout.flush()
+    return server_url, child.returncode, duration_s
+
+  begin_s = time.time()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [ executor.submit(run_one, i, url) for i, url in enumerate(interleave_by_host(server_urls)) ]
+    results = [ f.result() for f in futures ]
+  wall_s = time.time() - begin_s
+
+  print(f'=== Tested {len(results)} servers with PARALLEL_SERVERS={max_workers} MAX_INFLIGHT_PER_HOST={per_host_limit} ===')
+  for server_url, returncode, duration_s in results:
+    status = 'ok' if returncode == 0 else f'FAILED (exit code {returncode})'
+    print(f'  {duration_s:6.1f}s {status: <8} {server_url}')
+  print(f'Wall time {wall_s:.1f}s, sequential time would have been ~{sum(r[2] for r in results):.1f}s')
+
+  return 0 if all(r[1] == 0 for r in results) else 1
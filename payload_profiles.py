@@ -0,0 +1,112 @@
+# What a page request asks the server to send back.
+#
+# The stability analysis only ever reads OIDs from a page, so downloading and decoding every
+# attribute and the full geometry of each feature is wasted work. A payload profile picks the
+# outFields / returnGeometry of page requests (query_feature_page, query_feature_page_arcgis,
+# query_feature, query_features_by_oids and initial_research.py's query_features_under):
+#
+#   full     outFields=* with geometry (the default, what every page request used to send)
+#   oid      outFields=<OID field>, no geometry
+#   fields   outFields=<OID field>,PAGE_FIELDS, no geometry unless PAGE_GEOMETRY is set
+#
+# When geometry is returned it can be generalized (maxAllowableOffset) and have its coordinates
+# rounded (geometryPrecision) or snapped to an integer grid (quantizationParameters, edit mode so
+# vertices are only snapped, never dropped) on the server. Any of those also sets outSR=4326 so
+# offsets and tolerances are in degrees, the same units as the harness' test polygons.
+# The profile is printed with each test so runs with smaller payloads can be compared with full ones.
+#
+# Tunables (env vars):
+#   PAGE_PAYLOAD               full (default), oid or fields
+#   PAGE_FIELDS                comma-separated fields added to the OID for PAGE_PAYLOAD=fields
+#   PAGE_GEOMETRY              also return geometry with PAGE_PAYLOAD=oid / fields
+#   PAGE_MAX_ALLOWABLE_OFFSET  maxAllowableOffset in degrees for returned geometry
+#   PAGE_GEOMETRY_PRECISION    geometryPrecision (decimal places) for returned geometry
+#   PAGE_QUANTIZE_TOLERANCE    quantize returned geometry to a grid of this many degrees
+
+import os
+import json
+
+profile_names = ['full', 'oid', 'fields']
+
+# Quantization grid origin: the upper left corner of the WGS84 world, valid for any layer extent
+quantize_extent = {'xmin': -180.0, 'ymin': -90.0, 'xmax': 180.0, 'ymax': 90.0, 'spatialReference': {'wkid': 4326}}
+
+def optional_float(value):
+  return float(value) if len(str(value or '').strip()) > 0 else None
+
+class PayloadProfile:
+  def __init__(self, name='full', fields=None, return_geometry=None, max_allowable_offset=None, geometry_precision=None, quantize_tolerance=None):
+    if not name in profile_names:
+      raise Exception(f'Unknown payload profile {name}, expected one of {profile_names}')
+    self.name = name
+    self.fields = [ f for f in (fields or []) if len(f) > 0 ] if name == 'fields' else []
+    self.return_geometry = (name == 'full') or bool(return_geometry)
+    self.max_allowable_offset = max_allowable_offset
+    self.geometry_precision = geometry_precision
+    self.quantize_tolerance = quantize_tolerance
+
+  @property
+  def simplifies_geometry(self):
+    return self.return_geometry and (self.max_allowable_offset is not None or self.geometry_precision is not None or self.quantize_tolerance is not None)
+
+  def out_fields(self, oid_field):
+    if self.name == 'full':
+      return '*'
+    return ','.join([oid_field] + [ f for f in self.fields if f.casefold() != oid_field.casefold() ])
+
+  def quantization_parameters(self):
+    return {'mode': 'edit', 'originPosition': 'upperLeft', 'tolerance': self.quantize_tolerance, 'extent': quantize_extent}
+
+  def query_params(self, oid_field):
+    params = {
+      'outFields': self.out_fields(oid_field),
+      'returnGeometry': self.return_geometry,
+    }
+    if self.simplifies_geometry:
+      params['outSR'] = 4326
+      if self.max_allowable_offset is not None:
+        params['maxAllowableOffset'] = self.max_allowable_offset
+      if self.geometry_precision is not None:
+        params['geometryPrecision'] = self.geometry_precision
+      if self.quantize_tolerance is not None:
+        params['quantizationParameters'] = json.dumps(self.quantization_parameters())
+    return params
+
+  def arcgis_query_kwargs(self, oid_field):
+    # The same profile as keyword arguments of arcgis.features.FeatureLayer.query()
+    kwargs = {
+      'out_fields': self.out_fields(oid_field),
+      'return_geometry': self.return_geometry,
+    }
+    if self.simplifies_geometry:
+      kwargs['out_sr'] = 4326
+      if self.max_allowable_offset is not None:
+        kwargs['max_allowable_offset'] = self.max_allowable_offset
+      if self.geometry_precision is not None:
+        kwargs['geometry_precision'] = self.geometry_precision
+      if self.quantize_tolerance is not None:
+        kwargs['quantization_parameters'] = self.quantization_parameters()
+    return kwargs
+
+  def describe(self, oid_field='<OID>'):
+    txt = f'{self.name} (outFields={self.out_fields(oid_field)}, returnGeometry={self.return_geometry}'
+    if self.max_allowable_offset is not None:
+      txt += f', maxAllowableOffset={self.max_allowable_offset}'
+    if self.geometry_precision is not None:
+      txt += f', geometryPrecision={self.geometry_precision}'
+    if self.quantize_tolerance is not None:
+      txt += f', quantize tolerance={self.quantize_tolerance}'
+    return txt + ')'
+
+def from_env():
+  precision = os.environ.get('PAGE_GEOMETRY_PRECISION', '')
+  return PayloadProfile(
+    name=os.environ.get('PAGE_PAYLOAD', '') or 'full',
+    fields=[ f.strip() for f in os.environ.get('PAGE_FIELDS', '').split(',') ],
+    return_geometry=len(os.environ.get('PAGE_GEOMETRY', '')) > 0,
+    max_allowable_offset=optional_float(os.environ.get('PAGE_MAX_ALLOWABLE_OFFSET', '')),
+    geometry_precision=int(precision) if len(precision.strip()) > 0 else None,
+    quantize_tolerance=optional_float(os.environ.get('PAGE_QUANTIZE_TOLERANCE', '')),
+  )
+
+default_profile = from_env()
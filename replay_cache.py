@@ -0,0 +1,192 @@
+# Record / replay store for HTTP responses fetched through http_pool.
+#
+# Responses are kept in a SQLite file, zlib compressed, keyed by a hash of the method,
+# normalized URL (lowercased scheme + host, sorted query parameters) and normalized
+# form-encoded POST body (sorted parameters). A rerun that issues the same requests
+# (see RANDOM_SEED in test_order_stability.py) is then answered from disk with no network.
+#
+# Tunables (env vars):
+#   HTTP_REPLAY_DB     SQLite file to record to / replay from (unset disables record and replay)
+#   HTTP_REPLAY_MODE   auto   = replay when recorded, otherwise fetch and record (default)
+#                      record = always fetch, overwrite what was recorded
+#                      replay = only replay, a request that was never recorded raises ReplayMiss
+#
+# Bodies are stored after content decoding (see content_coding.py), whatever encoding the server used.
+#
+# Only 2xx responses that were read to the end and are not ArcGIS error payloads (throttling
+# and the like, which request_scheduler retries) are recorded. Requests sent by the arcgis
+# package do not go through http_pool and are never recorded.
+
+import io
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import http.client
+import urllib.parse
+
+import request_scheduler
+
+modes = ['auto', 'record', 'replay']
+
+class ReplayMiss(Exception):
+  pass
+
+def normalize_url(url):
+  parsed = urllib.parse.urlsplit(url)
+  query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)))
+  return urllib.parse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/', query, ''))
+
+def normalize_body(data):
+  if data is None:
+    return b''
+  try:
+    return urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(data.decode('utf-8'), keep_blank_values=True))).encode('utf-8')
+  except UnicodeDecodeError:
+    return bytes(data)
+
+def request_key(url, data):
+  method = 'GET' if data is None else 'POST'
+  h = hashlib.sha256()
+  h.update(method.encode('utf-8'))
+  h.update(b'\n')
+  h.update(normalize_url(url).encode('utf-8'))
+  h.update(b'\n')
+  h.update(normalize_body(data))
+  return h.hexdigest()
+
+class ReplayedResponse:
+  # Same surface as http_pool.PooledResponse, backed by the recorded body
+  def __init__(self, url, status, content_type, body):
+    self.url = url
+    self.status = status
+    self.headers = http.client.HTTPMessage()
+    if content_type:
+      self.headers['Content-Type'] = content_type
+    self.num_bytes = 0
+    self._body = io.BytesIO(body)
+
+  def read(self, amt=None):
+    chunk = self._body.read(amt) if amt is not None else self._body.read()
+    self.num_bytes += len(chunk)
+    return chunk
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.close()
+
+class RecordingResponse:
+  # Wraps a live response, keeps a copy of the body and stores it once the body was read to the end
+  def __init__(self, store, key, data, resp):
+    self.url = resp.url
+    self.status = resp.status
+    self.headers = resp.headers
+    self.request_body_compressed = getattr(resp, 'request_body_compressed', False)
+    self._store = store
+    self._key = key
+    self._data = data
+    self._resp = resp
+    self._chunks = []
+    self._at_end = False
+
+  @property
+  def num_bytes(self):
+    return self._resp.num_bytes
+
+  def read(self, amt=None):
+    chunk = self._resp.read(amt)
+    self._chunks.append(chunk)
+    if amt is None or len(chunk) < 1:
+      self._at_end = True
+    return chunk
+
+  def close(self):
+    if self._resp is None:
+      return
+    # Streaming readers (STREAM_JSON) stop at the closing brace and leave the tail unread, drain it so the body can still be stored
+    if not self._at_end and 200 <= self.status < 300:
+      try:
+        while len(self.read(64 * 1024)) > 0:
+          pass
+      except Exception:
+        self._at_end = False
+    if self._at_end and 200 <= self.status < 300:
+      body = b''.join(self._chunks)
+      if request_scheduler.arcgis_error(body) is None:
+        self._store.put(self._key, self.url, self._data, self.status, self.headers.get('Content-Type', None), body)
+    self._chunks = []
+    self._resp.close()
+    self._resp = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.close()
+
+class ReplayStore:
+  def __init__(self, db_file, mode='auto'):
+    if not mode in modes:
+      raise Exception(f'Unknown replay mode {mode}, expected one of {modes}')
+    self.db_file = db_file
+    self.mode = mode
+    self.stats = {'hits': 0, 'misses': 0, 'recorded': 0}
+    self._lock = threading.Lock()
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    os.makedirs(db_dir, exist_ok=True)
+    self._db = sqlite3.connect(db_file, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS responses (
+      key TEXT PRIMARY KEY,
+      url TEXT NOT NULL,
+      request_body BLOB,
+      status INTEGER NOT NULL,
+      content_type TEXT,
+      body BLOB NOT NULL,
+      body_len INTEGER NOT NULL,
+      recorded_at_s REAL NOT NULL
+    )''')
+    self._db.commit()
+
+  def get(self, key):
+    # (status, content_type, body) or None
+    with self._lock:
+      row = self._db.execute('SELECT status, content_type, body FROM responses WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    return row[0], row[1], zlib.decompress(row[2])
+
+  def put(self, key, url, data, status, content_type, body):
+    compressed = zlib.compress(body, 6)
+    with self._lock:
+      self._db.execute(
+        'INSERT OR REPLACE INTO responses (key, url, request_body, status, content_type, body, body_len, recorded_at_s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (key, url, data, status, content_type, compressed, len(body), time.time())
+      )
+      self._db.commit()
+      self.stats['recorded'] += 1
+
+  def open(self, url, data, live_open_fn):
+    # Returns a ReplayedResponse on a hit, otherwise the live response from live_open_fn() (recorded unless in replay mode)
+    key = request_key(url, data)
+    if self.mode != 'record':
+      recorded = self.get(key)
+      if recorded is not None:
+        self.stats['hits'] += 1
+        status, content_type, body = recorded
+        return ReplayedResponse(url, status, content_type, body)
+      self.stats['misses'] += 1
+      if self.mode == 'replay':
+        raise ReplayMiss(f'No recorded response for {url} data={normalize_body(data)[:200]}')
+    return RecordingResponse(self, key, data, live_open_fn())
+
+  def close(self):
+    with self._lock:
+      self._db.close()
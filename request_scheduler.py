@@ -0,0 +1,204 @@
+# Per-host request scheduling for http_pool: a token bucket rate limit, a cap on in-flight
+# requests and retries with jittered exponential backoff.
+#
+# Retried: HTTP 429 / 500 / 502 / 503 / 504, connection errors and timeouts, and ArcGIS error
+# payloads (HTTP 200 + {"error": {...}}) whose code is one of those or whose message reads like
+# throttling. Other error payloads (a bad where clause, ...) are returned to the caller as before.
+# Once retries run out RetriesExhausted is raised, so throttling never looks like an empty page.
+#
+# When a host throttles us its token bucket rate is halved, and it creeps back up by 1% of the
+# configured rate per successful request (AIMD), so long runs settle just under the limit.
+#
+# Tunables (env vars):
+#   HTTP_RATE_LIMIT_RPS      requests per second per host (default 0 = unlimited until the host throttles us)
+#   HTTP_RATE_LIMIT_BURST    token bucket size (default max(1, HTTP_RATE_LIMIT_RPS))
+#   HTTP_MAX_INFLIGHT        concurrent requests per host from this process (default 8, 0 = unlimited)
+#   HTTP_MAX_RETRIES         retries after the first attempt (default 5)
+#   HTTP_BACKOFF_BASE_S      first backoff, doubled per retry (default 0.5)
+#   HTTP_BACKOFF_MAX_S       backoff cap (default 30)
+
+import os
+import json
+import time
+import random
+import socket
+import threading
+import collections
+import http.client
+import urllib.error
+import urllib.parse
+
+rate_limit_rps = float(os.environ.get('HTTP_RATE_LIMIT_RPS', '0'))
+rate_limit_burst = float(os.environ.get('HTTP_RATE_LIMIT_BURST', '0')) or max(1.0, rate_limit_rps)
+max_inflight = int(os.environ.get('HTTP_MAX_INFLIGHT', '8'))
+max_retries = int(os.environ.get('HTTP_MAX_RETRIES', '5'))
+backoff_base_s = float(os.environ.get('HTTP_BACKOFF_BASE_S', '0.5'))
+backoff_max_s = float(os.environ.get('HTTP_BACKOFF_MAX_S', '30'))
+
+retryable_codes = [429, 500, 502, 503, 504]
+throttle_messages = ['too many requests', 'rate limit', 'throttl', 'exceeded the maximum']
+min_rate_rps = 0.2
+additive_increase = 0.01 # Fraction of the configured rate won back per successful request
+
+stats = {
+  'retries': 0,
+  'throttled': 0,
+  'exhausted': 0,
+  'rate_limit_waits_s': 0.0,
+}
+_stats_lock = threading.Lock() # stats are updated from every pool and trial thread
+
+def count_stat(key, amount=1):
+  with _stats_lock:
+    stats[key] += amount
+
+class RetryableError(Exception):
+  def __init__(self, message, retry_after_s=None, throttled=False):
+    super().__init__(message)
+    self.retry_after_s = retry_after_s
+    self.throttled = throttled
+
+class RetriesExhausted(Exception):
+  pass
+
+class HostLimiter:
+  def __init__(self, rps, burst, inflight):
+    self.configured_rps = rps
+    self.rps = rps
+    self.burst = burst
+    self.tokens = burst
+    self.refilled_s = time.monotonic()
+    self.lock = threading.Lock()
+    self.inflight = threading.BoundedSemaphore(inflight) if inflight > 0 else None
+    self.recent_s = collections.deque(maxlen=256) # Start times of recent requests, to find our rate when first throttled
+
+  def acquire_token(self):
+    while True:
+      with self.lock:
+        now_s = time.monotonic()
+        self.recent_s.append(now_s)
+        if self.rps <= 0:
+          return
+        self.tokens = min(self.burst, self.tokens + (now_s - self.refilled_s) * self.rps)
+        self.refilled_s = now_s
+        if self.tokens >= 1.0:
+          self.tokens -= 1.0
+          return
+        wait_s = (1.0 - self.tokens) / self.rps
+      count_stat('rate_limit_waits_s', wait_s)
+      time.sleep(wait_s)
+
+  def on_throttled(self):
+    with self.lock:
+      if self.rps <= 0:
+        # Unlimited so far: start from half the rate we were sending at over the last second
+        now_s = time.monotonic()
+        sent_last_s = sum(1 for t in self.recent_s if now_s - t < 1.0)
+        self.configured_rps = max(min_rate_rps, float(sent_last_s))
+        self.rps = self.configured_rps
+        self.burst = max(1.0, self.rps)
+        self.tokens = 0.0
+        self.refilled_s = now_s
+      self.rps = max(min_rate_rps, self.rps * 0.5)
+
+  def on_success(self):
+    with self.lock:
+      if self.rps > 0 and self.rps < self.configured_rps:
+        self.rps = min(self.configured_rps, self.rps + additive_increase * self.configured_rps)
+
+_limiters = dict() # netloc -> HostLimiter
+_limiters_lock = threading.Lock()
+
+def limiter_for(url):
+  netloc = urllib.parse.urlsplit(url).netloc.lower()
+  with _limiters_lock:
+    if not netloc in _limiters:
+      _limiters[netloc] = HostLimiter(rate_limit_rps, rate_limit_burst, max_inflight)
+    return _limiters[netloc]
+
+def limited(url, fn):
+  # Runs fn(release) once a token is available and an in-flight slot for the host is free. The slot is held
+  # until release() is called, so a response can keep it while its body is read; the slot is released here
+  # if fn raises. Calling release() more than once is harmless.
+  limiter = limiter_for(url)
+  limiter.acquire_token()
+  if limiter.inflight is None:
+    return fn(lambda: None)
+  limiter.inflight.acquire()
+  released = []
+  def release():
+    if len(released) < 1:
+      released.append(True)
+      limiter.inflight.release()
+  try:
+    return fn(release)
+  except BaseException:
+    release()
+    raise
+
+def arcgis_error(body):
+  # The "error" object of an ArcGIS error payload, or None. Cheap for normal (large or binary) bodies.
+  if body is None or len(body) > 64 * 1024 or body.lstrip()[:1] != b'{' or not b'"error"' in body[:256]:
+    return None
+  try:
+    resp_json = json.loads(body)
+  except ValueError:
+    return None
+  if isinstance(resp_json, dict) and isinstance(resp_json.get('error', None), dict):
+    return resp_json['error']
+  return None
+
+def is_retryable_error(error):
+  message = f'{error.get("message", "")} {" ".join(str(d) for d in error.get("details", None) or [])}'.casefold()
+  return error.get('code', None) in retryable_codes or any(m in message for m in throttle_messages)
+
+def raise_for_error(url, error):
+  # Raises RetryableError if an ArcGIS error object (from a body or a streamed response header) should be retried
+  if error is not None and is_retryable_error(error):
+    throttled = error.get('code', None) == 429 or any(m in str(error.get('message', '')).casefold() for m in throttle_messages)
+    raise RetryableError(f'{url} answered error {error.get("code", None)}: {error.get("message", "")}', throttled=throttled)
+
+def backoff_s(attempt, retry_after_s=None):
+  # Full jitter: uniform in [0, min(cap, base * 2^attempt)], but never sooner than Retry-After
+  delay_s = random.uniform(0, min(backoff_max_s, backoff_base_s * (2 ** attempt)))
+  if retry_after_s is not None:
+    delay_s = max(delay_s, min(backoff_max_s, retry_after_s))
+  return delay_s
+
+def _retry_after_s(headers):
+  try:
+    return float(headers.get('Retry-After', None))
+  except (TypeError, ValueError, AttributeError):
+    return None
+
+def retry(url, fn):
+  # Calls fn() until it succeeds, retrying transient failures with backoff; RetriesExhausted when they persist
+  limiter = limiter_for(url)
+  for attempt in range(0, max_retries + 1):
+    try:
+      result = fn()
+      limiter.on_success()
+      return result
+    except urllib.error.HTTPError as e:
+      if not e.code in retryable_codes:
+        raise
+      last_error = e
+      retry_after_s = _retry_after_s(e.headers)
+      throttled = e.code in (429, 503)
+    except RetryableError as e:
+      last_error = e
+      retry_after_s = e.retry_after_s
+      throttled = e.throttled
+    except (ConnectionError, socket.timeout, TimeoutError, http.client.HTTPException, urllib.error.URLError) as e:
+      last_error = e
+      retry_after_s = None
+      throttled = False
+    if throttled:
+      count_stat('throttled')
+      limiter.on_throttled()
+    if attempt >= max_retries:
+      break
+    count_stat('retries')
+    time.sleep(backoff_s(attempt, retry_after_s))
+  count_stat('exhausted')
+  raise RetriesExhausted(f'Giving up on {url} after {max_retries + 1} attempts: {last_error}') from last_error
@@ -0,0 +1,198 @@
+# Per-request timing: DNS, connect, TLS, time to first byte, download and parse, plus bytes and
+# feature count, for every query the harness makes.
+#
+# Query functions wrap their work in `with request_timing.span(name, url) as s:` and call
+# s.parsed(num_features) once the response is decoded; http_pool fills in the network phases
+# of every request made inside the span (summed if a span makes several, e.g. redirects).
+# Spans are opened per attempt inside request_scheduler.retry, so backoff sleeps are not timed; an
+# attempt that raised (and may be retried) is recorded with failed=True.
+# DNS / connect / TLS are only non-zero when a new connection had to be opened.
+# Requests sent by the arcgis package do not go through http_pool, their spans only have
+# total_s, bytes are unknown and the parse phase covers everything after the HTTP response.
+#
+# bytes is what came over the wire, decoded_bytes the body after gzip / deflate / br decoding.
+#
+# Finished spans are not kept for the life of the process: jsonl records are written as they finish and
+# only the running `totals` are kept, chrome traces buffer `records` until exit. Code that wants the
+# spans of one piece of work wraps it in `with request_timing.collect() as span_records:`.
+#
+# Tunables (env vars):
+#   REQUEST_TIMING_TO       file to write timings to (unset disables timing)
+#   REQUEST_TIMING_FORMAT   jsonl (one record per line, written as requests finish) or chrome
+#                           (a chrome://tracing / Perfetto trace written at exit); defaults to
+#                           chrome when REQUEST_TIMING_TO ends in .json, jsonl otherwise
+
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+timing_file = os.environ.get('REQUEST_TIMING_TO', '')
+timing_format = os.environ.get('REQUEST_TIMING_FORMAT', '') or ('chrome' if timing_file.endswith('.json') else 'jsonl')
+enabled = len(timing_file) > 0
+
+phase_names = ['dns_s', 'connect_s', 'tls_s', 'ttfb_s', 'download_s', 'parse_s']
+
+records = [] # Every finished span as a dict, in finish order; only kept for the chrome format
+_records_lock = threading.Lock()
+_collectors = [] # Lists filled by active collect() blocks
+_local = threading.local()
+_origin_s = time.perf_counter()
+_jsonl_fd = None
+
+class Span:
+  def __init__(self, name, url):
+    self.name = name
+    self.url = url
+    self.begin_s = time.perf_counter()
+    self.phases = {p: 0.0 for p in phase_names}
+    self.num_bytes = 0
+    self.num_decoded_bytes = 0
+    self.num_http_requests = 0
+    self.num_features = None
+    self.failed = False
+    self._http_end_s = None
+
+  def add_http(self, timings, num_bytes, num_decoded_bytes=None):
+    for p, v in timings.items():
+      self.phases[p] += v
+    self.num_bytes += num_bytes
+    self.num_decoded_bytes += num_decoded_bytes if num_decoded_bytes is not None else num_bytes
+    self.num_http_requests += 1
+    self._http_end_s = time.perf_counter()
+
+  def parsed(self, num_features=None):
+    now_s = time.perf_counter()
+    self.phases['parse_s'] += now_s - (self._http_end_s if self._http_end_s is not None else self.begin_s)
+    self.num_features = num_features
+
+  def as_record(self, end_s):
+    return {
+      'name': self.name,
+      'url': self.url,
+      'thread': threading.current_thread().name,
+      'begin_s': self.begin_s - _origin_s,
+      'total_s': end_s - self.begin_s,
+      **self.phases,
+      'bytes': self.num_bytes if self.num_http_requests > 0 else None,
+      'decoded_bytes': self.num_decoded_bytes if self.num_http_requests > 0 else None,
+      'http_requests': self.num_http_requests,
+      'features': self.num_features,
+      'failed': self.failed,
+    }
+
+class _NullSpan:
+  def parsed(self, num_features=None):
+    pass
+
+_null_span = _NullSpan()
+
+@contextlib.contextmanager
+def span(name, url):
+  if not enabled:
+    yield _null_span
+    return
+  s = Span(name, url)
+  parent = getattr(_local, 'span', None)
+  _local.span = s
+  try:
+    yield s
+  except BaseException:
+    s.failed = True # e.g. an attempt that will be retried
+    raise
+  finally:
+    _local.span = parent
+    _finish(s.as_record(time.perf_counter()))
+
+@contextlib.contextmanager
+def collect():
+  # Yields a list that receives every span finished inside the block (on any thread)
+  span_records = []
+  with _records_lock:
+    _collectors.append(span_records)
+  try:
+    yield span_records
+  finally:
+    with _records_lock:
+      _collectors.remove(span_records)
+
+def add_http(timings, num_bytes, num_decoded_bytes=None):
+  # Called by http_pool when a response is closed
+  s = getattr(_local, 'span', None)
+  if s is not None:
+    s.add_http(timings, num_bytes, num_decoded_bytes)
+
+def _finish(record):
+  global _jsonl_fd
+  with _records_lock:
+    _add_to_summary(totals, record)
+    totals['spans'] += 1
+    for span_records in _collectors:
+      span_records.append(record)
+    if timing_format == 'chrome':
+      records.append(record)
+    if timing_format == 'jsonl':
+      if _jsonl_fd is None:
+        _jsonl_fd = open(timing_file, 'w')
+      _jsonl_fd.write(json.dumps(record))
+      _jsonl_fd.write('\n')
+
+def _empty_summary():
+  summary = {p: 0.0 for p in ['total_s'] + phase_names}
+  summary['bytes'] = 0
+  summary['decoded_bytes'] = 0
+  summary['features'] = 0
+  return summary
+
+def _add_to_summary(summary, r):
+  for p in ['total_s'] + phase_names:
+    summary[p] += r[p]
+  summary['bytes'] += r['bytes'] or 0
+  summary['decoded_bytes'] += r.get('decoded_bytes', None) or r['bytes'] or 0
+  summary['features'] += r['features'] or 0
+
+def summarize(span_records):
+  # Summed phases, bytes and features over the given records
+  summary = _empty_summary()
+  for r in span_records:
+    _add_to_summary(summary, r)
+  return summary
+
+totals = dict(_empty_summary(), spans=0) # summarize() of every span finished so far, plus their count
+
+def format_phases(r):
+  # Short one-line breakdown in milliseconds, for the per-page printout
+  parts = [ f'{p[:-2]}={r[p]*1000.0:.1f}ms' for p in phase_names if r[p] > 0 ]
+  decoded = f' decoded={r["decoded_bytes"]}' if r.get('decoded_bytes', None) not in (None, r['bytes']) else ''
+  return f'total={r["total_s"]*1000.0:.1f}ms ' + ' '.join(parts) + f' bytes={r["bytes"]}' + decoded
+
+def chrome_trace(span_records):
+  # Complete ("X") events: one per span, with its phases laid out back to back on the same thread
+  thread_ids = dict()
+  events = []
+  for r in span_records:
+    tid = thread_ids.setdefault(r['thread'], len(thread_ids) + 1)
+    begin_us = r['begin_s'] * 1e6
+    args = {k: r.get(k, None) for k in ('url', 'bytes', 'decoded_bytes', 'http_requests', 'features', 'failed')}
+    events.append({'name': r['name'], 'cat': 'request', 'ph': 'X', 'ts': begin_us, 'dur': r['total_s'] * 1e6, 'pid': os.getpid(), 'tid': tid, 'args': args})
+    phase_begin_us = begin_us
+    for p in phase_names:
+      if r[p] > 0:
+        events.append({'name': p[:-2], 'cat': 'phase', 'ph': 'X', 'ts': phase_begin_us, 'dur': r[p] * 1e6, 'pid': os.getpid(), 'tid': tid})
+        phase_begin_us += r[p] * 1e6
+  for thread_name, tid in thread_ids.items():
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}})
+  return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def _write_at_exit():
+  with _records_lock:
+    if _jsonl_fd is not None:
+      _jsonl_fd.close()
+    if timing_format == 'chrome':
+      with open(timing_file, 'w') as fd:
+        json.dump(chrome_trace(records), fd)
+
+if enabled:
+  atexit.register(_write_at_exit)
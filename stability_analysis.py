@@ -0,0 +1,126 @@
+# Q1-Q4 analysis of paginated results against the "expected" single big query.
+#
+# OIDs are held in compact int64 arrays (numpy when installed, array('q') otherwise) and every
+# question is answered with hashing or sorting instead of list membership tests, so the
+# analysis stays near-linear on layers with hundreds of thousands of features.
+#
+# On top of the yes/no questions two ordering-distance metrics describe how far the paged
+# order drifted from the expected order, over the OIDs present in both:
+#   kendall_tau       1.0 = identical order, -1.0 = fully reversed
+#   inversions        number of OID pairs the pages returned in the wrong relative order
+#   lis_fraction      longest run of OIDs (not necessarily adjacent) already in expected order,
+#                     as a fraction of the common OIDs; 1.0 = nothing needs to move
+
+import array
+import bisect
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def to_oid_array(oids):
+  if numpy is not None:
+    return numpy.fromiter(oids, dtype=numpy.int64)
+  return array.array('q', oids)
+
+def flatten_pages(pages_of_oids):
+  return to_oid_array(oid for page in pages_of_oids for oid in page)
+
+def count_inversions(values):
+  # Pairs i < j with values[i] > values[j], via a Fenwick tree over value ranks: O(n log n)
+  n = len(values)
+  if n < 2:
+    return 0
+  ranks = {v: i + 1 for i, v in enumerate(sorted(set(values)))}
+  tree = [0] * (len(ranks) + 1)
+  inversions = 0
+  for seen, v in enumerate(values):
+    r = ranks[v]
+    # Count already-seen values <= v, everything else seen so far is an inversion with v
+    le = 0
+    i = r
+    while i > 0:
+      le += tree[i]
+      i -= i & -i
+    inversions += seen - le
+    i = r
+    while i < len(tree):
+      tree[i] += 1
+      i += i & -i
+  return inversions
+
+def longest_increasing_subsequence_len(values):
+  tails = []
+  for v in values:
+    i = bisect.bisect_left(tails, v)
+    if i == len(tails):
+      tails.append(v)
+    else:
+      tails[i] = v
+  return len(tails)
+
+def ordering_distance(expected_oids, deduped_oids):
+  expected_pos = {oid: i for i, oid in enumerate(expected_oids)}
+  positions = [ expected_pos[oid] for oid in deduped_oids if oid in expected_pos ]
+  n = len(positions)
+  inversions = count_inversions(positions)
+  num_pairs = n * (n - 1) // 2
+  return {
+    'common_oids': n,
+    'inversions': inversions,
+    'kendall_tau': 1.0 - (2.0 * inversions / num_pairs) if num_pairs > 0 else 1.0,
+    'lis_fraction': longest_increasing_subsequence_len(positions) / n if n > 0 else 1.0,
+  }
+
+def _analyze_numpy(expected, flattened):
+  uniq, first_idx, counts = numpy.unique(flattened, return_index=True, return_counts=True)
+  first_seen_order = numpy.argsort(first_idx, kind='stable')
+  deduped = flattened[numpy.sort(first_idx)]
+  dup_mask = counts[first_seen_order] > 1
+  duplicates = list(zip(uniq[first_seen_order][dup_mask].tolist(), counts[first_seen_order][dup_mask].tolist()))
+  missing = expected[~numpy.isin(expected, uniq)].tolist()
+  unexpected = flattened[~numpy.isin(flattened, expected)].tolist()
+  n = min(len(expected), len(deduped))
+  mismatch_idx = numpy.nonzero(expected[:n] != deduped[:n])[0]
+  order_mismatches = [ (int(i), int(expected[i]), int(deduped[i])) for i in mismatch_idx ]
+  return uniq, deduped, duplicates, missing, unexpected, order_mismatches
+
+def _analyze_python(expected, flattened):
+  counts = dict()
+  for oid in flattened:
+    counts[oid] = counts.get(oid, 0) + 1
+  deduped = array.array('q', counts.keys()) # dicts keep first-seen order
+  duplicates = [ (oid, c) for oid, c in counts.items() if c > 1 ]
+  missing = [ oid for oid in expected if not oid in counts ]
+  expected_set = set(expected)
+  unexpected = [ oid for oid in flattened if not oid in expected_set ]
+  order_mismatches = [ (i, e, d) for i, (e, d) in enumerate(zip(expected, deduped)) if e != d ]
+  return deduped, deduped, duplicates, missing, unexpected, order_mismatches
+
+def analyze(expected_oids, pages_of_oids):
+  # Returns a dict with:
+  #   flattened          every returned OID in page order
+  #   deduped            flattened with repeats removed (first occurrence kept)
+  #   unique             the distinct returned OIDs
+  #   duplicates         [(oid, times_returned)] for OIDs returned more than once, first-seen order   (Q1)
+  #   missing            expected OIDs not returned by any page, expected order                       (Q2)
+  #   unexpected         returned OIDs absent from the expected query, one entry per occurrence       (Q3)
+  #   order_mismatches   [(position, expected_oid, deduped_oid)] where the orders differ              (Q4)
+  #   ordering           ordering_distance() metrics
+  expected = to_oid_array(expected_oids)
+  flattened = flatten_pages(pages_of_oids)
+  if numpy is not None:
+    unique, deduped, duplicates, missing, unexpected, order_mismatches = _analyze_numpy(expected, flattened)
+  else:
+    unique, deduped, duplicates, missing, unexpected, order_mismatches = _analyze_python(expected, flattened)
+  return {
+    'flattened': flattened,
+    'deduped': deduped,
+    'unique': unique,
+    'duplicates': duplicates,
+    'missing': missing,
+    'unexpected': unexpected,
+    'order_mismatches': order_mismatches,
+    'ordering': ordering_distance(expected.tolist(), deduped.tolist()),
+  }
@@ -0,0 +1,81 @@
+# Repeated-trial engine for stability tests: runs the same pagination several times concurrently,
+# compares cheap fingerprints of each run and stops as soon as one differs (unstable) or enough
+# runs agree that an unstable polygon would most likely have shown a difference by now (stable).
+#
+# The number of agreeing trials needed comes from a simple model: if an unstable polygon made a
+# trial differ from the first one with probability at least STABILITY_MISMATCH_RATE, then n - 1
+# agreeing repeats happen by chance with probability (1 - rate)^(n - 1); we stop once that is
+# below 1 - STABILITY_CONFIDENCE. Defaults (0.9, 0.5) need 5 trials, capped at STABILITY_MAX_TRIALS.
+#
+# Tunables (env vars):
+#   STABILITY_CONFIDENCE      confidence to reach before calling a polygon stable (default 0.9)
+#   STABILITY_MISMATCH_RATE   smallest per-trial mismatch rate we want to catch (default 0.5)
+#   STABILITY_MAX_TRIALS      upper bound on trials per polygon, first one included (default 7)
+#   STABILITY_TRIAL_WORKERS   trials run at once (default 4)
+
+import os
+import math
+import hashlib
+import threading
+import concurrent.futures
+
+confidence = float(os.environ.get('STABILITY_CONFIDENCE', '0.9'))
+mismatch_rate = float(os.environ.get('STABILITY_MISMATCH_RATE', '0.5'))
+max_trials = int(os.environ.get('STABILITY_MAX_TRIALS', '7'))
+trial_workers = int(os.environ.get('STABILITY_TRIAL_WORKERS', '4'))
+
+def fingerprint(oids):
+  # (count, hash of the sorted OID set): equal fingerprints mean the same features came back
+  h = hashlib.sha256()
+  for oid in sorted(oids):
+    h.update(str(oid).encode('utf-8'))
+    h.update(b',')
+  return (len(oids), h.hexdigest()[:16])
+
+def trials_needed(target_confidence=None, min_mismatch_rate=None, trial_limit=None):
+  target_confidence = target_confidence if target_confidence is not None else confidence
+  min_mismatch_rate = min_mismatch_rate if min_mismatch_rate is not None else mismatch_rate
+  trial_limit = trial_limit if trial_limit is not None else max_trials
+  if target_confidence <= 0 or min_mismatch_rate >= 1.0:
+    return min(trial_limit, 2)
+  if target_confidence >= 1.0 or min_mismatch_rate <= 0:
+    return trial_limit
+  repeats = math.ceil(math.log(1.0 - target_confidence) / math.log(1.0 - min_mismatch_rate))
+  return max(2, min(trial_limit, 1 + repeats))
+
+class TrialResult:
+  def __init__(self, stable, fingerprints, mismatch_trial=None):
+    self.stable = stable
+    self.fingerprints = fingerprints # Finished trials in finish order, first one is the reference
+    self.mismatch_trial = mismatch_trial # Index into fingerprints of the first differing trial
+
+  @property
+  def num_trials(self):
+    return len(self.fingerprints)
+
+def run_trials(trial_fn, num_trials=None, max_workers=None, on_trial=None):
+  # trial_fn(stop_event) runs one trial and returns its fingerprint, or None if it noticed
+  # stop_event and gave up early. on_trial(fingerprint) is called as each trial finishes.
+  num_trials = num_trials if num_trials is not None else trials_needed()
+  max_workers = max(1, min(num_trials, max_workers if max_workers is not None else trial_workers))
+  stop_event = threading.Event()
+  fingerprints = []
+  mismatch_trial = None
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [ executor.submit(trial_fn, stop_event) for _ in range(0, num_trials) ]
+    try:
+      for future in concurrent.futures.as_completed(futures):
+        fp = future.result()
+        if fp is None:
+          continue
+        fingerprints.append(fp)
+        if on_trial is not None:
+          on_trial(fp)
+        if fp != fingerprints[0]:
+          mismatch_trial = len(fingerprints) - 1
+          break
+    finally:
+      stop_event.set()
+      for future in futures:
+        future.cancel()
+  return TrialResult(mismatch_trial is None, fingerprints, mismatch_trial)
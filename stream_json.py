@@ -0,0 +1,103 @@
+# Incremental decoding of ArcGIS query responses.
+#
+# A query response is one JSON object whose bulk is a single top-level array ("features" or
+# "objectIds"). iter_top_level_array() reads the response body in chunks and yields that
+# array's items one at a time as they arrive, decoding each item on its own, so the full
+# document is never held in memory. Every other top-level key (objectIdFieldName,
+# exceededTransferLimit, error, ...) is decoded normally and stored in the `header` dict.
+
+import json
+import codecs
+
+default_chunk_size = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+class _Reader:
+  def __init__(self, fp, chunk_size):
+    self.fp = fp
+    self.chunk_size = chunk_size
+    self.utf8 = codecs.getincrementaldecoder('utf-8')()
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self):
+    # Drops the consumed prefix and appends the next chunk; returns False at end of input
+    if self.eof:
+      return False
+    chunk = self.fp.read(self.chunk_size)
+    if len(chunk) < 1:
+      self.eof = True
+      self.buf = self.buf[self.pos:] + self.utf8.decode(b'', final=True)
+    else:
+      self.buf = self.buf[self.pos:] + self.utf8.decode(chunk)
+    self.pos = 0
+    return True
+
+  def peek(self):
+    # Next non-whitespace character without consuming it, None at end of input
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.fill():
+        return None
+
+  def expect(self, c):
+    if self.peek() != c:
+      raise ValueError(f'Expected {c!r} at {self.buf[self.pos:self.pos+40]!r}')
+    self.pos += 1
+
+  def value(self):
+    # Decodes one complete JSON value, reading more input until it is complete
+    self.peek()
+    while True:
+      try:
+        value, end = _decoder.raw_decode(self.buf, self.pos)
+        # A number at the very end of the buffer may continue in the next chunk
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except json.JSONDecodeError:
+        if self.eof:
+          raise
+      self.fill()
+
+def iter_top_level_array(fp, array_key, header=None, chunk_size=default_chunk_size):
+  # Yields the items of the top-level array `array_key` of the JSON object read from fp.
+  # Other top-level keys land in `header`; header[array_key] is set to None (the items were
+  # streamed, not kept) when the key was present.
+  if header is None:
+    header = dict()
+  r = _Reader(fp, chunk_size)
+  r.expect('{')
+  if r.peek() == '}':
+    return
+  while True:
+    key = r.value()
+    r.expect(':')
+    if key == array_key and r.peek() == '[':
+      header[array_key] = None
+      r.expect('[')
+      if r.peek() == ']':
+        r.pos += 1
+      else:
+        while True:
+          yield r.value()
+          c = r.peek()
+          r.pos += 1
+          if c == ']':
+            break
+          if c != ',':
+            raise ValueError(f'Expected , or ] in {array_key} array, got {c!r}')
+    else:
+      header[key] = r.value()
+    c = r.peek()
+    r.pos += 1
+    if c == '}':
+      return
+    if c != ',':
+      raise ValueError(f'Expected , or }} after top-level key {key!r}, got {c!r}')
@@ -2,6 +2,7 @@
 # requires-python = ">=3.9"
 # dependencies = [
 #   "shapely>=2.0.7",
+#   "numpy>=1.21",
 #   "pyproj>=2.3.0",
 #   "arcgis>=2.4.0"
 # ]
@@ -10,36 +11,44 @@
 
 import os
 import sys
-import urllib.request
 import urllib.parse
 import random
-import json
-import traceback
-import pyproj
 import shapely.geometry
 import time
+import concurrent.futures
 
-import arcgis.gis
-import arcgis.geometry
+# arcgis and pyproj are imported on first use through backends.py
+
+import http_pool
+import backends
+import stability_analysis
+import geometry_selection
+import request_timing
+import adaptive_paging
+import feature_service
+import candidate_polygons
 
 if len(os.environ.get('LOG_URLS_TO', '')) > 0:
   import http
   import http.client
+  import atexit
+  import threading
   log_urls_file = os.environ.get('LOG_URLS_TO', '')
 
   def patch_send():
       if os.path.exists(log_urls_file):
         os.remove(log_urls_file)
 
+      # One handle for the whole run instead of an open() per send(); closed (and flushed) at exit
+      log_fd = open(log_urls_file, 'a')
+      log_lock = threading.Lock()
+      atexit.register(log_fd.close)
+
       old_send = http.client.HTTPConnection.send
       def new_send(self, data):
-          with open(log_urls_file, 'a') as fd:
-            fd.write(f'{"-"*9} BEGIN REQUEST {"-"*9}')
-            fd.write('\n')
-            fd.write(data.decode('utf-8').strip())
-            fd.write('\n')
-            fd.write(f'{"-"*10} END REQUEST {"-"*10}')
-            fd.write('\n')
+          data_txt = data.decode('utf-8', errors='replace') if isinstance(data, (bytes, bytearray)) else str(data)
+          with log_lock:
+            log_fd.write(f'{"-"*9} BEGIN REQUEST {"-"*9}\n{data_txt.strip()}\n{"-"*10} END REQUEST {"-"*10}\n')
           return old_send(self, data)
       http.client.HTTPConnection.send = new_send
 
@@ -52,6 +61,15 @@ if len(os.environ.get('LOG_URLS_TO', '')) > 0:
 else:
   print(f'LOG_URLS_TO is unset, pass a file path to record all outgoing HTTP requests')
 
+# RANDOM_SEED=N makes test geometry and page sizes repeat between runs, so with HTTP_REPLAY_DB set
+# (see replay_cache.py) a rerun sends the same requests and is answered from the recording.
+if len(os.environ.get('RANDOM_SEED', '')) > 0:
+  random.seed(int(os.environ['RANDOM_SEED']))
+  print(f'RANDOM_SEED is set, seeded random with {os.environ["RANDOM_SEED"]}')
+
+if http_pool.replay_store is not None:
+  print(f'HTTP_REPLAY_DB is set, {http_pool.replay_store.mode} mode against {http_pool.replay_store.db_file}')
+
 
 server_urls = [ random.choice([
   # This one is an older server (10.91) which does not give stable paginated results
@@ -64,97 +82,38 @@ server_urls = [ random.choice([
   'https://energy.virginia.gov/gis/rest/services/DGMR/VA_Water_Wells/MapServer/0',
 ]) ]
 
-if len(sys.argv) > 1:
+# Only when run as a script: benchmark.py imports this module and its own arguments are not server URLs
+if __name__ == '__main__' and len(sys.argv) > 1:
   server_urls = sys.argv[1:]
 
 server_url = random.choice(server_urls)
 
-possible_oid_names = [
-  'objectid', 'OBJECTID', 'ObjectID', 'oid', 'OID', 'rowid'
-]
-server_oid_field_name = 'objectid'
+# Fallback area for random test geometry, replaced by the layer extent in the test loop
+min_x = feature_service.default_extent['xmin']
+max_y = feature_service.default_extent['ymax']
+max_x = feature_service.default_extent['xmax']
+min_y = feature_service.default_extent['ymin']
 
-min_x = -120.0
-max_y = 46.0
-max_x = -82.0
-min_y = 32.0
+def area_of_wgs84_in_km2(g):
+  return backends.geodesic().area_m2(g) / 1e6
 
-# triangle_radius_deg = 6.0
+# Per-layer state (OID field, extent, maxRecordCount, query format, pooled arcgis layers) lives in a
+# feature_service.FeatureServiceClient per layer URL; the functions below keep the server_url-first API.
 
-def area_of_wgs84_in_km2(g):
-  geod = pyproj.Geod(ellps='WGS84')
-  return abs(geod.geometry_area_perimeter(g)[0])
-
-def gen_rand_points(num_points=3):
-  global min_x, max_x, min_y, max_y
-  rp = (random.uniform(min_x, max_x), random.uniform(min_y, max_y))
-  triangle_radius_deg = abs(max_x - min_x) / 4.0 # Make the triangles approx 1/4 by 1/4 in size, so querying approx 1/16th of data or so.
-  pts = []
-  for i in range(0, num_points):
-    pts.append(
-        (rp[0] + random.uniform(-triangle_radius_deg, triangle_radius_deg),
-         rp[1] + random.uniform(-triangle_radius_deg, triangle_radius_deg)))
-  return pts
+def client(server_url):
+  return feature_service.client_for(server_url)
 
 def read_server_version(query_url):
-  # We just read up 1 directory until we get JSON w/'currentVersion' key
-  up_one_url = query_url.split('?')[0]
-  for i in range(0, 6):
-    up_one_url = '/'.join(up_one_url.split('/')[:-1])
-    try:
-      req = urllib.request.Request(up_one_url+'?f=pjson')
-      resp = urllib.request.urlopen(req)
-      resp_txt = resp.read()
-      resp_json = json.loads(resp_txt)
-      if 'currentVersion' in resp_json:
-        return resp_json['currentVersion']
-    except:
-      traceback.print_exc()
-  return -0.0
+  return client(query_url).version
 
 def read_fc_extent(query_url):
-  query_url = query_url.split('?')[0]
-  if query_url.endswith('/query'):
-    query_url = '/'.join(query_url.split('/')[:-1])
-  try:
-    req = urllib.request.Request(query_url+'?f=pjson')
-    resp = urllib.request.urlopen(req)
-    resp_txt = resp.read()
-    resp_json = json.loads(resp_txt)
-    if 'extent' in resp_json:
-      return {
-        'xmin': resp_json['extent']['xmin'],
-        'xmax': resp_json['extent']['xmax'],
-        'ymin': resp_json['extent']['ymin'],
-        'ymax': resp_json['extent']['ymax'],
-      }
-  except:
-    traceback.print_exc()
-  return {
-    'xmin': min_x,
-    'xmax': max_x,
-    'ymin': min_y,
-    'ymax': max_y,
-  }
+  return client(query_url).extent
 
 def read_fc_oid_field(query_url):
-  global server_oid_field_name
-  query_url = query_url.split('?')[0]
-  if query_url.endswith('/query'):
-    query_url = '/'.join(query_url.split('/')[:-1])
-  try:
-    req = urllib.request.Request(query_url+'?f=pjson')
-    resp = urllib.request.urlopen(req)
-    resp_txt = resp.read()
-    resp_json = json.loads(resp_txt)
-    if 'fields' in resp_json:
-      for field in resp_json['fields']:
-        if field.get('type', 'UNK').casefold() == 'esriFieldTypeOID'.casefold():
-          return field.get('name', field.get('alias', server_oid_field_name))
-
-  except:
-    traceback.print_exc()
-  return server_oid_field_name
+  return client(query_url).oid_field
+
+def read_fc_max_record_count(query_url):
+  return client(query_url).max_record_count
 
 def tf_to_yn(tf):
   if tf:
@@ -162,192 +121,64 @@ def tf_to_yn(tf):
   else:
     return 'No'
 
-def read_oid(f):
-  if isinstance(f, arcgis.features.Feature):
-    f = f.as_dict
+read_oid = feature_service.read_oid
+read_oid_field = feature_service.read_oid_field
+query_format_setting = feature_service.query_format_setting
+use_streaming_json = feature_service.use_streaming_json
 
-  if 'attributes' in f:
-    for possible_oid_name in possible_oid_names:
-      if possible_oid_name in f['attributes']:
-        return f['attributes'][possible_oid_name]
-    raise Exception(f'No ObjectID found in f={f}')
-  else:
-    for possible_oid_name in possible_oid_names:
-      if possible_oid_name in f:
-        return f[possible_oid_name]
-    raise Exception(f'No ObjectID found in f={f}')
-
-def read_oid_field(f):
-  if 'attributes' in f:
-    for possible_oid_name in possible_oid_names:
-      if possible_oid_name in f['attributes']:
-        return possible_oid_name
-    raise Exception(f'No ObjectID found in f={f}')
-  else:
-    for possible_oid_name in possible_oid_names:
-      if possible_oid_name in f:
-        return possible_oid_name
-    raise Exception(f'No ObjectID found in f={f}')
+def query_format(server_url):
+  return client(server_url).query_format
 
+def query_feature_page(server_url, a_polygon, resultOffset=0, resultRecordCount=4, where=None):
+  return client(server_url).query_feature_page(a_polygon, resultOffset=resultOffset, resultRecordCount=resultRecordCount, where=where)
 
-last_feature_page_json = None
-def query_feature_page(server_url, a_polygon, resultOffset=0, resultRecordCount=4):
-  global last_feature_page_json, server_oid_field_name
-  if a_polygon is None:
-    return []
-  if hasattr(a_polygon, 'exterior'):
-    coords = [pt for pt in a_polygon.exterior.coords]
-  else:
-    coords = a_polygon
-  json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [coords]}
-  data = urllib.parse.urlencode({
-      'geometry': json.dumps(json_query_g),
-      'geometryType': 'esriGeometryPolygon',
-      'outFields': '*',
-      'returnGeometry': True,
-      'orderByFields': f'{server_oid_field_name} DESC',
-      # 'returnDistinctValues': 'true', # Cannot use in a Geometry query -_-
-      'resultOffset': resultOffset,
-      'resultRecordCount': resultRecordCount,
-      'f': 'pjson',
-  }).encode()
-  req = urllib.request.Request(
-      server_url,
-      data=data)
-  resp = urllib.request.urlopen(req)
-  resp_txt = resp.read()
-  resp_json = json.loads(resp_txt)
-  last_feature_page_json = resp_json # Save off for any reporting we want to do
-  # We return a list of objectids
-  if not 'features' in resp_json:
-    if not isinstance(resp_txt, str):
-      resp_txt = resp_txt.decode('utf-8')
-    if not isinstance(data, str):
-      data = data.decode('utf-8')
-    print(f'WARNING ERROR JSON:\n{resp_txt}\n^^ query data={data}\n')
-    return []
-  return [ read_oid(f) for f in resp_json['features'] ]
-
-def query_feature_page_arcgis(server_url, a_polygon, resultOffset=0, resultRecordCount=4):
-  global last_feature_page_json, server_oid_field_name
-  if a_polygon is None:
-    return []
-  if hasattr(a_polygon, 'exterior'):
-    coords = [pt for pt in a_polygon.exterior.coords]
-  else:
-    coords = a_polygon
-
-  json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [ coords ]}
-  arcgis_g = arcgis.geometry.Polygon(json_query_g)
-
-  fl_url = server_url
-  if fl_url.endswith('/query'):
-    fl_url = '/'.join(fl_url.split('/')[:-1])
-
-  arcgis_fl = arcgis.features.FeatureLayer(fl_url)
-
-  arcgis_result = arcgis_fl.query(
-    where='1=1',
-    geometry_filter=arcgis.geometry.filters.intersects(arcgis_g, sr=4326),
-    out_fields='*',
-    return_geometry=True,
-    order_by_fields=f'{server_oid_field_name} DESC',
-    result_offset=resultOffset,
-    result_record_count=resultRecordCount,
-    return_all_records=False # Must be set so result_record_count is respected
-  )
-  try:
-    page_oids = [ read_oid(f) for f in arcgis_result.features ]
-    #print(f'result_offset={resultOffset} result_record_count={resultRecordCount} - {page_oids}')
-    del arcgis_fl
-    return page_oids
-  except:
-    traceback.print_exc()
-    return []
+def query_feature_page_arcgis(server_url, a_polygon, resultOffset=0, resultRecordCount=4, where=None):
+  return client(server_url).query_feature_page_arcgis(a_polygon, resultOffset=resultOffset, resultRecordCount=resultRecordCount, where=where)
 
 def query_all_feature_oids(server_url, a_polygon):
-  global last_feature_page_json, server_oid_field_name
-  if a_polygon is None:
-    return []
-  if hasattr(a_polygon, 'exterior'):
-    coords = [pt for pt in a_polygon.exterior.coords]
-  else:
-    coords = a_polygon
-  json_query_g = {'spatialReference': {'wkid': 4326}, 'rings': [coords]}
-  data = urllib.parse.urlencode({
-      'geometry': json.dumps(json_query_g),
-      'geometryType': 'esriGeometryPolygon',
-      #'outFields': '*',
-      'returnGeometry': False,
-      'returnIdsOnly': True,
-      'orderByFields': f'{server_oid_field_name} DESC',
-      'f': 'pjson',
-  }).encode()
-  req = urllib.request.Request(
-      server_url,
-      data=data)
-  resp = urllib.request.urlopen(req)
-  resp_txt = resp.read()
-  resp_json = json.loads(resp_txt)
-  if not 'objectIds' in resp_json:
-    if not isinstance(resp_txt, str):
-      resp_txt = resp_txt.decode('utf-8')
-    if not isinstance(data, str):
-      data = data.decode('utf-8')
-    print(f'WARNING ERROR JSON:\n{resp_txt}\n^^ query data={data}\n')
-    return []
-
-  # Update if info available
-  server_oid_field_name = resp_json.get('objectIdFieldName', server_oid_field_name)
-
-  return resp_json['objectIds']
+  return client(server_url).query_all_feature_oids(a_polygon)
 
 def query_feature(server_url, feature_oid):
-  global last_feature_page_json, server_oid_field_name
-  data = urllib.parse.urlencode({
-      'outFields': '*',
-      'returnGeometry': True,
-      'where': f'{server_oid_field_name} = {feature_oid}',
-      'f': 'pjson',
-  }).encode()
-  req = urllib.request.Request(
-      server_url,
-      data=data)
-  resp = urllib.request.urlopen(req)
-  resp_txt = resp.read()
-  resp_json = json.loads(resp_txt)
-  last_feature_page_json = resp_json # Save off for any reporting we want to do
-  # We return a list of objectids
-  if not 'features' in resp_json:
-    if not isinstance(resp_txt, str):
-      resp_txt = resp_txt.decode('utf-8')
-    if not isinstance(data, str):
-      data = data.decode('utf-8')
-    print(f'WARNING ERROR JSON:\n{resp_txt}\n^^ query data={data}\n')
-    return []
-  if len(resp_json['features']) < 1:
-    return None
-  else:
-    return next(x for x in resp_json['features'])
+  return client(server_url).query_feature(feature_oid)
 
-def query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None):
-  global last_feature_page_json
+def query_features_by_oids(server_url, feature_oids):
+  return client(server_url).query_features_by_oids(feature_oids)
+
+def query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None, page_sizes=None, adaptive=False):
+  # adaptive=False reads random page sizes from page_sizes and stops after 6 empty pages in a row, for stability testing.
+  # adaptive=True is for throughput: the page size follows measured latency (adaptive_paging.py, up to maxRecordCount)
+  # and the harvest stops as soon as the returnCountOnly total has been received.
   if a_polygon is None:
     return []
   if query_feature_page_fn is None:
     query_feature_page_fn = query_feature_page
+  if page_sizes is None:
+    page_sizes = [4,5,6,7,8,9,10,11,12]
+  expected_count = None
+  page_sizer = None
+  if adaptive:
+    expected_count = geometry_selection.query_feature_count(server_url, a_polygon)
+    page_sizer = adaptive_paging.AdaptivePageSize(read_fc_max_record_count(server_url))
   allowed_zero_replies = 6
   result_offset = 0
   offset_and_len = list() # Tuple of (resultOffset, resultRecordCount)
   pages_of_oids = list()
   while allowed_zero_replies > 0:
-    result_record_count = random.choice([4,5,6,7,8,9,10,11,12])
+    if expected_count is not None and result_offset >= expected_count:
+      break
+    if page_sizer is not None:
+      result_record_count = page_sizer.next(remaining=expected_count - result_offset if expected_count is not None else None)
+    else:
+      result_record_count = random.choice(page_sizes)
+    page_begin_s = time.perf_counter()
     feature_page = query_feature_page_fn(
       server_url,
       a_polygon,
       resultOffset=result_offset,
       resultRecordCount=result_record_count # We select a random page size - when joined this should not make a difference if we're reading features 2-at-a-time, 3-at-a-time, etc.
     )
+    if page_sizer is not None:
+      page_sizer.observe(result_record_count, time.perf_counter() - page_begin_s)
     if len(feature_page) < 1:
       allowed_zero_replies -= 1
     else:
@@ -363,8 +194,123 @@ def query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None):
 
   return offset_and_len, pages_of_oids
 
-def double_query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None):
-  global last_feature_page_json
+def keyset_query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None, page_sizes=None):
+  # Pages by OID instead of resultOffset: every page is the first resultRecordCount features (OID DESC)
+  # with an OID below the smallest OID seen so far, so the server never has to skip rows and a page
+  # cannot shift when rows before it move. offset_and_len holds (number of OIDs received before the page, page size).
+  if a_polygon is None:
+    return []
+  if query_feature_page_fn is None:
+    query_feature_page_fn = query_feature_page
+  if page_sizes is None:
+    page_sizes = [4,5,6,7,8,9,10,11,12]
+  allowed_zero_replies = 6
+  num_received = 0
+  last_seen_oid = None
+  offset_and_len = list() # Tuple of (number of OIDs received so far, resultRecordCount)
+  pages_of_oids = list()
+  while allowed_zero_replies > 0:
+    result_record_count = random.choice(page_sizes)
+    where = '1=1' if last_seen_oid is None else f'{read_fc_oid_field(server_url)} < {last_seen_oid}'
+    feature_page = query_feature_page_fn(
+      server_url,
+      a_polygon,
+      resultOffset=0,
+      resultRecordCount=result_record_count,
+      where=where,
+    )
+    if len(feature_page) < 1:
+      allowed_zero_replies -= 1
+    else:
+      allowed_zero_replies = 6
+      # min() rather than the last item, so a page the server returned slightly out of order cannot make us re-read rows
+      last_seen_oid = min(feature_page)
+
+    pages_of_oids.append(feature_page)
+    offset_and_len.append(
+      (num_received, result_record_count)
+    )
+
+    num_received += len(feature_page)
+
+  return offset_and_len, pages_of_oids
+
+def polygon_parts(g):
+  # Polygons making up a (possibly multi-part, possibly collection) shapely geometry, empty and non-polygon parts dropped
+  if g.is_empty:
+    return []
+  if g.geom_type == 'Polygon':
+    return [g]
+  if hasattr(g, 'geoms'):
+    return [ part for sub_g in g.geoms for part in polygon_parts(sub_g) ]
+  return []
+
+def split_tile(tile, grid_size):
+  xmin, ymin, xmax, ymax = tile.bounds
+  cell_w = (xmax - xmin) / grid_size
+  cell_h = (ymax - ymin) / grid_size
+  cells = []
+  for row in range(0, grid_size):
+    for col in range(0, grid_size):
+      cell = shapely.geometry.box(xmin + col * cell_w, ymin + row * cell_h, xmin + (col + 1) * cell_w, ymin + (row + 1) * cell_h)
+      cells.extend(polygon_parts(tile.intersection(cell)))
+  return cells
+
+def tiled_query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None, grid_size=2, max_workers=4, max_depth=12, tile_record_count=None):
+  # Harvests a_polygon (or the whole layer extent when a_polygon is None) without resultOffset: the area is cut
+  # into a grid_size x grid_size grid of tiles fetched concurrently with one request each, and any tile that comes
+  # back full (tile_record_count features, maxRecordCount by default) is split again like a quadtree.
+  # Features on tile edges intersect several tiles, so every page only holds OIDs not already seen in an earlier page.
+  # Tiles still full at max_depth are paged with query_all_feature_pages.
+  # offset_and_len holds (number of OIDs received before the page, tile_record_count).
+  if query_feature_page_fn is None:
+    query_feature_page_fn = query_feature_page
+  if a_polygon is None:
+    extent = read_fc_extent(server_url)
+    a_polygon = shapely.geometry.box(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+  if tile_record_count is None:
+    tile_record_count = read_fc_max_record_count(server_url)
+
+  def fetch_tile(tile, depth):
+    if depth >= max_depth:
+      _, tile_pages = query_all_feature_pages(server_url, tile, query_feature_page_fn=query_feature_page_fn, page_sizes=[tile_record_count])
+      return tile, depth, [ oid for page in tile_pages for oid in page ], False
+    page = query_feature_page_fn(server_url, tile, resultOffset=0, resultRecordCount=tile_record_count)
+    return tile, depth, page, len(page) >= tile_record_count
+
+  seen_oids = set()
+  num_received = 0
+  offset_and_len = list() # Tuple of (number of OIDs received so far, tile_record_count)
+  pages_of_oids = list()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    pending = set( executor.submit(fetch_tile, tile, 0) for tile in split_tile(a_polygon, grid_size) )
+    while len(pending) > 0:
+      done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        tile, depth, page, is_full = future.result()
+        if is_full:
+          # Results were truncated, throw them away and query the four quarters instead
+          pending.update( executor.submit(fetch_tile, sub_tile, depth + 1) for sub_tile in split_tile(tile, 2) )
+          continue
+        new_oids = [ oid for oid in page if not oid in seen_oids ]
+        seen_oids.update(new_oids)
+        pages_of_oids.append(new_oids)
+        offset_and_len.append((num_received, tile_record_count))
+        num_received += len(new_oids)
+
+  return offset_and_len, pages_of_oids
+
+def check_harvest_complete(server_url, a_polygon, pages_of_oids):
+  # Compares harvested OIDs with returnIdsOnly for the same area, returns (missing_oids, unexpected_oids)
+  if a_polygon is None:
+    extent = read_fc_extent(server_url)
+    a_polygon = shapely.geometry.box(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+  all_oids = query_all_feature_oids(server_url, a_polygon)
+  harvested_oids = set( oid for page in pages_of_oids for oid in page )
+  all_oids_set = set(all_oids)
+  return [ oid for oid in all_oids if not oid in harvested_oids ], [ oid for oid in harvested_oids if not oid in all_oids_set ]
+
+def double_query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=None, batched=False, batch_size=None, max_workers=4):
   if a_polygon is None:
     return []
   if query_feature_page_fn is None:
@@ -375,14 +321,37 @@ def double_query_all_feature_pages(server_url, a_polygon, query_feature_page_fn=
   offset_and_len = list() # Tuple of (resultOffset, resultRecordCount)
   pages_of_oids = list()
 
+  if batched:
+    # Fetch OIDs in chunks of up to maxRecordCount using objectIds= instead of one request per OID.
+    # Each chunk becomes one page, so offset_and_len holds (index of first OID in all_oids, chunk length).
+    if batch_size is None:
+      batch_size = read_fc_max_record_count(server_url)
+    batch_size = max(1, batch_size)
+    chunks = [ all_oids[i:i+batch_size] for i in range(0, len(all_oids), batch_size) ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      chunk_features = list(executor.map(lambda chunk: query_features_by_oids(server_url, chunk), chunks))
+
+    for chunk_i, chunk in enumerate(chunks):
+      returned_oids = set( client(server_url).read_oid(f) for f in chunk_features[chunk_i] )
+      # Rebuild the page in the order query_all_feature_oids gave us; OIDs the server did not return are left out
+      pages_of_oids.append([ oid for oid in chunk if oid in returned_oids ])
+      offset_and_len.append((chunk_i * batch_size, len(chunk)))
+
+    return offset_and_len, pages_of_oids
+
   for i in range(0, len(all_oids)):
     f = query_feature(server_url, all_oids[i])
-    pages_of_oids.append([read_oid(f)])
+    pages_of_oids.append([client(server_url).read_oid(f)])
     offset_and_len.append((i, 1))
 
   return offset_and_len, pages_of_oids
 
 if __name__ == '__main__':
+  parallel_servers = int(os.environ.get('PARALLEL_SERVERS', '0') or 0)
+  if parallel_servers > 1 and len(server_urls) > 1:
+    import parallel_runner
+    sys.exit(parallel_runner.run_servers(os.path.abspath(__file__), server_urls, parallel_servers))
+
   for server_url in server_urls:
     # Step 0: Report meta-data
     begin_s = time.time()
@@ -398,21 +367,39 @@ if __name__ == '__main__':
     min_y = fc_extent.get('ymin', min_y)
     print(f'min_x={min_x} max_x={max_x} min_y={min_y} max_y={max_y}')
     use_arcgis_pages = len(os.environ.get('USE_ARCGIS_PAGES', '')) > 0
-    print(f'USE_ARCGIS_PAGES = {use_arcgis_pages}\n    (when True, arcgis.features.FeatureLayer::query is used download the data. When False, urllib.request.Request downloads the data.)')
+    print(f'USE_ARCGIS_PAGES = {use_arcgis_pages}\n    (when True, arcgis.features.FeatureLayer::query is used download the data. When False, http_pool.fetch (keep-alive urllib) downloads the data.)')
     use_double_query = len(os.environ.get('USE_DOUBLE_QUERY', '')) > 0
+    use_keyset_pages = len(os.environ.get('USE_KEYSET_PAGES', '')) > 0
+    use_tiled_pages = len(os.environ.get('USE_TILED_PAGES', '')) > 0
+    use_adaptive_pages = len(os.environ.get('USE_ADAPTIVE_PAGES', '')) > 0
     print(f'USE_DOUBLE_QUERY = {use_double_query}\n    (when True, double_query_all_feature_pages combines the data. When False, query_all_feature_pages combines the data.)')
-
-    server_oid_field_name = read_fc_oid_field(server_url)
-    if not server_oid_field_name in possible_oid_names:
-      possible_oid_names.insert(0, server_oid_field_name)
-
-    # Step 1: Generate a triangle which, when queried for UP to 500 features returns at least 9 and less than 300.
-    g = None
-    while True:
-      num_features = len(query_feature_page(server_url, g, resultOffset=0, resultRecordCount=500))
-      if num_features > 9 and num_features < 90:
-        break
-      g = shapely.geometry.Polygon(gen_rand_points(3))
+    if not use_double_query:
+      print(f'USE_TILED_PAGES = {use_tiled_pages}\n    (when True, tiled_query_all_feature_pages fetches quadtree tiles of the test geometry concurrently, one request per tile.)')
+      print(f'USE_ADAPTIVE_PAGES = {use_adaptive_pages}\n    (when True, query_all_feature_pages sizes pages from measured latency up to maxRecordCount and stops once the returnCountOnly total is read. When False, random 4-12 feature pages until 6 empty pages.)')
+      print(f'USE_KEYSET_PAGES = {use_keyset_pages}\n    (when True, keyset_query_all_feature_pages pages with where=<OID field> < last seen OID. When False, query_all_feature_pages pages with resultOffset.)')
+    print(f'QUERY_FORMAT = {query_format_setting} (using f={query_format(server_url)})\n    (auto picks f=pbf when the layer advertises PBF, else compact f=json.)')
+    print(f'REQUEST_TIMING_TO = {request_timing.timing_file} ({request_timing.timing_format if request_timing.enabled else "disabled"})\n    (when set, DNS / connect / TLS / TTFB / download / parse times of every request are written there and shown per page below.)')
+    print(f'STREAM_JSON = {use_streaming_json}\n    (when True, query responses are decoded incrementally and only OIDs are kept. When False, the whole response is read and json.loads()ed.)')
+    payload_profile = client(server_url).payload_profile
+    print(f'PAGE_PAYLOAD = {payload_profile.describe(read_fc_oid_field(server_url))}\n    (what each page request asks for: full = every attribute + geometry, oid = only the OID field, fields = OID + PAGE_FIELDS. Only OIDs are compared, so smaller payloads should show the same instability.)')
+    use_batched_double_query = len(os.environ.get('USE_BATCHED_DOUBLE_QUERY', '')) > 0
+    if use_double_query:
+      print(f'USE_BATCHED_DOUBLE_QUERY = {use_batched_double_query}\n    (when True, double_query_all_feature_pages fetches features in maxRecordCount-sized objectIds= chunks. When False, one request per OID.)')
+
+    # Step 1: Generate a triangle which holds at least 10 and at most 89 features, using returnCountOnly probes sized from a density grid.
+    test_extent = {'xmin': min_x, 'xmax': max_x, 'ymin': min_y, 'ymax': max_y}
+    g, num_features, num_probes = geometry_selection.select_test_polygon(server_url, test_extent, min_features=10, max_features=89, num_points=3)
+    if g is None:
+      # Count probes did not converge (or returnCountOnly is unsupported), fall back to downloading pages of up to 500 features
+      print(f'WARNING: count-only geometry selection failed after {num_probes} probes, falling back to 500-record probes')
+      candidates = candidate_polygons.CandidatePool(test_extent, num_points=3)
+      while True:
+        g, _ = candidates.next()
+        num_features = len(query_feature_page(server_url, g, resultOffset=0, resultRecordCount=500))
+        if num_features > 9 and num_features < 90:
+          break
+    else:
+      print(f'Selected test geometry holding {num_features} features after {num_probes} count-only probes')
     print(f'Running test with random Geometry {g}')
     print(f'Test geometry is {int(area_of_wgs84_in_km2(g)):,} km^2 in area')
     print()
@@ -434,34 +421,55 @@ if __name__ == '__main__':
     # Step 3: Join pages together and do analysis on
     #   - do OIDS repeat?
     #   - Are OIDS omitted?
-    if use_double_query:
-      if use_arcgis_pages:
-        print(f'Querying pages using double_query_all_feature_pages + query_feature_page_arcgis')
-        offset_and_len, pages_of_oids = double_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis)
-      else:
-        print(f'Querying pages using double_query_all_feature_pages + query_feature_page')
-        offset_and_len, pages_of_oids = double_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page)
-    else:
-      if use_arcgis_pages:
-        print(f'Querying pages using query_all_feature_pages + query_feature_page_arcgis')
-        offset_and_len, pages_of_oids = query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis)
+    with request_timing.collect() as harvest_timings:
+      if use_double_query:
+        if use_arcgis_pages:
+          print(f'Querying pages using double_query_all_feature_pages + query_feature_page_arcgis')
+          offset_and_len, pages_of_oids = double_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis, batched=use_batched_double_query)
+        else:
+          print(f'Querying pages using double_query_all_feature_pages + query_feature_page')
+          offset_and_len, pages_of_oids = double_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page, batched=use_batched_double_query)
+      elif use_tiled_pages:
+        if use_arcgis_pages:
+          print(f'Querying pages using tiled_query_all_feature_pages + query_feature_page_arcgis')
+          offset_and_len, pages_of_oids = tiled_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis)
+        else:
+          print(f'Querying pages using tiled_query_all_feature_pages + query_feature_page')
+          offset_and_len, pages_of_oids = tiled_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page)
+        missing_oids, unexpected_oids = check_harvest_complete(server_url, g, pages_of_oids)
+        print(f'Tiled harvest completeness vs returnIdsOnly: {len(missing_oids)} missing, {len(unexpected_oids)} unexpected')
+      elif use_keyset_pages:
+        if use_arcgis_pages:
+          print(f'Querying pages using keyset_query_all_feature_pages + query_feature_page_arcgis')
+          offset_and_len, pages_of_oids = keyset_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis)
+        else:
+          print(f'Querying pages using keyset_query_all_feature_pages + query_feature_page')
+          offset_and_len, pages_of_oids = keyset_query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page)
       else:
-        print(f'Querying pages using query_all_feature_pages + query_feature_page')
-        offset_and_len, pages_of_oids = query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page)
+        if use_arcgis_pages:
+          print(f'Querying pages using query_all_feature_pages + query_feature_page_arcgis')
+          offset_and_len, pages_of_oids = query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page_arcgis, adaptive=use_adaptive_pages)
+        else:
+          print(f'Querying pages using query_all_feature_pages + query_feature_page')
+          offset_and_len, pages_of_oids = query_all_feature_pages(server_url, g, query_feature_page_fn=query_feature_page, adaptive=use_adaptive_pages)
+
+    # With REQUEST_TIMING_TO set, each page line gets its request's phase breakdown when pages map 1:1 to page requests
+    page_timings = [ r for r in harvest_timings if r['name'] in ('query_feature_page', 'query_feature_page_streaming', 'query_feature_page_arcgis', 'query_feature', 'query_features_by_oids') and not r.get('failed', False) ]
+    if len(page_timings) != len(pages_of_oids):
+      page_timings = []
 
     print(f'=== {len(pages_of_oids)} pages of oids returned ===')
     for i in range(0, min(len(pages_of_oids), len(offset_and_len)) ):
       print(f'  Requested begin at offset {offset_and_len[i][0]: <2}, return the next {offset_and_len[i][1]: <2} items, recived {len(pages_of_oids[i]): <2}: {pages_of_oids[i]}')
+      if i < len(page_timings):
+        print(f'      {request_timing.format_phases(page_timings[i])}')
+    if len(harvest_timings) > 0:
+      timing_summary = request_timing.summarize(harvest_timings)
+      print(f'Time in {len(harvest_timings)} requests: {request_timing.format_phases(timing_summary)} features={timing_summary["features"]}')
 
-    pages_of_oids_unique_oids = set()
-    flattened_returned_pages = list()
-    flattened_deduped_returned_pages = list()
-    for p in pages_of_oids:
-      for oid in p:
-        pages_of_oids_unique_oids.add(oid)
-        flattened_returned_pages.append(oid)
-        if not oid in flattened_deduped_returned_pages:
-          flattened_deduped_returned_pages.append(oid)
+    analysis = stability_analysis.analyze(expected_oids, pages_of_oids)
+    pages_of_oids_unique_oids = set(analysis['unique'].tolist())
+    flattened_deduped_returned_pages = analysis['deduped'].tolist()
 
     print(f'pages_of_oids_unique_oids({len(pages_of_oids_unique_oids)}) = {pages_of_oids_unique_oids}')
     print(f'flattened_deduped_returned_pages({len(flattened_deduped_returned_pages)}) = {flattened_deduped_returned_pages}')
@@ -475,44 +483,32 @@ if __name__ == '__main__':
 
     print()
     print('Q1: Are there duplicate OIDs?')
-    q1_is_true = False
-    oid_counts = dict()
-    for oid in flattened_returned_pages:
-      if not oid in oid_counts:
-        oid_counts[oid] = 0
-      oid_counts[oid] += 1
-
-    for oid, count in oid_counts.items():
-      if count > 1:
-        print(f'  Observation: {oid} was returned {count} times!')
-        q1_is_true = True
+    for oid, count in analysis['duplicates']:
+      print(f'  Observation: {oid} was returned {count} times!')
+    q1_is_true = len(analysis['duplicates']) > 0
     print(f'Q1 is {tf_to_yn(q1_is_true)} for {server_host}')
     print()
 
     print('Q2: Are there expected OIDs which were NOT returnd by the paginated query?')
-    q2_is_true = False
-    for e_oid in expected_oids:
-      if not e_oid in pages_of_oids_unique_oids:
-        print(f'  Observation: {e_oid} was NOT returned in the pages!')
-        q2_is_true = False
+    for e_oid in analysis['missing']:
+      print(f'  Observation: {e_oid} was NOT returned in the pages!')
+    q2_is_true = len(analysis['missing']) > 0
     print(f'Q2 is {tf_to_yn(q2_is_true)} for {server_host}')
     print()
 
     print('Q3: Are OIDs returned by the paginated query which were NOT expected OIDs?')
-    q3_is_true = False
-    for p_oid in flattened_returned_pages:
-      if not p_oid in expected_oids:
-        print(f'  Observation: {p_oid} returned in the pages but NOT in the initial large query which produced the expected results!')
-        q3_is_true = False
+    for p_oid in analysis['unexpected']:
+      print(f'  Observation: {p_oid} returned in the pages but NOT in the initial large query which produced the expected results!')
+    q3_is_true = len(analysis['unexpected']) > 0
     print(f'Q3 is {tf_to_yn(q3_is_true)} for {server_host}')
     print()
 
     print('Q4: Is the ordering different from the one big query to the combination of smaller queries? (We use flattened_deduped_returned_pages instead of flattened_returned_pages to answer this question)')
-    q4_is_true = False
-    for i in range(0, min(len(expected_oids), len(flattened_deduped_returned_pages))):
-      if expected_oids[i] != flattened_deduped_returned_pages[i]:
-        print(f'  Expected OID {expected_oids[i]} at position {i} but flattened_deduped_returned_pages[{i}] = {flattened_deduped_returned_pages[i]}')
-        q4_is_true = True
+    for i, e_oid, p_oid in analysis['order_mismatches']:
+      print(f'  Expected OID {e_oid} at position {i} but flattened_deduped_returned_pages[{i}] = {p_oid}')
+    q4_is_true = len(analysis['order_mismatches']) > 0
+    ordering = analysis['ordering']
+    print(f'  Ordering distance over {ordering["common_oids"]} common OIDs: kendall_tau={ordering["kendall_tau"]:.4f} inversions={ordering["inversions"]} lis_fraction={ordering["lis_fraction"]:.4f} (1.0 = same order)')
     print(f'Q4 is {tf_to_yn(q4_is_true)} for {server_host}')
     print()
 
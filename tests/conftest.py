@@ -0,0 +1,23 @@
+# The modules live flat in the repository root; tests import them from there.
+# Env-var tunables are read at import, so clear the ones that would make tests touch the
+# user's cache files or change the query format before any module is imported.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['LAYER_METADATA_CACHE'] = ''
+for name in ['HTTP_REPLAY_DB', 'REQUEST_TIMING_TO', 'STREAM_JSON', 'QUERY_FORMAT', 'HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy']:
+  os.environ.pop(name, None)
+
+@pytest.fixture(scope='module')
+def emulator():
+  # A small arcgis_emulator layer on a free port for the module's tests, yields its query URL
+  import arcgis_emulator
+  server, query_url = arcgis_emulator.serve_in_thread(arcgis_emulator.SyntheticLayer(num_features=500))
+  yield query_url
+  server.shutdown()
+  server.server_close()
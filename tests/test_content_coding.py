@@ -0,0 +1,99 @@
+import gzip
+import json
+import random
+import urllib.parse
+import zlib
+
+import pytest
+
+import arcgis_emulator
+import content_coding
+import http_pool
+
+body = json.dumps({'features': [ {'attributes': {'OBJECTID': i, 'NAME': f'feature {i}'}} for i in range(0, 500) ]}).encode()
+
+def decode_in_chunks(decoder, encoded, chunk_size):
+  return b''.join(decoder.decompress(encoded[i:i+chunk_size]) for i in range(0, len(encoded), chunk_size)) + decoder.flush()
+
+def deflate(data, wbits):
+  c = zlib.compressobj(6, zlib.DEFLATED, wbits)
+  return c.compress(data) + c.flush()
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 4096, 1 << 20])
+@pytest.mark.parametrize('content_encoding, encode', [
+  ('gzip', gzip.compress),
+  ('x-gzip', gzip.compress),
+  ('deflate', lambda data: deflate(data, zlib.MAX_WBITS)), # zlib wrapped, as the RFC says
+  ('deflate', lambda data: deflate(data, -zlib.MAX_WBITS)), # raw, as some servers send it
+])
+def test_decoders_round_trip(content_encoding, encode, chunk_size):
+  assert decode_in_chunks(content_coding.decoder_for(content_encoding), encode(body), chunk_size) == body
+
+def test_raw_and_zlib_deflate_told_apart_on_random_data():
+  rng = random.Random(3)
+  for i in range(0, 300):
+    data = bytes(rng.getrandbits(8) for _ in range(0, rng.randint(0, 64))) * rng.randint(1, 4)
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+      assert decode_in_chunks(content_coding.DeflateDecoder(), deflate(data, wbits), rng.choice([1, 2, 7])) == data
+
+@pytest.mark.skipif(content_coding.brotli is None, reason='brotli not installed')
+def test_brotli_round_trip():
+  assert decode_in_chunks(content_coding.decoder_for('br'), content_coding.brotli.compress(body), 3) == body
+
+def test_decoder_for():
+  assert content_coding.decoder_for(None) is None
+  assert content_coding.decoder_for('') is None
+  assert content_coding.decoder_for(' Identity ') is None
+  with pytest.raises(Exception):
+    content_coding.decoder_for('compress')
+
+def test_should_compress_request(monkeypatch):
+  monkeypatch.setattr(content_coding, 'compress_requests_over', 100)
+  monkeypatch.setattr(content_coding, '_plain_request_hosts', set())
+  assert not content_coding.should_compress_request('a.example', None)
+  assert not content_coding.should_compress_request('a.example', b'x' * 100)
+  assert content_coding.should_compress_request('a.example', b'x' * 101)
+  content_coding.reject_compressed_requests('a.example')
+  assert not content_coding.should_compress_request('a.example', b'x' * 101)
+  assert content_coding.should_compress_request('b.example', b'x' * 101)
+  assert gzip.decompress(content_coding.compress_request(body)) == body
+  monkeypatch.setattr(content_coding, 'compress_requests_over', 0)
+  assert not content_coding.should_compress_request('b.example', b'x' * 101)
+
+def serve(**kwargs):
+  return arcgis_emulator.serve_in_thread(arcgis_emulator.SyntheticLayer(num_features=300), **kwargs)
+
+def page_data():
+  # Long enough (the objectIds list) to be compressed once HTTP_COMPRESS_REQUESTS_OVER is set
+  object_ids = ','.join(str(oid) for oid in range(1, 201))
+  return urllib.parse.urlencode({'objectIds': object_ids, 'outFields': '*', 'orderByFields': 'OBJECTID', 'f': 'json'}).encode()
+
+def test_compressed_and_plain_responses_decode_the_same():
+  compressed_server, compressed_url = serve()
+  plain_server, plain_url = serve(compression=False)
+  try:
+    bytes_before = http_pool.stats['bytes_received']
+    compressed = http_pool.fetch(compressed_url, data=page_data())
+    compressed_bytes = http_pool.stats['bytes_received'] - bytes_before
+    plain = http_pool.fetch(plain_url, data=page_data())
+    assert json.loads(compressed)['features'] == json.loads(plain)['features']
+    assert len(json.loads(plain)['features']) == 200
+    assert compressed_bytes < len(plain) / 2
+  finally:
+    for s in (compressed_server, plain_server):
+      s.shutdown()
+      s.server_close()
+
+@pytest.mark.parametrize('accept_compressed_requests', [True, False])
+def test_compressed_requests_fall_back_to_plain(monkeypatch, accept_compressed_requests):
+  monkeypatch.setattr(content_coding, 'compress_requests_over', 100)
+  server, url = serve(accept_compressed_requests=accept_compressed_requests)
+  try:
+    netloc = urllib.parse.urlsplit(url).netloc
+    for i in range(0, 3):
+      assert len(json.loads(http_pool.fetch(url, data=page_data()))['features']) == 200
+    # A host answering 415 is sent plain bodies from then on
+    assert (netloc in content_coding._plain_request_hosts) != accept_compressed_requests
+  finally:
+    server.shutdown()
+    server.server_close()
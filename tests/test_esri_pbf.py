@@ -0,0 +1,102 @@
+import json
+import struct
+import urllib.parse
+
+import pytest
+
+import esri_pbf
+import http_pool
+
+@pytest.mark.parametrize('n', [0, 1, 127, 128, 300, 2 ** 31, 2 ** 63 - 1])
+def test_varint_round_trip(n):
+  assert esri_pbf._read_varint(esri_pbf._varint(n), 0) == (n, len(esri_pbf._varint(n)))
+
+@pytest.mark.parametrize('n', [0, 1, -1, 2, -2, 123456789, -123456789, 2 ** 62, -(2 ** 62)])
+def test_zigzag_round_trip(n):
+  assert esri_pbf._zigzag_encode(n) >= 0
+  assert esri_pbf._zigzag_decode(esri_pbf._zigzag_encode(n)) == n
+
+@pytest.mark.parametrize('count', [0, 1, 1000, 2 ** 40])
+def test_count_round_trip(count):
+  assert esri_pbf.decode(esri_pbf.encode_count(count)) == {'count': count}
+
+@pytest.mark.parametrize('oids', [[], [1], [5, 3, 1], list(range(1, 5000, 7)) + [2 ** 33]])
+def test_ids_round_trip(oids):
+  assert esri_pbf.decode(esri_pbf.encode_ids('FID', oids)) == {'objectIdFieldName': 'FID', 'objectIds': oids}
+
+def test_ids_unpacked_repeated_field():
+  # Encoders may send repeated scalars one per tag instead of packed
+  ids_result = esri_pbf._len_field(1, b'OBJECTID') + b''.join(esri_pbf._varint_field(3, oid) for oid in [9, 8, 7])
+  assert esri_pbf.decode(esri_pbf._wrap(esri_pbf._len_field(3, ids_result)))['objectIds'] == [9, 8, 7]
+
+def test_points_round_trip():
+  fields = [
+    {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+    {'name': 'NAME', 'type': 'esriFieldTypeString'},
+    {'name': 'POP', 'type': 'esriFieldTypeInteger'},
+    {'name': 'RATIO', 'type': 'esriFieldTypeDouble'},
+    {'name': 'ACTIVE', 'type': 'esriFieldTypeSmallInteger'},
+  ]
+  features = [
+    {'attributes': {'OBJECTID': 1, 'NAME': 'Zürich', 'POP': -42, 'RATIO': 0.125, 'ACTIVE': True}, 'geometry': {'x': -100.123456, 'y': 40.654321}},
+    {'attributes': {'OBJECTID': 2 ** 40, 'NAME': '', 'POP': 0, 'RATIO': -1e300, 'ACTIVE': False}},
+  ]
+  decoded = esri_pbf.decode(esri_pbf.encode_points('OBJECTID', fields, features, translate=(-180.0, -90.0), scale=(1e-6, 1e-6), exceeded_transfer_limit=True))
+  assert decoded['objectIdFieldName'] == 'OBJECTID'
+  assert decoded['fields'] == fields
+  assert decoded['exceededTransferLimit'] is True
+  assert decoded['geometryType'] == 'esriGeometryPoint'
+  assert [ f['attributes'] for f in decoded['features'] ] == [ f['attributes'] for f in features ]
+  assert decoded['features'][0]['geometry'] == pytest.approx({'x': -100.123456, 'y': 40.654321}, abs=1e-6)
+  assert not 'geometry' in decoded['features'][1]
+
+def test_polygon_delta_decoding_with_upper_left_origin():
+  # Two rings, coordinates delta encoded across the whole geometry, y growing downwards from translate
+  quantized = [(0, 0), (10, 0), (10, 10), (0, 0), (2, 2), (4, 2), (2, 2)]
+  deltas = []
+  prev = (0, 0)
+  for qx, qy in quantized:
+    deltas += [qx - prev[0], qy - prev[1]]
+    prev = (qx, qy)
+  geometry = esri_pbf._len_field(2, esri_pbf._varint(4) + esri_pbf._varint(3)) + esri_pbf._len_field(3, b''.join(esri_pbf._varint(esri_pbf._zigzag_encode(d)) for d in deltas))
+  transform = esri_pbf._len_field(2, esri_pbf._double_field(1, 0.5) + esri_pbf._double_field(2, 0.5)) + esri_pbf._len_field(3, esri_pbf._double_field(1, 100.0) + esri_pbf._double_field(2, 50.0))
+  feature_result = (
+    esri_pbf._len_field(1, b'OID') +
+    esri_pbf._varint_field(7, 3) + # esriGeometryTypePolygon
+    esri_pbf._len_field(12, esri_pbf._varint_field(1, esri_pbf.quantize_origin_upper_left) + transform) +
+    esri_pbf._len_field(13, esri_pbf._len_field(1, b'OID') + esri_pbf._varint_field(2, 6)) +
+    esri_pbf._len_field(15, esri_pbf._len_field(1, esri_pbf._varint_field(8, esri_pbf._zigzag_encode(7))) + esri_pbf._len_field(2, geometry))
+  )
+  decoded = esri_pbf.decode(esri_pbf._wrap(esri_pbf._len_field(1, feature_result)))
+  assert decoded['geometryType'] == 'esriGeometryPolygon'
+  assert decoded['features'][0]['attributes'] == {'OID': 7}
+  rings = decoded['features'][0]['geometry']['rings']
+  assert rings == [ [ [100.0 + qx * 0.5, 50.0 - qy * 0.5] for qx, qy in quantized[:4] ], [ [100.0 + qx * 0.5, 50.0 - qy * 0.5] for qx, qy in quantized[4:] ] ]
+
+def test_value_types():
+  assert esri_pbf._decode_value(esri_pbf._tag(2, 5) + struct.pack('<f', 1.5)) == 1.5
+  assert esri_pbf._decode_value(esri_pbf._varint_field(5, 7)) == 7 # uint
+  assert esri_pbf._decode_value(esri_pbf._varint_field(6, (1 << 64) - 3)) == -3 # sint64 as two's complement
+  assert esri_pbf._decode_value(b'') is None
+
+def test_unsupported_wire_type_raises():
+  with pytest.raises(ValueError):
+    esri_pbf.decode(esri_pbf._tag(2, 3))
+
+def query(url, **params):
+  return http_pool.fetch(url, data=urllib.parse.urlencode(params).encode())
+
+def test_emulator_pbf_matches_json(emulator):
+  params = {'where': '1=1', 'outFields': '*', 'returnGeometry': 'true', 'orderByFields': 'OBJECTID', 'resultRecordCount': 50}
+  json_resp = json.loads(query(emulator, f='json', **params))
+  pbf_resp = esri_pbf.decode(query(emulator, f='pbf', **params))
+  assert len(pbf_resp['features']) == 50
+  assert [ f['attributes'] for f in pbf_resp['features'] ] == [ f['attributes'] for f in json_resp['features'] ]
+  for pbf_f, json_f in zip(pbf_resp['features'], json_resp['features']):
+    assert pbf_f['geometry'] == pytest.approx(json_f['geometry'], abs=1e-7)
+
+def test_emulator_ids_and_count_match_json(emulator):
+  ids_json = json.loads(query(emulator, where='OBJECTID <= 100', returnIdsOnly='true', f='json'))
+  ids_pbf = esri_pbf.decode(query(emulator, where='OBJECTID <= 100', returnIdsOnly='true', f='pbf'))
+  assert sorted(ids_pbf['objectIds']) == sorted(ids_json['objectIds']) == list(range(1, 101))
+  assert esri_pbf.decode(query(emulator, where='1=1', returnCountOnly='true', f='pbf')) == {'count': 500}
@@ -0,0 +1,73 @@
+import random
+
+import pytest
+import shapely.geometry
+
+import arcgis_emulator
+import page_monitor
+
+def random_oid_lists():
+  rng = random.Random(7)
+  for i in range(0, 40):
+    yield [ rng.randint(0, 2 ** 40) for _ in range(0, rng.randint(0, 30)) ]
+
+@pytest.mark.parametrize('oids', list(random_oid_lists()))
+def test_combine_hashes_matches_hash_of_concatenation(oids):
+  for split in range(0, len(oids) + 1):
+    a, b = oids[:split], oids[split:]
+    assert page_monitor.combine_hashes(page_monitor.rolling_hash(a), page_monitor.rolling_hash(b), len(b)) == page_monitor.rolling_hash(oids)
+
+def test_harvest_hash_from_pages():
+  oids = list(range(1000, 0, -1))
+  h = 0
+  for i in range(0, len(oids), 30):
+    page = oids[i:i+30]
+    h = page_monitor.combine_hashes(h, page_monitor.rolling_hash(page), len(page))
+  assert h == page_monitor.rolling_hash(oids)
+
+def test_rolling_hash_sees_order_and_zero_oids():
+  assert page_monitor.rolling_hash([]) == 0
+  assert page_monitor.rolling_hash([0]) != page_monitor.rolling_hash([])
+  assert page_monitor.rolling_hash([0, 0]) != page_monitor.rolling_hash([0])
+  assert page_monitor.rolling_hash([1, 2, 3]) != page_monitor.rolling_hash([1, 3, 2])
+  assert 0 <= page_monitor.rolling_hash([2 ** 63 - 1] * 100) < page_monitor.hash_modulus
+  assert page_monitor.page_fingerprint([5, 4]) == (2, page_monitor.rolling_hash([5, 4]))
+
+def test_fingerprint_index_round_trip(tmp_path):
+  index = page_monitor.FingerprintIndex(str(tmp_path / 'index.db'))
+  watch = index.add_watch('http://a/query', shapely.geometry.box(0, 0, 1, 1), 10)
+  assert index.add_watch('http://a/query', shapely.geometry.box(0, 0, 1, 1), 10) == watch
+  index.add_watch('http://b/query', shapely.geometry.box(0, 0, 2, 2), 5)
+  assert [ w['query_url'] for w in index.watches() ] == ['http://a/query', 'http://b/query']
+  assert index.watches({'http://b/query'})[0]['page_size'] == 5
+  assert index.page_fingerprints(watch) == {}
+  fingerprints = {(0, 10): (10, 123), (10, 10): (3, 2 ** 60)}
+  index.store_run(watch, fingerprints, {(10, 10)}, 13, 99, 1000.0)
+  assert index.page_fingerprints(watch) == fingerprints
+  index.store_run(watch, {(0, 10): (10, 124)}, set(), 10, 98, 1001.0)
+  assert index.page_fingerprints(watch) == {(0, 10): (10, 124)}
+  index.close()
+
+def test_check_watch_records_then_detects_changes(tmp_path):
+  layer = arcgis_emulator.SyntheticLayer(num_features=300)
+  server, query_url = arcgis_emulator.serve_in_thread(layer)
+  index = page_monitor.FingerprintIndex(str(tmp_path / 'index.db'))
+  try:
+    watch = index.add_watch(query_url, shapely.geometry.box(-125, 24, -67, 50), 40)
+    lines, changed = page_monitor.check_watch(index, watch)
+    assert changed == 0 and 'recorded 8 page fingerprints' in lines[0]
+    lines, changed = page_monitor.check_watch(index, watch)
+    assert changed == 0 and 'unchanged' in lines[0]
+
+    # Pages now start before resultOffset, so rows repeat at page boundaries
+    layer.instability = 'duplicate'
+    layer.instability_rate = 1.0
+    lines, changed = page_monitor.check_watch(index, watch)
+    assert changed > 0
+    report = '\n'.join(lines)
+    assert 'Q1 duplicate OIDs: 0  ' not in report and 'Q1 duplicate OIDs: ' in report
+    assert 'returned 2 times' in report
+  finally:
+    index.close()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,90 @@
+import io
+import json
+import urllib.parse
+
+import pytest
+
+import http_pool
+import replay_cache
+import stream_json
+
+def test_normalize_url_sorts_query_and_lowercases_host():
+  assert replay_cache.normalize_url('HTTP://Example.COM/Arcgis/query?f=json&where=1%3D1&a=') == 'http://example.com/Arcgis/query?a=&f=json&where=1%3D1'
+  assert replay_cache.normalize_url('https://example.com') == 'https://example.com/'
+
+def test_normalize_body():
+  assert replay_cache.normalize_body(None) == b''
+  assert replay_cache.normalize_body(b'where=1%3D1&f=json') == b'f=json&where=1%3D1'
+  assert replay_cache.normalize_body(b'\xff\xfe') == b'\xff\xfe'
+
+def test_request_key():
+  url = 'https://example.com/arcgis/rest/services/A/MapServer/0/query'
+  key = replay_cache.request_key(url, b'f=json&where=1%3D1&resultOffset=0')
+  assert key == replay_cache.request_key(url.replace('example.com', 'EXAMPLE.com'), b'resultOffset=0&where=1%3D1&f=json')
+  assert key != replay_cache.request_key(url, b'f=json&where=1%3D1&resultOffset=10')
+  assert replay_cache.request_key(url, None) != replay_cache.request_key(url, b'')
+
+class FakeResponse:
+  def __init__(self, body, status=200):
+    self.url = 'http://fake/query'
+    self.status = status
+    self.headers = {'Content-Type': 'application/json'}
+    self.num_bytes = 0
+    self.closed = False
+    self._body = io.BytesIO(body)
+
+  def read(self, amt=None):
+    return self._body.read(amt) if amt is not None else self._body.read()
+
+  def close(self):
+    self.closed = True
+
+def record(store, body, read_fn, status=200):
+  resp = replay_cache.RecordingResponse(store, replay_cache.request_key('http://fake/query', b'f=json'), b'f=json', FakeResponse(body, status))
+  with resp:
+    read_fn(resp)
+  return store.get(replay_cache.request_key('http://fake/query', b'f=json'))
+
+def test_only_complete_successful_non_error_bodies_are_recorded(tmp_path):
+  store = replay_cache.ReplayStore(str(tmp_path / 'replay.db'))
+  assert record(store, b'{"features": []}', lambda r: r.read(5), status=500) is None
+  assert record(store, b'{"error": {"code": 429, "message": "Too many requests"}}', lambda r: r.read()) is None
+  assert record(store, b'{"features": [1, 2, 3]}', lambda r: r.read()) == (200, 'application/json', b'{"features": [1, 2, 3]}')
+  store.close()
+
+def test_partly_read_body_is_drained_and_recorded(tmp_path):
+  # stream_json stops at the closing brace; trailing bytes must not keep the response from being recorded
+  store = replay_cache.ReplayStore(str(tmp_path / 'replay.db'))
+  body = b'{"objectIds": [3, 2, 1]}' + b' ' * 100000
+  oids = []
+  assert record(store, body, lambda r: oids.extend(stream_json.iter_top_level_array(r, 'objectIds', chunk_size=16))) == (200, 'application/json', body)
+  assert oids == [3, 2, 1]
+  store.close()
+
+def test_unknown_mode_raises(tmp_path):
+  with pytest.raises(Exception):
+    replay_cache.ReplayStore(str(tmp_path / 'replay.db'), mode='sometimes')
+
+def page_data(offset):
+  return urllib.parse.urlencode({'where': '1=1', 'outFields': 'OBJECTID', 'orderByFields': 'OBJECTID', 'resultOffset': offset, 'resultRecordCount': 10, 'f': 'json'}).encode()
+
+def test_record_then_replay(emulator, tmp_path, monkeypatch):
+  db_file = str(tmp_path / 'replay.db')
+  monkeypatch.setattr(http_pool, 'replay_store', replay_cache.ReplayStore(db_file))
+  recorded = [ http_pool.fetch(emulator, data=page_data(offset)) for offset in (0, 10) ]
+  with http_pool.open_once(emulator, data=page_data(20)) as resp:
+    streamed = list(stream_json.iter_top_level_array(resp, 'features'))
+  assert http_pool.replay_store.stats == {'hits': 0, 'misses': 3, 'recorded': 3}
+  http_pool.replay_store.close()
+
+  monkeypatch.setattr(http_pool, 'replay_store', replay_cache.ReplayStore(db_file, mode='replay'))
+  requests_before = http_pool.stats['requests']
+  # Same parameters in a different order are the same request
+  reordered = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(page_data(10).decode()), reverse=True)).encode()
+  assert http_pool.fetch(emulator, data=page_data(0)) == recorded[0]
+  assert http_pool.fetch(emulator, data=reordered) == recorded[1]
+  assert [ f['attributes'] for f in json.loads(http_pool.fetch(emulator, data=page_data(20)))['features'] ] == [ f['attributes'] for f in streamed ]
+  assert http_pool.stats['requests'] == requests_before
+  with pytest.raises(replay_cache.ReplayMiss):
+    http_pool.fetch(emulator, data=page_data(30))
+  http_pool.replay_store.close()
@@ -0,0 +1,186 @@
+import random
+import threading
+import urllib.error
+import urllib.parse
+
+import pytest
+import shapely.geometry
+
+import arcgis_emulator
+import feature_service
+import http_pool
+import request_scheduler
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+  # Records backoff sleeps instead of sleeping
+  sleeps = []
+  monkeypatch.setattr(request_scheduler.time, 'sleep', sleeps.append)
+  return sleeps
+
+_host_num = [0]
+
+def fresh_url():
+  # Limiters are per host, so every test gets a host no other test used
+  _host_num[0] += 1
+  return f'http://scheduler-test-{_host_num[0]}.invalid/arcgis/rest/services/A/MapServer/0/query'
+
+def test_backoff_is_jittered_within_the_cap(monkeypatch):
+  monkeypatch.setattr(request_scheduler, 'backoff_base_s', 0.5)
+  monkeypatch.setattr(request_scheduler, 'backoff_max_s', 30.0)
+  random.seed(5)
+  for attempt in range(0, 10):
+    delays = [ request_scheduler.backoff_s(attempt) for _ in range(0, 200) ]
+    assert min(delays) >= 0.0
+    assert max(delays) <= min(30.0, 0.5 * 2 ** attempt)
+  # Never sooner than Retry-After, but Retry-After is capped as well
+  assert all(request_scheduler.backoff_s(0, retry_after_s=4.0) >= 4.0 for _ in range(0, 50))
+  assert request_scheduler.backoff_s(0, retry_after_s=600.0) == 30.0
+
+def test_retry_until_success(no_sleep):
+  attempts = []
+  def fn():
+    attempts.append(1)
+    if len(attempts) < 3:
+      raise request_scheduler.RetryableError('busy', retry_after_s=2.0)
+    return 'ok'
+  assert request_scheduler.retry(fresh_url(), fn) == 'ok'
+  assert len(attempts) == 3
+  assert len(no_sleep) == 2 and all(s >= 2.0 for s in no_sleep)
+
+def test_retry_exhausted_after_max_retries(no_sleep, monkeypatch):
+  monkeypatch.setattr(request_scheduler, 'max_retries', 3)
+  attempts = []
+  def fn():
+    attempts.append(1)
+    raise ConnectionResetError('reset')
+  with pytest.raises(request_scheduler.RetriesExhausted):
+    request_scheduler.retry(fresh_url(), fn)
+  assert len(attempts) == 4
+  assert len(no_sleep) == 3
+
+def test_non_retryable_errors_are_raised_at_once(no_sleep):
+  url = fresh_url()
+  def not_found():
+    raise urllib.error.HTTPError(url, 404, 'Not Found', {}, None)
+  with pytest.raises(urllib.error.HTTPError):
+    request_scheduler.retry(url, not_found)
+  def bug():
+    raise KeyError('features')
+  with pytest.raises(KeyError):
+    request_scheduler.retry(url, bug)
+  assert no_sleep == []
+
+def test_throttling_halves_the_host_rate(no_sleep, monkeypatch):
+  monkeypatch.setattr(request_scheduler, 'rate_limit_rps', 10.0)
+  monkeypatch.setattr(request_scheduler, 'rate_limit_burst', 10.0)
+  url = fresh_url()
+  limiter = request_scheduler.limiter_for(url)
+  def throttled_once():
+    if limiter.rps == 10.0:
+      raise urllib.error.HTTPError(url, 429, 'Too Many Requests', {'Retry-After': '1'}, None)
+    return 'ok'
+  assert request_scheduler.retry(url, throttled_once) == 'ok'
+  # Halved, then won back by one additive step on success
+  assert limiter.rps == pytest.approx(5.0 + request_scheduler.additive_increase * 10.0)
+
+@pytest.mark.parametrize('body, retryable', [
+  (b'{"error": {"code": 429, "message": "Too many requests", "details": []}}', True),
+  (b'{"error": {"code": 500, "message": "Error performing query operation"}}', True),
+  (b'{"error": {"code": 400, "message": "Unable to complete operation.", "details": ["Rate limit exceeded"]}}', True),
+  (b'{"error": {"code": 400, "message": "Invalid or missing input parameters."}}', False),
+])
+def test_arcgis_error_payloads(body, retryable):
+  error = request_scheduler.arcgis_error(body)
+  assert error is not None
+  assert request_scheduler.is_retryable_error(error) == retryable
+
+def test_normal_bodies_are_not_errors():
+  assert request_scheduler.arcgis_error(b'{"features": [], "error_count": 1}') is None
+  assert request_scheduler.arcgis_error(b'\x0a\x053.0.0') is None
+  assert request_scheduler.arcgis_error(None) is None
+
+def test_limited_releases_the_slot_on_release_and_on_error(monkeypatch):
+  monkeypatch.setattr(request_scheduler, 'max_inflight', 1)
+  url = fresh_url()
+  limiter = request_scheduler.limiter_for(url)
+  release = request_scheduler.limited(url, lambda release: release)
+  assert not limiter.inflight.acquire(blocking=False)
+  release()
+  release() # A second call must not release someone else's slot
+  assert limiter.inflight.acquire(blocking=False)
+  limiter.inflight.release()
+  with pytest.raises(RuntimeError):
+    request_scheduler.limited(url, lambda release: (_ for _ in ()).throw(RuntimeError('connect failed')))
+  assert limiter.inflight.acquire(blocking=False)
+  limiter.inflight.release()
+
+@pytest.fixture
+def server():
+  # A server of its own, so its host limiter is created with the settings the test patched in
+  servers = []
+  def start(**kwargs):
+    s, query_url = arcgis_emulator.serve_in_thread(arcgis_emulator.SyntheticLayer(num_features=200), **kwargs)
+    servers.append(s)
+    return query_url
+  yield start
+  for s in servers:
+    s.shutdown()
+    s.server_close()
+
+def page_data(offset):
+  return urllib.parse.urlencode({'where': '1=1', 'outFields': 'OBJECTID', 'orderByFields': 'OBJECTID', 'resultOffset': offset, 'resultRecordCount': 10, 'f': 'json'}).encode()
+
+def test_response_holds_the_slot_until_closed(server, monkeypatch):
+  monkeypatch.setattr(request_scheduler, 'max_inflight', 1)
+  url = server()
+  limiter = request_scheduler.limiter_for(url)
+  resp = http_pool.open_once(url, data=page_data(0))
+  opened = threading.Event()
+  def second_request():
+    with http_pool.open_once(url, data=page_data(10)) as resp:
+      resp.read()
+    opened.set()
+  t = threading.Thread(target=second_request)
+  t.start()
+  assert not opened.wait(0.3) # Blocked on the slot while the first body is unread
+  resp.read()
+  resp.close()
+  assert opened.wait(5)
+  t.join()
+  assert limiter.inflight.acquire(blocking=False)
+  limiter.inflight.release()
+
+@pytest.mark.parametrize('style', ['http', 'json'])
+def test_fetch_retries_a_throttling_server(server, monkeypatch, style):
+  monkeypatch.setattr(request_scheduler, 'backoff_base_s', 0.01)
+  monkeypatch.setattr(request_scheduler, 'backoff_max_s', 0.05)
+  monkeypatch.setattr(request_scheduler, 'max_retries', 50)
+  url = server(throttle=arcgis_emulator.Throttle(20, style))
+  retries_before = request_scheduler.stats['retries']
+  pages = [ http_pool.fetch(url, data=page_data(offset)) for offset in range(0, 200, 10) for _ in range(0, 2) ]
+  assert all(b'"features"' in page for page in pages)
+  assert request_scheduler.stats['retries'] > retries_before
+
+def test_one_retry_layer_per_request(server, monkeypatch):
+  # Each failed attempt is one request on the wire: max_retries + 1 in total, not (max_retries + 1) ** 2
+  monkeypatch.setattr(request_scheduler, 'backoff_base_s', 0.0)
+  monkeypatch.setattr(request_scheduler, 'backoff_max_s', 0.0)
+  monkeypatch.setattr(request_scheduler, 'max_retries', 2)
+  url = server(throttle=arcgis_emulator.Throttle(0.001))
+  # Slowing the host down after each 429 is tested above, here it would only make the test slow
+  monkeypatch.setattr(request_scheduler.limiter_for(url), 'on_throttled', lambda: None)
+  monkeypatch.setattr(feature_service, 'use_streaming_json', True)
+  monkeypatch.setattr(feature_service, 'query_format_setting', 'json')
+  client = feature_service.FeatureServiceClient(url) # Reads the layer metadata, which is not throttled
+  requests_before = http_pool.stats['requests']
+  with pytest.raises(request_scheduler.RetriesExhausted):
+    http_pool.fetch(url, data=page_data(0))
+  with pytest.raises(request_scheduler.RetriesExhausted):
+    http_pool.open(url, data=page_data(0))
+  # The streaming readers retry around a single-attempt open
+  with pytest.raises(request_scheduler.RetriesExhausted):
+    client.query_feature_page(shapely.geometry.box(-180, -90, 180, 90), 0, 10)
+  with pytest.raises(request_scheduler.RetriesExhausted):
+    client.query_all_feature_oids(None, where='1=1')
+  assert http_pool.stats['requests'] - requests_before == 4 * 3
@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+import stability_analysis
+
+def brute_inversions(values):
+  return sum(1 for i in range(0, len(values)) for j in range(i + 1, len(values)) if values[i] > values[j])
+
+def brute_lis_len(values):
+  # O(n^2) dynamic programming, strictly increasing
+  best = [1] * len(values)
+  for j in range(0, len(values)):
+    for i in range(0, j):
+      if values[i] < values[j]:
+        best[j] = max(best[j], best[i] + 1)
+  return max(best, default=0)
+
+def random_sequences():
+  rng = random.Random(1234)
+  yield []
+  yield [7]
+  yield list(range(0, 20))
+  yield list(range(20, 0, -1))
+  yield [3, 3, 3, 1, 1, 2] # Equal values are not inversions
+  for i in range(0, 50):
+    n = rng.randint(2, 120)
+    yield [ rng.randint(0, n // 2 if i % 2 else 10 ** 9) for _ in range(0, n) ]
+
+@pytest.mark.parametrize('values', list(random_sequences()))
+def test_count_inversions_matches_brute_force(values):
+  assert stability_analysis.count_inversions(values) == brute_inversions(values)
+
+@pytest.mark.parametrize('values', list(random_sequences()))
+def test_lis_matches_brute_force(values):
+  assert stability_analysis.longest_increasing_subsequence_len(values) == brute_lis_len(values)
+
+def test_ordering_distance_extremes():
+  expected = list(range(1, 101))
+  same = stability_analysis.ordering_distance(expected, expected)
+  assert same == {'common_oids': 100, 'inversions': 0, 'kendall_tau': 1.0, 'lis_fraction': 1.0}
+  reversed_ = stability_analysis.ordering_distance(expected, expected[::-1])
+  assert reversed_['inversions'] == 100 * 99 // 2
+  assert reversed_['kendall_tau'] == -1.0
+  assert reversed_['lis_fraction'] == 1 / 100
+  assert stability_analysis.ordering_distance(expected, [])['kendall_tau'] == 1.0
+
+def test_ordering_distance_ignores_oids_not_in_both():
+  result = stability_analysis.ordering_distance([1, 2, 3, 4], [99, 2, 1, 98, 3])
+  assert result['common_oids'] == 3
+  assert result['inversions'] == 1
+  assert result['kendall_tau'] == pytest.approx(1.0 - 2.0 / 3.0)
+  assert result['lis_fraction'] == pytest.approx(2 / 3)
+
+def brute_analyze(expected, pages):
+  flattened = [ oid for page in pages for oid in page ]
+  deduped = []
+  for oid in flattened:
+    if not oid in deduped:
+      deduped.append(oid)
+  return {
+    'flattened': flattened,
+    'deduped': deduped,
+    'unique': sorted(set(flattened)),
+    'duplicates': [ (oid, flattened.count(oid)) for oid in deduped if flattened.count(oid) > 1 ],
+    'missing': [ oid for oid in expected if not oid in flattened ],
+    'unexpected': [ oid for oid in flattened if not oid in expected ],
+    'order_mismatches': [ (i, e, d) for i, (e, d) in enumerate(zip(expected, deduped)) if e != d ],
+  }
+
+def paginations():
+  expected = list(range(1000, 0, -1))
+  yield expected, [ expected[i:i+7] for i in range(0, len(expected), 7) ]
+  yield expected, [ expected[i:i+7] for i in range(0, len(expected), 6) ] # overlapping pages, duplicates
+  yield expected, [ expected[i:i+5] for i in range(0, len(expected), 6) ] # gaps, missing OIDs
+  yield expected, [ [5000, 5001] ] + [ expected[i:i+9] for i in range(0, len(expected), 9) ][::-1]
+  rng = random.Random(99)
+  shuffled = list(expected)
+  rng.shuffle(shuffled)
+  yield expected, [ shuffled[i:i+8] + [ rng.randint(1, 1200) ] for i in range(0, len(shuffled), 8) ]
+  yield [], []
+  yield expected, []
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+@pytest.mark.parametrize('expected, pages', list(paginations()))
+def test_analyze_matches_brute_force(monkeypatch, use_numpy, expected, pages):
+  if not use_numpy:
+    monkeypatch.setattr(stability_analysis, 'numpy', None)
+  elif stability_analysis.numpy is None:
+    pytest.skip('numpy not installed')
+  result = stability_analysis.analyze(expected, pages)
+  reference = brute_analyze(expected, pages)
+  assert list(result['flattened']) == reference['flattened']
+  assert list(result['deduped']) == reference['deduped']
+  assert sorted(result['unique']) == reference['unique']
+  assert [ (int(oid), int(c)) for oid, c in result['duplicates'] ] == reference['duplicates']
+  assert result['missing'] == reference['missing']
+  assert result['unexpected'] == reference['unexpected']
+  assert result['order_mismatches'] == reference['order_mismatches']
+  assert result['ordering'] == stability_analysis.ordering_distance(expected, reference['deduped'])
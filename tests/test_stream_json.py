@@ -0,0 +1,50 @@
+import io
+import json
+
+import pytest
+
+import stream_json
+
+def stream(doc, array_key, chunk_size):
+  header = dict()
+  items = list(stream_json.iter_top_level_array(io.BytesIO(doc.encode('utf-8')), array_key, header, chunk_size=chunk_size))
+  return items, header
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 64 * 1024])
+def test_features_match_json_loads(chunk_size):
+  resp_json = {
+    'objectIdFieldName': 'OBJECTID',
+    'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'NAME', 'type': 'esriFieldTypeString'}],
+    'features': [ {'attributes': {'OBJECTID': i, 'NAME': f'Zürich ☃ {i}', 'POP': i * 1.5e-7}, 'geometry': {'x': -100.0 - i, 'y': 40.123456789}} for i in range(0, 50) ],
+    'exceededTransferLimit': True,
+  }
+  items, header = stream(json.dumps(resp_json, indent=1), 'features', chunk_size)
+  assert items == resp_json['features']
+  assert header == {'objectIdFieldName': 'OBJECTID', 'fields': resp_json['fields'], 'features': None, 'exceededTransferLimit': True}
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1024])
+def test_object_ids_numbers_split_across_chunks(chunk_size):
+  oids = [ 10 ** (i % 12) + i for i in range(0, 300) ]
+  items, header = stream(json.dumps({'objectIdFieldName': 'FID', 'objectIds': oids}), 'objectIds', chunk_size)
+  assert items == oids
+  assert header == {'objectIdFieldName': 'FID', 'objectIds': None}
+
+def test_empty_array_and_object():
+  assert stream('{"features": []}', 'features', 3) == ([], {'features': None})
+  assert stream(' { } ', 'features', 3) == ([], {})
+
+def test_error_payload_lands_in_header():
+  items, header = stream('{"error": {"code": 400, "message": "Invalid query", "details": []}}', 'features', 5)
+  assert items == []
+  assert header['error']['code'] == 400
+  assert not 'features' in header
+
+def test_non_array_value_is_kept_in_header():
+  items, header = stream('{"features": null, "count": 3}', 'features', 2)
+  assert items == []
+  assert header == {'features': None, 'count': 3}
+
+@pytest.mark.parametrize('doc', ['[1, 2]', '{"features": [1 2]}', '{"features": [1, 2] "x": 1}', '{"features": [1, 2'])
+def test_malformed_documents_raise(doc):
+  with pytest.raises(ValueError):
+    stream(doc, 'features', 2)